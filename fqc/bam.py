@@ -1,11 +1,20 @@
+import hashlib
+import json
 import logging
+import os
+import zlib
+from collections import Counter
+from contextlib import ExitStack
 from urllib.parse import urlparse
 
 import pysam
 from tqdm import tqdm
 
+from .bus import BUSWriter
+from .config import CHECKPOINT_INTERVAL, MAX_OPEN_FILES
+from .resources import get_resources
 from .technologies import OrderedTechnology, TECHNOLOGIES
-from .utils import open_as_text
+from .writers import GzipSplitWriter
 
 logger = logging.getLogger(__name__)
 
@@ -29,11 +38,84 @@ def extract_10x(alignment):
     return ([barcode], [umi], sequence)
 
 
+def hash_whitelist(whitelist):
+    """Compute a checksum of a set of barcodes, which does not depend on the
+    order of the set.
+
+    :param whitelist: set of barcodes, may be `None`
+    :type whitelist: set
+
+    :return: MD5 checksum of the sorted barcodes, or `None` if `whitelist` is
+             `None`
+    :rtype: str
+    """
+    if whitelist is None:
+        return None
+    return hashlib.md5('\n'.join(sorted(whitelist)).encode()).hexdigest()
+
+
+def write_checkpoint(path, checkpoint):
+    """Atomically write a checkpoint to a JSON file, so that an interruption
+    never leaves a partially written checkpoint.
+
+    :param path: path to checkpoint
+    :type path: str
+    :param checkpoint: checkpoint
+    :type checkpoint: dict
+    """
+    temp_path = f'{path}.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(checkpoint, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+
+
+def write_checksums(path, rows):
+    """Write a tab-separated manifest of FASTQs with, on each line, the path,
+    MD5 checksum of the compressed bytes, size in bytes, number of records and
+    number of bases of a FASTQ.
+
+    :param path: path to manifest
+    :type path: str
+    :param rows: list of (path, md5, size, records, bases) tuples
+    :type rows: list
+    """
+    with open(path, 'w') as f:
+        for row in rows:
+            f.write('\t'.join(str(value) for value in row) + '\n')
+
+
+def read_checksums(path):
+    """Read a manifest written by `write_checksums`.
+
+    :param path: path to manifest
+    :type path: str
+
+    :return: list of (path, md5, size, records, bases) tuples
+    :rtype: list
+    """
+    rows = []
+    with open(path, 'r') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            fastq, md5, size, records, bases = line.rstrip('\n').split('\t')
+            rows.append((fastq, md5, int(size), int(records), int(bases)))
+    return rows
+
+
 class BAM:
     """Class to work with BAM files.
 
     :param path: path to BAM file
     :type path: str
+    :param head: path to a local copy of the beginning of the BAM file, which
+                 is used instead of `path` to detect the technology, defaults to `None`
+    :type head: str, optional
+    :param technology: technology of the BAM, if it is already known, in which
+                       case it is not detected again, defaults to `None`
+    :type technology: Technology, optional
     """
     # https://support.10xgenomics.com/single-cell-gene-expression/software/pipelines/latest/output/bam
     TAGS_10X = (
@@ -46,9 +128,10 @@ class BAM:
         '10xv3': extract_10x,
     }
 
-    def __init__(self, path):
+    def __init__(self, path, head=None, technology=None):
         self.path = path
-        self.technology = self.detect_technology()
+        self.head = head
+        self.technology = technology or self.detect_technology()
 
     def detect_technology(self):
         """Detect what technology was used to generate this BAM.
@@ -57,7 +140,7 @@ class BAM:
         :rtype: Technology
         """
         logger.warning('Only 10x Genomics BAM files can be detected.')
-        with pysam.AlignmentFile(self.path, 'rb') as f:
+        with pysam.AlignmentFile(self.head or self.path, 'rb') as f:
             # Check first read of file to see the headers.
             for item in f.fetch(until_eof=True):
                 # This is a 10x BAM
@@ -92,85 +175,561 @@ class BAM:
 
         raise Exception(f'Failed to detect technology for BAM {self.path}')
 
-    def to_fastq(self, prefix='', threads=1):
+    def read_lengths(self):
+        """Get the minimum length of each read, such that all barcode and UMI
+        positions fit.
+
+        :return: list of lengths, one for each read
+        :rtype: list
+        """
+        lengths = [0] * self.technology.n_files
+        for substring in self.technology.barcode_positions + self.technology.umi_positions:
+            lengths[substring.file
+                    ] = max(lengths[substring.file], substring.stop)
+        return lengths
+
+    def extract(self, item):
+        """Extract the barcodes, UMIs and sequence of a single BAM entry.
+
+        :param item: a single BAM entry
+        :type item: pysam.AlignedSegment
+
+        :return: a 3-tuple containing (barcodes, umis, sequence)
+        :rtype: tuple
+        """
+        return BAM.EXTRACT_FUNCTIONS[self.technology.name](item)
+
+    def reads(self, extracted, lengths):
+        """Reconstruct the reads of a single BAM entry.
+
+        :param extracted: 3-tuple containing (barcodes, umis, sequence), as
+                          returned by `extract`
+        :type extracted: tuple
+        :param lengths: minimum length of each read, as returned by `read_lengths`
+        :type lengths: list
+
+        :return: list of reads
+        :rtype: list
+        """
+        reads = ['N' * l for l in lengths]  # noqa
+        barcodes, umis, sequence = extracted
+
+        # Set sequence.
+        reads[self.technology.reads_file.file] = sequence
+
+        # Barcode and UMI
+        for barcode, substring in zip(
+                barcodes, self.technology.barcode_positions):
+            bc = reads[substring.file]
+            reads[substring.file
+                  ] = f'{bc[:substring.start]}{barcode}{bc[substring.stop:]}'
+        for umi, substring in zip(umis, self.technology.umi_positions):
+            u = reads[substring.file]
+            reads[substring.file
+                  ] = f'{u[:substring.start]}{umi}{u[substring.stop:]}'
+
+        return [read.upper() for read in reads]
+
+    @staticmethod
+    def format_record(name, read):
+        """Format a single FASTQ record. All quality scores are set to F.
+
+        :param name: read name
+        :type name: str
+        :param read: read sequence
+        :type read: str
+
+        :return: FASTQ record
+        :rtype: str
+        """
+        return f'@{name}\n{read}\n+\n{"F" * len(read)}\n'
+
+    def count(self, threads=1):
+        """Count the number of entries in the BAM. Remote BAMs are not counted.
+
+        :param threads: number of threads to use to read the BAM file, defaults to `1`
+        :type threads: int, optional
+
+        :return: number of entries, or `None` if the BAM is remote
+        :rtype: int
+        """
+        # Count total number only if the bam is local
+        if urlparse(self.path).scheme:
+            logger.warning((
+                'Skip counting total BAM entries in remote BAM. '
+                'This means a progress bar can not be displayed.'
+            ))
+            return None
+        with pysam.AlignmentFile(self.path, 'rb', threads=threads) as f:
+            count = f.count(until_eof=True)
+        logger.info(f'Detected {count} BAM entries')
+        return count
+
+    def entries(
+        self,
+        f,
+        whitelist=None,
+        fraction=1.,
+        max_records=None,
+        seed=0,
+        pbar=None,
+    ):
+        """Generator for the entries of an open BAM that pass all filters. Entries
+        are filtered before their reads are reconstructed, so that the cost of
+        formatting and writing scales with the number of retained entries.
+
+        Subsampling is deterministic: an entry is kept if the hash of its read
+        name (with the seed) falls below `fraction`, so all entries with the
+        same name are either kept or dropped together, across runs.
+
+        :param f: open BAM file
+        :type f: pysam.AlignmentFile
+        :param whitelist: only keep entries whose barcode is in this set,
+                          defaults to `None`
+        :type whitelist: set, optional
+        :param fraction: fraction of entries to keep, defaults to `1.`
+        :type fraction: float, optional
+        :param max_records: stop after this many entries are kept, defaults to `None`
+        :type max_records: int, optional
+        :param seed: seed for subsampling, defaults to `0`
+        :type seed: int, optional
+        :param pbar: progress bar to update for every entry read, defaults to `None`
+        :type pbar: tqdm.tqdm, optional
+
+        :return: generator for (entry, (barcodes, umis, sequence)) tuples
+        :rtype: generator
+        """
+        if not 0 < fraction <= 1:
+            raise Exception('Fraction of entries to keep must be in (0, 1].')
+        threshold = int(fraction * 2**32)
+        n = 0
+        if max_records is not None and max_records <= 0:
+            return
+        for item in f.fetch(until_eof=True):
+            if pbar is not None:
+                pbar.update(1)
+            if threshold < 2**32 and zlib.crc32(item.query_name.encode(),
+                                                seed) >= threshold:
+                continue
+            extracted = self.extract(item)
+            if whitelist is not None and ''.join(extracted[0]) not in whitelist:
+                continue
+            n += 1
+            yield item, extracted
+            if max_records is not None and n >= max_records:
+                break
+
+    def fastq_paths(self, prefix='', part=None):
+        """Get the paths of the FASTQs that the BAM is split into.
+
+        :param prefix: prefix to output FASTQ files, defaults to empty string
+        :type prefix: str, optional
+        :param part: index of the chunk, starting from 1, defaults to `None`,
+                     which indicates the output is not chunked
+        :type part: int, optional
+
+        :return: list of paths, one for each read
+        :rtype: list
+        """
+        suffix = f'.part{part:04d}' if part is not None else ''
+        return [
+            f'{prefix}_{i+1}{suffix}.fastq.gz'
+            if prefix else f'{i+1}{suffix}.fastq.gz'
+            for i in range(self.technology.n_files)
+        ]
+
+    def to_fastq(
+        self,
+        prefix='',
+        threads=1,
+        whitelist=None,
+        fraction=1.,
+        max_records=None,
+        seed=0,
+        resume=False,
+        checkpoint_interval=CHECKPOINT_INTERVAL,
+        chunk_records=None,
+        chunk_bytes=None,
+    ):
         """Split the BAM into FASTQs.
 
+        Every `checkpoint_interval` BAM entries, all FASTQs are flushed at clean
+        gzip member boundaries and a checkpoint of the BAM virtual offset and
+        the FASTQ sizes is written to `{prefix}.checkpoint.json`. The checkpoint
+        is removed when the split completes. If the split is interrupted, it
+        can be resumed by truncating the FASTQs to the checkpoint.
+
+        If `chunk_records` or `chunk_bytes` is provided, the output is rotated
+        into chunks named `{prefix}_{i}.part{j}.fastq.gz`, where all reads of
+        an entry are always in the same chunk, and a manifest of the chunks
+        is written to `{prefix}.manifest.tsv`. Each line of the manifest
+        contains the chunk, its number of records and its FASTQs.
+
+        While writing, the MD5 checksum of the compressed bytes and the number
+        of records and bases of each FASTQ are counted, and written to
+        `{prefix}.checksums.tsv` (see `write_checksums`), so that the FASTQs
+        can be verified without reading them again.
+
         :param path: path to BAM file
         :type path: str
         :param prefix: prefix to output FASTQ files, defaults to empty string
         :type prefix: str, optional
         :param threads: number of threads to use to read the BAM file, defaults to `1`
         :type threads: int, optional
+        :param whitelist: only write entries whose barcode is in this set,
+                          defaults to `None`
+        :type whitelist: set, optional
+        :param fraction: fraction of entries to write, defaults to `1.`
+        :type fraction: float, optional
+        :param max_records: maximum number of entries to write, defaults to `None`
+        :type max_records: int, optional
+        :param seed: seed for subsampling, defaults to `0`
+        :type seed: int, optional
+        :param resume: whether to resume from the last checkpoint, if there is
+                       one, defaults to `False`
+        :type resume: bool, optional
+        :param checkpoint_interval: number of BAM entries between checkpoints,
+                                    defaults to `1000000`
+        :type checkpoint_interval: int, optional
+        :param chunk_records: maximum number of entries per chunk, defaults to `None`
+        :type chunk_records: int, optional
+        :param chunk_bytes: maximum number of uncompressed bytes (of all reads)
+                            per chunk, defaults to `None`
+        :type chunk_bytes: int, optional
 
-        :return: (list of paths to generated FASTQs, list of OrderedTechnology objects)
+        :return: (list of paths to generated FASTQs, list of OrderedTechnology
+                 objects). If the output is chunked, the first element is a
+                 list of chunks instead, each a list of paths to FASTQs.
         :rtype: tuple
         """
-        # Write to uncompressed FASTQ for speed
-        fastqs = [
-            f'{prefix}_{i+1}.fastq.gz' if prefix else f'{i+1}.fastq.gz'
-            for i in range(self.technology.n_files)
-        ]
-        logger.info(f'Splitting BAM file into FASTQs {", ".join(fastqs)}')
+        chunked = chunk_records is not None or chunk_bytes is not None
+        checkpoint_path = f'{prefix}.checkpoint.json' if prefix else 'checkpoint.json'
+        manifest_path = f'{prefix}.manifest.tsv' if prefix else 'manifest.tsv'
+        checksums_path = f'{prefix}.checksums.tsv' if prefix else 'checksums.tsv'
+        # Arguments that must be the same to resume from a checkpoint.
+        arguments = {
+            'path': self.path,
+            'prefix': prefix,
+            'fraction': fraction,
+            'max_records': max_records,
+            'seed': seed,
+            'chunk_records': chunk_records,
+            'chunk_bytes': chunk_bytes,
+            'whitelist': hash_whitelist(whitelist),
+        }
+        checkpoint = None
+        if resume:
+            if os.path.exists(checkpoint_path):
+                with open(checkpoint_path, 'r') as f:
+                    checkpoint = json.load(f)
+                if checkpoint['arguments'] != arguments:
+                    raise Exception(
+                        f'Checkpoint {checkpoint_path} was written with different arguments.'
+                    )
+                logger.info((
+                    f'Resuming from checkpoint {checkpoint_path} after '
+                    f'{checkpoint["n_read"]} BAM entries'
+                ))
+            else:
+                logger.warning(
+                    f'Checkpoint {checkpoint_path} does not exist. Starting from the beginning.'
+                )
+        elif os.path.exists(checkpoint_path):
+            # A checkpoint of an earlier split must not be used to resume this
+            # one, whose FASTQs are written from the beginning.
+            logger.warning(f'Removing checkpoint {checkpoint_path}')
+            os.remove(checkpoint_path)
+        logger.info((
+            f'Splitting BAM file into FASTQs '
+            f'{", ".join(self.fastq_paths(prefix, 1 if chunked else None))}'
+            f'{" and following chunks" if chunked else ""}'
+        ))
         logger.warning('All quality scores will be converted to F')
-        files = []
-        lengths = [0, 0, 0]
-        for substring in self.technology.barcode_positions + self.technology.umi_positions:
-            lengths[substring.file
-                    ] = max(lengths[substring.file], substring.stop)
+        lengths = self.read_lengths()
 
-        try:
-            for fastq in fastqs:
-                files.append(open_as_text(fastq, 'w'))
+        # Paths and number of records of each chunk, the number of bytes in
+        # the last chunk, and the number of bases in each FASTQ.
+        if checkpoint:
+            chunks = checkpoint['chunks']
+            n_bytes = checkpoint['n_bytes']
+            bases = checkpoint['bases']
+        else:
+            chunks = [[self.fastq_paths(prefix, 1 if chunked else None), 0]]
+            n_bytes = 0
+            bases = {}
+        n = sum(n_records for _, n_records in chunks)
 
-            # Count total number only if the bam is local
-            parse = urlparse(self.path)
-            if not parse.scheme:
-                with pysam.AlignmentFile(self.path, 'rb', threads=threads) as f:
-                    count = f.count(until_eof=True)
-                logger.info(f'Detected {count} BAM entries')
+        # Only part of the BAM is read if the number of entries is limited.
+        count = self.count(threads=threads) if max_records is None else None
+        writer = GzipSplitWriter(
+            max_open=self.technology.n_files,
+            max_buffered=get_resources().max_buffered
+        )
+        with ExitStack() as stack:
+            stack.enter_context(writer)
+            f = stack.enter_context(
+                pysam.AlignmentFile(self.path, 'rb', threads=threads)
+            )
+            pbar = stack.enter_context(tqdm(total=count))
+            if checkpoint:
+                writer.truncate(checkpoint['sizes'])
+                f.seek(checkpoint['offset'])
+                pbar.update(checkpoint['n_read'])
             else:
-                logger.warning((
-                    'Skip counting total BAM entries in remote BAM. '
-                    'This means a progress bar can not be displayed.'
-                ))
+                writer.truncate({fastq: 0 for fastq in chunks[0][0]})
+            last = pbar.n
+            for item, extracted in self.entries(
+                    f,
+                    whitelist=whitelist,
+                    fraction=fraction,
+                    max_records=max_records -
+                    n if max_records is not None else None,
+                    seed=seed,
+                    pbar=pbar,
+            ):
+                reads = self.reads(extracted, lengths)
+                records = [
+                    BAM.format_record(item.query_name, read) for read in reads
+                ]
+
+                # Rotate to the next chunk if this one is full.
+                size = sum(len(record) for record in records)
+                if chunked and chunks[-1][1] > 0 and (
+                        chunks[-1][1] >= (chunk_records or float('inf'))
+                        or n_bytes + size > (chunk_bytes or float('inf'))):
+                    writer.flush()
+                    part = len(chunks) + 1
+                    chunks.append([self.fastq_paths(prefix, part), 0])
+                    n_bytes = 0
+
+                # Write to each file.
+                for fastq, read, record in zip(chunks[-1][0], reads, records):
+                    writer.write(fastq, record)
+                    bases[fastq] = bases.get(fastq, 0) + len(read)
+                chunks[-1][1] += 1
+                n_bytes += size
+                n += 1
+
+                if pbar.n - last >= checkpoint_interval:
+                    last = pbar.n
+                    write_checkpoint(
+                        checkpoint_path, {
+                            'arguments': arguments,
+                            'offset': f.tell(),
+                            'n_read': pbar.n,
+                            'chunks': chunks,
+                            'n_bytes': n_bytes,
+                            'bases': bases,
+                            'sizes': writer.checkpoint(),
+                        }
+                    )
+
+        technologies = [
+            OrderedTechnology(
+                self.technology, tuple(range(self.technology.n_files))
+            )
+        ]
+        md5s = writer.checksums()
+        write_checksums(
+            checksums_path, [(
+                fastq, md5s[fastq], os.path.getsize(fastq), n_records,
+                bases.get(fastq, 0)
+            ) for fastqs, n_records in chunks for fastq in fastqs]
+        )
+        logger.info(f'Wrote checksums and counts to {checksums_path}')
+        if os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+        if not chunked:
+            return chunks[0][0], technologies
+
+        with open(manifest_path, 'w') as f:
+            for i, (fastqs, n_records) in enumerate(chunks):
+                f.write('\t'.join([f'part{i+1:04d}', str(n_records)] + fastqs))
+                f.write('\n')
+        logger.info(f'Wrote {len(chunks)} chunks, listed in {manifest_path}')
+        return [fastqs for fastqs, _ in chunks], technologies
+
+    def to_bus(
+        self,
+        path,
+        threads=1,
+        whitelist=None,
+        fraction=1.,
+        max_records=None,
+        seed=0,
+    ):
+        """Convert the BAM directly into a binary file of 2-bit packed barcode,
+        UMI and sequence records (see `bus.py`), skipping the FASTQ round trip.
+        Read names and quality scores are not written.
+
+        :param path: path to output file
+        :type path: str
+        :param threads: number of threads to use to read the BAM file, defaults to `1`
+        :type threads: int, optional
+        :param whitelist: only write entries whose barcode is in this set,
+                          defaults to `None`
+        :type whitelist: set, optional
+        :param fraction: fraction of entries to write, defaults to `1.`
+        :type fraction: float, optional
+        :param max_records: maximum number of entries to write, defaults to `None`
+        :type max_records: int, optional
+        :param seed: seed for subsampling, defaults to `0`
+        :type seed: int, optional
+
+        :return: number of records written
+        :rtype: int
+        """
+        barcode_length = sum(
+            substring.stop - substring.start
+            for substring in self.technology.barcode_positions
+        )
+        umi_length = sum(
+            substring.stop - substring.start
+            for substring in self.technology.umi_positions
+        )
+        logger.info(f'Converting BAM file into {path}')
+        count = self.count(threads=threads) if max_records is None else None
+        with ExitStack() as stack:
+            writer = stack.enter_context(
+                BUSWriter(
+                    path, barcode_length, umi_length, text=self.technology.name
+                )
+            )
+            f = stack.enter_context(
+                pysam.AlignmentFile(self.path, 'rb', threads=threads)
+            )
+            pbar = stack.enter_context(tqdm(total=count))
+            for _, (barcodes, umis, sequence) in self.entries(
+                    f,
+                    whitelist=whitelist,
+                    fraction=fraction,
+                    max_records=max_records,
+                    seed=seed,
+                    pbar=pbar,
+            ):
+                writer.write(''.join(barcodes), ''.join(umis), sequence)
+        logger.info(f'Wrote {writer.n_records} records')
+        return writer.n_records
+
+    def count_barcodes(self, threads=1):
+        """Count the number of BAM entries for each cell barcode.
+
+        :param threads: number of threads to use to read the BAM file, defaults to `1`
+        :type threads: int, optional
+
+        :return: dictionary of barcodes as keys and counts as values
+        :rtype: collections.Counter
+        """
+        counts = Counter()
+        with pysam.AlignmentFile(self.path, 'rb', threads=threads) as f:
+            for item in f.fetch(until_eof=True):
+                barcodes, _, _ = self.extract(item)
+                counts[''.join(barcodes)] += 1
+        return counts
+
+    def split_cells(
+        self,
+        prefix='',
+        threads=1,
+        whitelist=None,
+        min_count=0,
+        groups=None,
+        max_open=MAX_OPEN_FILES,
+        fraction=1.,
+        max_records=None,
+        seed=0,
+    ):
+        """Split the BAM into FASTQs per cell barcode (or per group of barcodes)
+        in a single pass. Only a bounded number of output files are kept open
+        at once.
+
+        :param prefix: prefix to output FASTQ files, defaults to empty string
+        :type prefix: str, optional
+        :param threads: number of threads to use to read the BAM file, defaults to `1`
+        :type threads: int, optional
+        :param whitelist: only write barcodes in this set, defaults to `None`
+        :type whitelist: set, optional
+        :param min_count: only write barcodes with at least this many entries,
+                          which requires an additional pass over the BAM to
+                          count barcodes, defaults to `0`
+        :type min_count: int, optional
+        :param groups: dictionary of barcodes as keys and group names as values.
+                       If provided, one set of FASTQs is written per group
+                       instead of per barcode, and barcodes that are not in
+                       any group are not written, defaults to `None`
+        :type groups: dict, optional
+        :param max_open: maximum number of open files, defaults to `256`
+        :type max_open: int, optional
+        :param fraction: fraction of entries to write, defaults to `1.`
+        :type fraction: float, optional
+        :param max_records: maximum number of entries to write, defaults to `None`
+        :type max_records: int, optional
+        :param seed: seed for subsampling, defaults to `0`
+        :type seed: int, optional
+
+        :return: (dictionary of barcodes or groups as keys and lists of paths to
+                 generated FASTQs as values, list of OrderedTechnology objects)
+        :rtype: tuple
+        """
+        logger.info(
+            f'Splitting BAM file into FASTQs per {"group" if groups else "cell"}'
+        )
+        logger.warning('All quality scores will be converted to F')
+        keep = whitelist
+        if min_count > 0:
+            logger.info(
+                f'Counting barcodes to filter those with < {min_count} entries'
+            )
+            counts = self.count_barcodes(threads=threads)
+            keep = {
+                barcode
+                for barcode, count in counts.items()
+                if count >= min_count and
+                (whitelist is None or barcode in whitelist)
+            }
+            logger.info(f'{len(keep)}/{len(counts)} barcodes will be written')
+
+        if groups is not None:
+            keep = set(groups) if keep is None else keep & set(groups)
+
+        lengths = self.read_lengths()
+        fastqs = {}
+        count = self.count(threads=threads) if max_records is None else None
+        writer = GzipSplitWriter(
+            max_open=max_open, max_buffered=get_resources().max_buffered
+        )
+        with ExitStack() as stack:
+            stack.enter_context(writer)
+            f = stack.enter_context(
+                pysam.AlignmentFile(self.path, 'rb', threads=threads)
+            )
+            pbar = stack.enter_context(tqdm(total=count))
+            for item, extracted in self.entries(
+                    f,
+                    whitelist=keep,
+                    fraction=fraction,
+                    max_records=max_records,
+                    seed=seed,
+                    pbar=pbar,
+            ):
+                barcode = ''.join(extracted[0])
+                key = groups[barcode] if groups is not None else barcode
 
-            with pysam.AlignmentFile(self.path, 'rb', threads=threads) as f,\
-                tqdm() if parse.scheme else tqdm(total=count) as pbar:
-                for item in f.fetch(until_eof=True):
-                    reads = ['N' * l for l in lengths]  # noqa
-                    barcodes, umis, sequence = BAM.EXTRACT_FUNCTIONS[
-                        self.technology.name](item)  # noqa
-
-                    # Set sequence.
-                    reads[self.technology.reads_file.file] = sequence
-
-                    # Barcode and UMI
-                    for barcode, substring in zip(
-                            barcodes, self.technology.barcode_positions):
-                        bc = reads[substring.file]
-                        reads[
-                            substring.file
-                        ] = f'{bc[:substring.start]}{barcode}{bc[substring.stop:]}'
-                    for umi, substring in zip(umis,
-                                              self.technology.umi_positions):
-                        u = reads[substring.file]
-                        reads[
-                            substring.file
-                        ] = f'{u[:substring.start]}{umi}{u[substring.stop:]}'
-
-                    # Write to each file.
-                    for file, read in zip(files, reads):
-                        file.write(f'@{item.query_name}\n')
-                        file.write(f'{read.upper()}\n')
-                        file.write('+\n')
-                        file.write(f'{"F" * len(read)}\n')
-
-                    pbar.update(1)
-
-        finally:
-            for file in files:
-                file.close()
+                if key not in fastqs:
+                    fastqs[key] = [
+                        f'{prefix}_{key}_{i+1}.fastq.gz'
+                        if prefix else f'{key}_{i+1}.fastq.gz'
+                        for i in range(self.technology.n_files)
+                    ]
+                reads = self.reads(extracted, lengths)
+                for fastq, read in zip(fastqs[key], reads):
+                    writer.write(
+                        fastq, BAM.format_record(item.query_name, read)
+                    )
 
+        logger.info(f'Wrote FASTQs for {len(fastqs)} cells or groups')
         return fastqs, [
-            OrderedTechnology(self.technology, tuple(range(len(fastqs))))
+            OrderedTechnology(
+                self.technology, tuple(range(self.technology.n_files))
+            )
         ]
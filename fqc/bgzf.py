@@ -0,0 +1,377 @@
+import io
+import logging
+import os
+import struct
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain, islice
+
+from .config import THREADS
+
+logger = logging.getLogger(__name__)
+
+# Empty BGZF block that marks the end of a BGZF file.
+BGZF_EOF = bytes.fromhex(
+    '1f8b08040000000000ff0600424302001b0003000000000000000000'
+)
+# Maximum size of a compressed BGZF block.
+MAX_BLOCK_SIZE = 1 << 16
+
+
+def is_bgzf(data):
+    """Determine whether some bytes start with a BGZF block header, which is
+    a gzip header with a `BC` extra subfield.
+
+    :param data: bytes from the start of a file
+    :type data: bytes
+
+    :return: whether or not the data is BGZF-compressed
+    :rtype: bool
+    """
+    return len(data) >= 18 and data[:4] == b'\x1f\x8b\x08\x04' and data[
+        12:14] == b'BC'
+
+
+def bgzf_complete_length(data):
+    """Find the length of the longest prefix of some BGZF-compressed bytes that
+    contains only complete blocks.
+
+    :param data: BGZF-compressed bytes
+    :type data: bytes
+
+    :return: number of bytes
+    :rtype: int
+    """
+    offset = 0
+    while is_bgzf(data[offset:offset + 18]):
+        size = struct.unpack_from('<H', data, offset + 16)[0] + 1
+        if offset + size > len(data):
+            break
+        offset += size
+    return offset
+
+
+def is_bgzf_file(path):
+    """Determine whether a local file is BGZF-compressed.
+
+    :param path: path to file
+    :type path: str
+
+    :return: whether or not the file is BGZF-compressed
+    :rtype: bool
+    """
+    with open(path, 'rb') as f:
+        return is_bgzf(f.read(18))
+
+
+def read_blocks(f, n):
+    """Read up to `n` compressed BGZF blocks from a binary file object.
+
+    :param f: binary file object, positioned at the start of a block
+    :type f: file object
+    :param n: maximum number of blocks to read
+    :type n: int
+
+    :return: list of compressed blocks
+    :rtype: list
+    """
+    blocks = []
+    for _ in range(n):
+        header = f.read(18)
+        if not header:
+            break
+        if not is_bgzf(header):
+            raise Exception(
+                f'Invalid BGZF block header at byte {f.tell() - len(header)}'
+            )
+        size = struct.unpack_from('<H', header, 16)[0] + 1
+        blocks.append(header + f.read(size - 18))
+    return blocks
+
+
+def decompress_block(block):
+    """Decompress a single BGZF block and verify its checksum.
+
+    :param block: compressed block
+    :type block: bytes
+
+    :return: decompressed data
+    :rtype: bytes
+    """
+    xlen = struct.unpack_from('<H', block, 10)[0]
+    data = zlib.decompress(block[12 + xlen:-8], -15)
+    crc, size = struct.unpack_from('<II', block, len(block) - 8)
+    if len(data) != size or zlib.crc32(data) != crc:
+        raise Exception('BGZF block failed its integrity check')
+    return data
+
+
+def decompress_blocks(blocks):
+    """Decompress a list of BGZF blocks.
+
+    :param blocks: list of compressed blocks
+    :type blocks: list
+
+    :return: decompressed data of all blocks
+    :rtype: bytes
+    """
+    return b''.join(decompress_block(block) for block in blocks)
+
+
+def find_block(f, offset):
+    """Find the first BGZF block that starts at or after an offset, by scanning
+    for a block header whose size points at another block header (or the end
+    of the file).
+
+    :param f: binary file object
+    :type f: file object
+    :param offset: offset in bytes
+    :type offset: int
+
+    :return: offset of the block, or `None` if there is none
+    :rtype: int
+    """
+    size = f.seek(0, os.SEEK_END)
+    f.seek(offset)
+    data = f.read(2 * MAX_BLOCK_SIZE + 18)
+    i = data.find(b'\x1f\x8b\x08\x04')
+    while i >= 0:
+        if is_bgzf(data[i:i + 18]):
+            end = i + struct.unpack_from('<H', data, i + 16)[0] + 1
+            if offset + end == size or is_bgzf(data[end:end + 18]):
+                return offset + i
+        i = data.find(b'\x1f\x8b\x08\x04', i + 1)
+    return None
+
+
+class BGZFReader(io.RawIOBase):
+    """Binary file-like object of the decompressed data of a BGZF file.
+
+    Compressed blocks are read sequentially, and decompressed in groups of
+    `blocks_per_task` blocks by `threads` threads (zlib releases the GIL), with
+    at most `queue_depth` groups in flight.
+
+    :param path: path to BGZF file
+    :type path: str
+    :param offset: offset of the block to start reading at, defaults to `0`
+    :type offset: int, optional
+    :param threads: number of decompression threads, defaults to the number of
+                    cpus
+    :type threads: int, optional
+    :param blocks_per_task: number of blocks decompressed at once, defaults to
+                            `64`
+    :type blocks_per_task: int, optional
+    :param queue_depth: maximum number of groups of blocks in flight, defaults
+                        to `None`, which is twice the number of threads
+    :type queue_depth: int, optional
+    """
+
+    def __init__(
+        self,
+        path,
+        offset=0,
+        threads=THREADS,
+        blocks_per_task=64,
+        queue_depth=None,
+    ):
+        super().__init__()
+        self.fileobj = open(path, 'rb')
+        self.fileobj.seek(offset)
+        self.threads = threads
+        self.blocks_per_task = blocks_per_task
+        self.queue_depth = queue_depth or 2 * threads
+        self.executor = ThreadPoolExecutor(threads) if threads > 1 else None
+        self.pending = deque()
+        self.exhausted = False
+        self.buffer = b''
+        self.position = 0
+
+    @property
+    def offset(self):
+        """Offset in bytes of the next compressed block to be read.
+        """
+        return self.fileobj.tell()
+
+    def readable(self):
+        return True
+
+    def _next(self):
+        """Decompress the next group of blocks.
+
+        :return: decompressed data, or `None` at the end of the file
+        :rtype: bytes
+        """
+        if self.executor is None:
+            blocks = read_blocks(self.fileobj, self.blocks_per_task)
+            return decompress_blocks(blocks) if blocks else None
+        while not self.exhausted and len(self.pending) < self.queue_depth:
+            blocks = read_blocks(self.fileobj, self.blocks_per_task)
+            if not blocks:
+                self.exhausted = True
+                break
+            self.pending.append(self.executor.submit(decompress_blocks, blocks))
+        return self.pending.popleft().result() if self.pending else None
+
+    def readinto(self, b):
+        # Loop, since some blocks (such as the EOF block) are empty.
+        while self.position >= len(self.buffer):
+            data = self._next()
+            if data is None:
+                return 0
+            self.buffer, self.position = data, 0
+        n = min(len(b), len(self.buffer) - self.position)
+        b[:n] = memoryview(self.buffer)[self.position:self.position + n]
+        self.position += n
+        return n
+
+    def close(self):
+        if self.closed:
+            return
+        super().close()
+        if self.executor is not None:
+            for future in self.pending:
+                future.cancel()
+            self.executor.shutdown(wait=True)
+        self.pending.clear()
+        self.fileobj.close()
+
+
+def read_name(header):
+    """Get the name of a read from its FASTQ header line, without the `/1` or
+    `/2` suffix that some FASTQs use to mark the mate.
+
+    :param header: header line
+    :type header: str
+
+    :return: read name
+    :rtype: str
+    """
+    name = header[1:].split(maxsplit=1)[0] if header[1:].strip() else ''
+    return name[:-2] if name[-2:-1] == '/' else name
+
+
+def fastq_records(lines):
+    """Generator for the (name, sequence) of FASTQ records in lines that may
+    start in the middle of a record, such as at an arbitrary BGZF block. Lines
+    are skipped until four of them look like a complete record.
+
+    :param lines: iterable of lines of a FASTQ file
+    :type lines: iterable
+
+    :return: generator for (read name, sequence) tuples
+    :rtype: generator
+    """
+    lines = iter(lines)
+    record = list(islice(lines, 4))
+    while len(record) == 4 and not (
+            record[0].startswith('@') and record[2].startswith('+')
+            and len(record[1].rstrip()) == len(record[3].rstrip())):
+        record = record[1:] + list(islice(lines, 1))
+    while len(record) == 4:
+        yield read_name(record[0]), record[1].strip()
+        record = list(islice(lines, 4))
+
+
+def sample_fastqs(paths, n, n_chunks, slack=0.01, threads=THREADS):
+    """Sample synchronized reads from `n_chunks` evenly spaced positions
+    across BGZF-compressed FASTQs, without decompressing anything before them.
+    Chunks are sampled concurrently.
+
+    Each chunk starts at the first complete record at its position in the first
+    FASTQ. Since the other FASTQs compress differently, the same record is found
+    by name by scanning from `slack` (a fraction of the file size) before the
+    same position.
+
+    :param paths: paths to BGZF-compressed FASTQs
+    :type paths: list
+    :param n: total number of reads to sample
+    :type n: int
+    :param n_chunks: number of positions to sample at
+    :type n_chunks: int
+    :param slack: fraction of each file to scan for a record, defaults to
+                  `0.01`
+    :type slack: float, optional
+    :param threads: number of chunks to sample at once, defaults to the number
+                    of cpus
+    :type threads: int, optional
+
+    :return: list of lists of reads, one list per FASTQ
+    :rtype: list
+    """
+    sizes = [os.path.getsize(path) for path in paths]
+    # Small FASTQs may not have a block at or after every position, and
+    # several positions may be in the same block, in which case fewer
+    # positions are sampled.
+    targets = []
+    offsets = set()
+    with open(paths[0], 'rb') as f:
+        for k in range(n_chunks):
+            target = (k + 0.5) / n_chunks
+            offset = find_block(f, int(target * sizes[0]))
+            if offset is not None and offset not in offsets:
+                targets.append(target)
+                offsets.add(offset)
+    per_chunk = -(-n // max(len(targets), 1))
+
+    def _sample(target):
+        chunk = []
+        anchor = None
+        for path, size in zip(paths, sizes):
+            start = int(target * size)
+            if anchor is not None:
+                start = max(start - int(slack * size), 0)
+            with open(path, 'rb') as f:
+                offset = find_block(f, start)
+            if offset is None:
+                raise Exception(f'No BGZF block after byte {start} of {path}')
+
+            reader = BGZFReader(path, offset, threads=1, blocks_per_task=1)
+            with io.TextIOWrapper(io.BufferedReader(reader)) as f:
+                records = fastq_records(f)
+                if anchor is None:
+                    first = next(records, None)
+                    if first is None:
+                        # There are no complete records after this position.
+                        return None
+                    anchor = first[0]
+                else:
+                    limit = target * size + slack * size + MAX_BLOCK_SIZE
+                    first = None
+                    for record in records:
+                        if record[0] == anchor:
+                            first = record
+                            break
+                        if reader.offset > limit:
+                            break
+                    if first is None:
+                        raise Exception(
+                            f'Failed to find read {anchor} near byte '
+                            f'{int(target * size)} of {path}'
+                        )
+                chunk.append([first[1]] + [
+                    sequence for _, sequence in islice(records, per_chunk - 1)
+                ])
+        n_reads = min(len(reads) for reads in chunk)
+        return [reads[:n_reads] for reads in chunk]
+
+    with ThreadPoolExecutor(threads) as executor:
+        chunks = [
+            chunk for chunk in executor.map(_sample, targets)
+            if chunk is not None
+        ]
+    if len(chunks) < n_chunks:
+        logger.warning((
+            f'{paths[0]} is too small to sample {n_chunks} positions. Only '
+            f'{len(chunks)} positions were sampled.'
+        ))
+    if not chunks:
+        logger.warning('Reading from the start instead.')
+        per_chunk = n
+        chunks = [_sample(0.)]
+    reads = [
+        list(chain.from_iterable(c[i]
+                                 for c in chunks))
+        for i in range(len(paths))
+    ]
+    return [rs[:n] for rs in reads]
@@ -0,0 +1,249 @@
+import struct
+
+import numpy as np
+
+from .plan import encode, ENCODING, to_matrix
+
+# File format, modeled after the BUS format
+# (https://github.com/BUStools/BUS-format), but with the read sequence stored
+# in each record instead of an equivalence class.
+#
+# Header:
+#   magic (4 bytes, FQB\0), version (uint32), barcode length (uint32),
+#   UMI length (uint32), text length (uint32), text (free-form, i.e. the
+#   technology)
+# Record:
+#   barcode (uint64, 2-bit packed), UMI (uint64, 2-bit packed),
+#   flags (uint32), sequence length (uint32),
+#   sequence (2-bit packed, 4 bases per byte, first base in the highest bits),
+#   N mask (only if FLAG_SEQUENCE_N is set, 1 bit per base, set for any base
+#   that is not A, C, G or T)
+# All integers are little-endian. Any base that is not A, C, G or T is packed
+# as A.
+MAGIC = b'FQB\0'
+VERSION = 1
+HEADER = struct.Struct('<4sIIII')
+RECORD = struct.Struct('<QQII')
+FLAG_BARCODE_N = 1
+FLAG_UMI_N = 2
+FLAG_SEQUENCE_N = 4
+DECODING = np.frombuffer(b'ACGT', dtype=np.uint8)
+
+
+def pack_sequences(sequences):
+    """2-bit pack a list of sequences of any length.
+
+    :param sequences: list of sequences
+    :type sequences: list
+
+    :return: (packed, masks, lengths) tuple, where `packed` is a 2D array with
+             one row of packed bytes per sequence, `masks` is a 2D array with
+             one row of packed N mask bits per sequence, and `lengths` contains
+             the length of each sequence
+    :rtype: tuple
+    """
+    matrix, lengths = to_matrix(sequences)
+    # Pad to a multiple of 8 columns, so that both the 2-bit packed sequences
+    # and the 1-bit masks are a whole number of bytes.
+    width = -(-matrix.shape[1] // 8) * 8
+    values = np.full((len(sequences), width), 255, dtype=np.uint8)
+    values[:, :matrix.shape[1]] = ENCODING[matrix]
+    invalid = values == 255
+    invalid[np.arange(width)[None, :] >= lengths[:, None]] = False
+    values[values == 255] = 0
+
+    quads = values.reshape(len(sequences), -1, 4)
+    packed = (quads[:, :, 0] << 6) | (quads[:, :, 1] << 4
+                                      ) | (quads[:, :, 2] << 2) | quads[:, :, 3]
+    masks = np.packbits(invalid, axis=1)
+    return packed.astype(np.uint8), masks, lengths
+
+
+def unpack_sequence(packed, length, mask=None):
+    """Unpack a single 2-bit packed sequence.
+
+    :param packed: packed bytes
+    :type packed: bytes
+    :param length: length of the sequence
+    :type length: int
+    :param mask: packed N mask bits, defaults to `None`
+    :type mask: bytes, optional
+
+    :return: sequence
+    :rtype: str
+    """
+    values = np.frombuffer(packed, dtype=np.uint8)
+    values = np.stack([(values >> shift) & 3 for shift in (6, 4, 2, 0)],
+                      axis=1).reshape(-1)[:length]
+    sequence = DECODING[values]
+    if mask is not None:
+        sequence = sequence.copy()
+        sequence[np.unpackbits(np.frombuffer(mask, dtype=np.uint8)
+                               )[:length].astype(bool)] = ord('N')
+    return sequence.tobytes().decode()
+
+
+def encode_fixed(sequences):
+    """2-bit encode a list of sequences of the same length into 64-bit integers.
+    Any base that is not A, C, G or T is encoded as A.
+
+    :param sequences: list of sequences
+    :type sequences: list
+
+    :return: (codes, valid) tuple, where `valid` is `False` for any sequence
+             that contains a base that is not A, C, G or T
+    :rtype: tuple
+    """
+    matrix = to_matrix(sequences)[0]
+    invalid = ENCODING[matrix] == 255
+    return encode(np.where(invalid, ord('A'),
+                           matrix).astype(np.uint8))[0], ~invalid.any(axis=1)
+
+
+def decode(code, length):
+    """Decode a single 2-bit encoded sequence stored in an integer.
+
+    :param code: encoded sequence
+    :type code: int
+    :param length: length of the sequence
+    :type length: int
+
+    :return: sequence
+    :rtype: str
+    """
+    return ''.join(
+        'ACGT'[(code >> (2 * (length - 1 - i))) & 3] for i in range(length)
+    )
+
+
+class BUSWriter:
+    """Writer of barcode, UMI and sequence records to the binary format
+    described at the top of this module. Records are buffered and packed in
+    batches.
+
+    :param path: path to output file
+    :type path: str
+    :param barcode_length: length of all barcodes
+    :type barcode_length: int
+    :param umi_length: length of all UMIs
+    :type umi_length: int
+    :param text: free-form header text, defaults to empty string
+    :type text: str, optional
+    :param batch_size: number of records to pack at once, defaults to `10000`
+    :type batch_size: int, optional
+    """
+
+    def __init__(
+        self, path, barcode_length, umi_length, text='', batch_size=10000
+    ):
+        if barcode_length > 32 or umi_length > 32:
+            raise Exception('Barcodes and UMIs can be at most 32 bases long.')
+        self.path = path
+        self.barcode_length = barcode_length
+        self.umi_length = umi_length
+        self.batch_size = batch_size
+        self.batch = []
+        self.n_records = 0
+        self.file = open(path, 'wb')
+        text = text.encode()
+        self.file.write(
+            HEADER.pack(MAGIC, VERSION, barcode_length, umi_length, len(text))
+        )
+        self.file.write(text)
+
+    def write(self, barcode, umi, sequence):
+        """Write a single record.
+
+        :param barcode: barcode sequence
+        :type barcode: str
+        :param umi: UMI sequence
+        :type umi: str
+        :param sequence: read sequence
+        :type sequence: str
+        """
+        if len(barcode) != self.barcode_length or len(umi) != self.umi_length:
+            raise Exception(
+                f'Expected barcode of length {self.barcode_length} and UMI of '
+                f'length {self.umi_length}, got {barcode} and {umi}'
+            )
+        self.batch.append((barcode, umi, sequence))
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Pack and write all buffered records.
+        """
+        if not self.batch:
+            return
+        barcodes, umis, sequences = zip(*self.batch)
+        barcode_codes, barcode_valid = encode_fixed(barcodes)
+        umi_codes, umi_valid = encode_fixed(umis)
+        packed, masks, lengths = pack_sequences(sequences)
+        has_n = masks.any(axis=1)
+
+        chunks = []
+        for i in range(len(self.batch)):
+            flags = (FLAG_BARCODE_N if not barcode_valid[i] else
+                     0) | (FLAG_UMI_N if not umi_valid[i] else 0) | (
+                         FLAG_SEQUENCE_N if has_n[i] else 0
+                     )
+            length = int(lengths[i])
+            chunks.append(
+                RECORD.pack(
+                    int(barcode_codes[i]), int(umi_codes[i]), flags, length
+                )
+            )
+            chunks.append(packed[i, :-(-length // 4)].tobytes())
+            if has_n[i]:
+                chunks.append(masks[i, :-(-length // 8)].tobytes())
+        self.file.write(b''.join(chunks))
+        self.n_records += len(self.batch)
+        self.batch = []
+
+    def close(self):
+        """Write all buffered records and close the file.
+        """
+        try:
+            self.flush()
+        finally:
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def read_bus(path):
+    """Generator for the records of a file in the binary format described at
+    the top of this module.
+
+    :param path: path to file
+    :type path: str
+
+    :return: generator for (barcode, UMI, sequence, flags) tuples. Barcodes and
+             UMIs with `N`s are returned with `A`s instead, as indicated by
+             the flags.
+    :rtype: generator
+    """
+    with open(path, 'rb') as f:
+        magic, version, barcode_length, umi_length, text_length = HEADER.unpack(
+            f.read(HEADER.size)
+        )
+        if magic != MAGIC:
+            raise Exception(f'{path} is not a valid file')
+        f.read(text_length)
+        while True:
+            data = f.read(RECORD.size)
+            if not data:
+                break
+            barcode, umi, flags, length = RECORD.unpack(data)
+            packed = f.read(-(-length // 4))
+            mask = f.read(-(-length // 8)) if flags & FLAG_SEQUENCE_N else None
+            yield (
+                decode(barcode, barcode_length),
+                decode(umi, umi_length),
+                unpack_sequence(packed, length, mask),
+                flags,
+            )
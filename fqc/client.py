@@ -0,0 +1,93 @@
+import json
+import os
+import socket
+from urllib.parse import urlparse
+
+from .config import N_READS, SERVER_TIMEOUT, SKIP_READS, SOCKET_PATH
+
+# This module only imports the standard library and the configuration, so that
+# forwarding a request to a server is fast.
+
+
+def request(message, path=SOCKET_PATH, timeout=SERVER_TIMEOUT):
+    """Send a request to a server started with `fqc serve`, and wait for its
+    response.
+
+    :param message: request, which must be serializable to JSON
+    :type message: dict
+    :param path: path to the server's Unix socket, defaults to `SOCKET_PATH`
+    :type path: str, optional
+    :param timeout: seconds to wait for the server to accept the request or to
+                    respond, defaults to `600`
+    :type timeout: float, optional
+
+    :return: response
+    :rtype: dict
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(path)
+        sock.sendall((json.dumps(message) + '\n').encode())
+        sock.shutdown(socket.SHUT_WR)
+        with sock.makefile('r') as f:
+            line = f.readline()
+    if not line:
+        raise ConnectionError(f'Server at {path} closed the connection')
+    return json.loads(line)
+
+
+def is_running(path=SOCKET_PATH, timeout=1):
+    """Check whether a server is listening on a socket.
+
+    :param path: path to the server's Unix socket, defaults to `SOCKET_PATH`
+    :type path: str, optional
+    :param timeout: seconds to wait for the server, defaults to `1`
+    :type timeout: float, optional
+
+    :return: whether the server responded
+    :rtype: bool
+    """
+    try:
+        return request({'command': 'ping'}, path, timeout)['status'] == 'ok'
+    except (OSError, ValueError, KeyError):
+        return False
+
+
+def detect(
+    paths,
+    skip=SKIP_READS,
+    n=N_READS,
+    path=SOCKET_PATH,
+    timeout=SERVER_TIMEOUT,
+):
+    """Detect the technology of FASTQs or a single BAM with a server.
+
+    :param paths: paths to FASTQs, or to a single BAM
+    :type paths: list
+    :param skip: number of reads to skip at the beginning, defaults to `1000`
+    :type skip: int, optional
+    :param n: number of reads to consider, defaults to `100000`
+    :type n: int, optional
+    :param path: path to the server's Unix socket, defaults to `SOCKET_PATH`
+    :type path: str, optional
+    :param timeout: seconds to wait for the server to accept the request or to
+                    respond, defaults to `600`
+    :type timeout: float, optional
+
+    :return: list of (technology name, permutation) tuples of the detected
+             technologies
+    :rtype: list
+    """
+    # The server may have been started in a different working directory. Urls
+    # (see `remote.is_remote`) are sent as they are.
+    paths = [p if urlparse(p).scheme else os.path.abspath(p) for p in paths]
+    response = request({
+        'command': 'detect',
+        'paths': paths,
+        'skip': skip,
+        'n': n
+    }, path, timeout)
+    if response['status'] != 'ok':
+        raise Exception(f'Server at {path} failed: {response["error"]}')
+    return [(technology['technology'], tuple(technology['permutation']))
+            for technology in response['technologies']]
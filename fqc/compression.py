@@ -0,0 +1,214 @@
+import gzip
+import importlib
+import io
+import logging
+import shutil
+import subprocess
+import time
+from collections import OrderedDict, namedtuple
+
+from .bgzf import BGZFReader, is_bgzf_file
+from .config import DECOMPRESSION_BACKEND
+from .resources import get_resources
+
+logger = logging.getLogger(__name__)
+
+# A way to decompress gzip files. `available` is a function that returns
+# whether or not the backend can be used, and `open` is a function that takes
+# a path and returns a tuple of (binary file object, subprocess or None).
+Backend = namedtuple('Backend', ['name', 'available', 'open'])
+
+
+def _command_backend(name, *args):
+    """Helper function to create a backend that decompresses with an external
+    command, so that decompression runs on a separate core.
+    """
+
+    def _open(path):
+        process = subprocess.Popen([name, *args, path],
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE)
+        return process.stdout, process
+
+    return Backend(name, lambda: shutil.which(name) is not None, _open)
+
+
+def _module_backend(name, module, attribute):
+    """Helper function to create a backend that decompresses with an
+    accelerated, gzip-compatible python module.
+    """
+
+    def _available():
+        try:
+            importlib.import_module(module)
+            return True
+        except ImportError:
+            return False
+
+    def _open(path):
+        return getattr(importlib.import_module(module),
+                       attribute)(path, 'rb'), None
+
+    return Backend(name, _available, _open)
+
+
+# Registered backends, in order of preference.
+BACKENDS = OrderedDict((backend.name, backend) for backend in [
+    _command_backend('pigz', '-dc'),
+    _module_backend('isal', 'isal.igzip', 'open'),
+    _module_backend('zlib-ng', 'zlib_ng.gzip_ng', 'open'),
+    _command_backend('gzip', '-dc'),
+    Backend('python', lambda: True, lambda path: (gzip.open(path, 'rb'), None)),
+])
+
+_backend = None
+
+
+def register_backend(backend, first=False):
+    """Register a new decompression backend.
+
+    :param backend: the backend
+    :type backend: Backend
+    :param first: whether the backend should be preferred over all other
+                  backends, defaults to `False`
+    :type first: bool, optional
+    """
+    global _backend
+    BACKENDS[backend.name] = backend
+    if first:
+        BACKENDS.move_to_end(backend.name, last=False)
+    _backend = None
+
+
+def set_backend(name=DECOMPRESSION_BACKEND):
+    """Select the decompression backend to use.
+
+    :param name: name of a registered backend, or `auto` to select the first
+                 available backend, defaults to `auto`
+    :type name: str, optional
+
+    :return: the selected backend
+    :rtype: Backend
+    """
+    global _backend
+    if name == 'auto':
+        _backend = next(
+            backend for backend in BACKENDS.values() if backend.available()
+        )
+    elif name not in BACKENDS:
+        raise Exception(
+            f'Unknown decompression backend {name}. '
+            f'Available backends are: {", ".join(BACKENDS.keys())}'
+        )
+    elif not BACKENDS[name].available():
+        fallback = set_backend('auto')
+        logger.warning(
+            f'Decompression backend {name} is not available. '
+            f'Falling back to {fallback.name}.'
+        )
+        return fallback
+    else:
+        _backend = BACKENDS[name]
+    logger.debug(f'Using decompression backend: {_backend.name}')
+    return _backend
+
+
+def get_backend():
+    """Get the selected decompression backend, selecting one if none has been
+    selected yet.
+
+    :return: the selected backend
+    :rtype: Backend
+    """
+    return _backend or set_backend()
+
+
+class DecompressedReader(io.RawIOBase):
+    """Binary file-like object of decompressed data that keeps track of
+    decompression throughput, and cleans up any decompression subprocess when
+    closed.
+
+    :param fileobj: decompressed binary stream
+    :type fileobj: file object
+    :param path: path to the compressed file
+    :type path: str
+    :param backend: name of the backend
+    :type backend: str
+    :param process: decompression subprocess, defaults to `None`
+    :type process: subprocess.Popen, optional
+    """
+
+    def __init__(self, fileobj, path, backend, process=None):
+        super().__init__()
+        self.fileobj = fileobj
+        self.path = path
+        self.backend = backend
+        self.process = process
+        self.n_bytes = 0
+        self.eof = False
+        self.start = time.time()
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        data = self.fileobj.read(len(b))
+        b[:len(data)] = data
+        self.n_bytes += len(data)
+        self.eof = not data
+        return len(data)
+
+    def close(self):
+        if self.closed:
+            return
+        super().close()
+        self.fileobj.close()
+        if self.process is not None:
+            # The file may not have been read completely, in which case the
+            # process must be terminated. It may also have already been killed
+            # by SIGPIPE after its output was closed, which is not an error.
+            if not self.eof:
+                if self.process.poll() is None:
+                    self.process.terminate()
+                self.process.wait()
+            elif self.process.wait() != 0:
+                raise Exception(
+                    f'{self.backend} failed to decompress {self.path}: '
+                    f'{self.process.stderr.read().decode().strip()}'
+                )
+            self.process.stderr.close()
+
+        elapsed = time.time() - self.start
+        size = self.n_bytes / (1024**2)
+        logger.debug((
+            f'Decompressed {size:.1f} MB from {self.path} with {self.backend} '
+            f'in {elapsed:.2f}s ({size / max(elapsed, 1e-6):.1f} MB/s)'
+        ))
+
+
+def open_decompressed(path, mode='rt'):
+    """Open a local gzip file for reading with the selected decompression
+    backend, or, if the file is BGZF-compressed, by decompressing its blocks in
+    parallel.
+
+    :param path: path to gzip file
+    :type path: str
+    :param mode: either `rt` for text or `rb` for binary, defaults to `rt`
+    :type mode: str, optional
+
+    :return: file object
+    :rtype: file object
+    """
+    resources = get_resources()
+    if resources.threads > 1 and is_bgzf_file(path):
+        reader = BGZFReader(
+            path, threads=resources.threads, queue_depth=resources.queue_depth
+        )
+        f = io.BufferedReader(DecompressedReader(reader, path, 'bgzf'))
+    else:
+        backend = get_backend()
+        fileobj, process = backend.open(path)
+        f = io.BufferedReader(
+            DecompressedReader(fileobj, path, backend.name, process)
+        )
+    return io.TextIOWrapper(f) if 't' in mode else f
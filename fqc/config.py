@@ -1,7 +1,85 @@
 import os
+import tempfile
 
 PACKAGE_PATH = os.path.abspath(os.path.dirname(__file__))
 WHITELIST_DIR = os.path.join(PACKAGE_PATH, 'whitelists')
 
 SKIP_READS = 1000
 N_READS = 100000
+
+# The heads of remote (http/https) BAMs are fetched concurrently, with at most
+# REMOTE_CONCURRENCY open connections. Remote FASTQs are all streamed at once,
+# since they are read in lockstep. REMOTE_TIMEOUT is the number of seconds to
+# wait for a connection or for any single read before giving up.
+REMOTE_CONCURRENCY = 8
+REMOTE_TIMEOUT = 60
+# Number of bytes fetched from the start of a remote BAM to detect its
+# technology from the header and first few records.
+BAM_HEAD_BYTES = 1 << 20
+
+# Number of reads per batch when detecting incrementally.
+BATCH_SIZE = 10000
+# When detecting from a stream, stop reading once the detected technology
+# reaches this confidence.
+STOP_CONFIDENCE = 0.999
+
+# Backend used to decompress gzip files. `auto` picks the first available of
+# pigz, isal, zlib-ng, gzip and python's gzip module. BGZF-compressed (bgzip)
+# files are instead decompressed block by block in parallel threads, regardless
+# of the backend.
+DECOMPRESSION_BACKEND = os.environ.get('FQC_DECOMPRESSION', 'auto')
+
+# Default number of threads, and maximum memory in bytes (`None` for no limit),
+# that `resources.plan_resources` fits worker pools, batch sizes, queue depths
+# and whitelists into.
+THREADS = os.cpu_count() or 1
+MAX_MEMORY = None
+# Rough memory usage, in bytes, of a worker process before any whitelists or
+# reads are loaded, of each spot of a batch of reads, and of each group of
+# BGZF blocks queued for decompression.
+PROCESS_MEMORY = 1 << 28
+SPOT_MEMORY = 1 << 11
+BGZF_TASK_MEMORY = 1 << 23
+# Smallest batch size that the number of reads per batch is reduced to.
+MIN_BATCH_SIZE = 1000
+# Whitelists that do not fit in memory are memory-mapped from a copy of their
+# encoded barcodes in this directory.
+WHITELIST_CACHE_DIR = os.environ.get(
+    'FQC_CACHE', os.path.join(tempfile.gettempdir(), 'fqc')
+)
+
+# Whole FASTQs are profiled this many (uncompressed) bytes at a time.
+PROFILE_CHUNK_SIZE = 1 << 22
+
+# Splitting a BAM per cell barcode writes to many gzipped FASTQs at once. At
+# most MAX_OPEN_FILES are kept open, and at most MAX_BUFFERED_BYTES of
+# uncompressed text is buffered in memory across all of them.
+MAX_OPEN_FILES = 256
+MAX_BUFFERED_BYTES = 1 << 28
+GZIP_LEVEL = 6
+
+# When splitting a BAM into FASTQs, a checkpoint to resume from is recorded
+# every CHECKPOINT_INTERVAL BAM entries.
+CHECKPOINT_INTERVAL = 1000000
+
+# Samples in a shared work queue are leased by a worker while it processes
+# them. A lease that has not been renewed for LEASE_TIMEOUT seconds is
+# considered stale and the sample is retried, at most MAX_ATTEMPTS times in
+# total. Idle workers check for work every POLL_INTERVAL seconds.
+LEASE_TIMEOUT = 600
+MAX_ATTEMPTS = 3
+POLL_INTERVAL = 10
+
+# Unix socket that `fqc serve` listens on, and that the command line forwards
+# detection requests to when a server is running. The default is per user, so
+# that users do not send requests to each other's servers.
+SOCKET_PATH = os.environ.get(
+    'FQC_SOCKET',
+    os.path.join(
+        tempfile.gettempdir(),
+        f'fqc-{os.getuid()}.sock' if hasattr(os, 'getuid') else 'fqc.sock'
+    )
+)
+# Number of seconds to wait for the server to accept a request or to respond,
+# after which the command line detects locally instead.
+SERVER_TIMEOUT = 600
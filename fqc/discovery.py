@@ -0,0 +1,138 @@
+import logging
+import os
+from collections import namedtuple
+from functools import lru_cache
+
+import numpy as np
+import scipy.stats as stats
+
+from .plan import ENCODING, load_whitelist, lookup, MAX_ENCODED_LENGTH, to_matrix
+from .technologies import TECHNOLOGIES
+from .utils import open_as_text
+
+logger = logging.getLogger(__name__)
+
+# A window of reads that contains barcodes of a whitelist at a significant
+# rate. `file` is the index of the physical FASTQ file.
+Discovery = namedtuple(
+    'Discovery',
+    ['file', 'start', 'stop', 'whitelist_path', 'rate', 'technologies']
+)
+
+
+@lru_cache(maxsize=None)
+def whitelist_length(path):
+    """Get the length of the barcodes in a whitelist, from its first barcode.
+
+    :param path: path to whitelist
+    :type path: str
+
+    :return: length of barcodes
+    :rtype: int
+    """
+    with open_as_text(path, 'r') as f:
+        return len(f.readline().strip())
+
+
+def window_codes(values, k):
+    """2-bit encode every window of length `k` of each row of a 2D array of
+    2-bit values with a rolling hash, so that each column is only shifted in
+    once.
+
+    :param values: 2D array of 2-bit values, with 255 for bases that can not
+                   be encoded
+    :type values: numpy.ndarray
+    :param k: length of windows, at most 32
+    :type k: int
+
+    :return: (codes, valid) tuple of 2D arrays, with one column per window
+             start, where `valid` is `False` for windows that contain a base
+             that can not be encoded
+    :rtype: tuple
+    """
+    n, length = values.shape
+    n_windows = max(length - k + 1, 0)
+    codes = np.zeros((n, n_windows), dtype=np.uint64)
+    invalid = values == 255
+    shifted = np.where(invalid, 0, values).astype(np.uint64)
+    mask = np.uint64((1 << (2 * k)) - 1)
+    code = np.zeros(n, dtype=np.uint64)
+    for j in range(length):
+        code = ((code << np.uint64(2)) | shifted[:, j]) & mask
+        if j >= k - 1:
+            codes[:, j - k + 1] = code
+
+    # Number of invalid bases in each window, from cumulative sums.
+    cumulative = np.zeros((n, length + 1), dtype=np.int64)
+    np.cumsum(invalid, axis=1, out=cumulative[:, 1:])
+    valid = (cumulative[:, k:] - cumulative[:, :n_windows]) == 0
+    return codes, valid
+
+
+def discover(
+    reads,
+    whitelist_paths=None,
+    min_rate=0.1,
+    alpha=1e-6,
+):
+    """Scan every window of every read against every whitelist, to find where
+    barcodes are when none of the known barcode positions match, i.e. for
+    libraries with shifted reads or unknown chemistries. All windows of a file
+    are looked up in a whitelist at once.
+
+    A window is reported if its rate of whitelisted barcodes is at least
+    `min_rate` and significantly higher than the rate of random sequences
+    that are in the whitelist by chance.
+
+    :param reads: list of lists of synchronized reads, one list per FASTQ
+    :type reads: list
+    :param whitelist_paths: paths to whitelists, defaults to `None`, which uses
+                            the whitelists of all technologies
+    :type whitelist_paths: list, optional
+    :param min_rate: minimum rate of whitelisted barcodes, defaults to `0.1`
+    :type min_rate: float, optional
+    :param alpha: significance level, defaults to `1e-6`
+    :type alpha: float, optional
+
+    :return: list of Discovery objects, sorted by decreasing rate
+    :rtype: list
+    """
+    if whitelist_paths is None:
+        whitelist_paths = sorted({
+            t.whitelist_path
+            for t in TECHNOLOGIES
+            if t.whitelist_path and os.path.exists(t.whitelist_path)
+        })
+    n = min(len(rs) for rs in reads) if reads else 0
+    if n == 0:
+        return []
+    values = [ENCODING[to_matrix(rs[:n])[0]] for rs in reads]
+
+    discoveries = []
+    for path in whitelist_paths:
+        whitelist = load_whitelist(path)
+        k = whitelist_length(path)
+        if k == 0 or k > MAX_ENCODED_LENGTH:
+            logger.warning(f'Whitelist {path} can not be scanned. Skipping.')
+            continue
+        # Rate at which a random sequence is in the whitelist.
+        background = len(whitelist) / 4**k
+        technologies = [
+            t.name for t in TECHNOLOGIES if t.whitelist_path == path
+        ]
+        for file, vs in enumerate(values):
+            codes, valid = window_codes(vs, k)
+            if codes.size == 0:
+                continue
+            hits = lookup(codes.ravel(), whitelist).reshape(codes.shape) & valid
+            counts = hits.sum(axis=0)
+            p_values = stats.binom.sf(counts - 1, n, background)
+            for start in np.flatnonzero((counts >= min_rate * n)
+                                        & (p_values < alpha)):
+                discoveries.append(
+                    Discovery(
+                        file, int(start),
+                        int(start) + k, path, counts[start] / n, technologies
+                    )
+                )
+    return sorted(discoveries, key=lambda d: d.rate, reverse=True)
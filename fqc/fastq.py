@@ -1,7 +1,101 @@
 import gzip
+from itertools import islice
 from urllib.parse import urlparse
 from urllib.request import urlopen
 
+from .compression import open_decompressed
+
+
+def slice_reads(lines, index):
+    """Extract a slice of read sequences from the lines of a FASTQ file.
+
+    :param lines: iterable of lines of a FASTQ file
+    :type lines: iterable
+    :param index: slice of reads to extract
+    :type index: slice
+
+    :return: list of read sequences
+    :rtype: list
+    """
+    if not isinstance(index, slice):
+        raise NotImplementedError('Indexing is not supported. Use slice.')
+    if index.stop is None or (index.start or 0) < 0 or index.stop < 0 or (
+            index.step is not None and index.step < 0):
+        raise NotImplementedError(
+            'Slices must only contain non-negative integers.'
+        )
+    indices = set(range(index.start or 0, index.stop, index.step or 1))
+
+    reads = []
+    for l, line in enumerate(lines):  # noqa
+        i = (l - 1) / 4
+        if i > index.stop - 1:
+            break
+
+        if i in indices:
+            reads.append(line.strip())
+    return reads
+
+
+def sequences(lines):
+    """Generator for the read sequences in the lines of a FASTQ file.
+
+    :param lines: iterable of lines of a FASTQ file
+    :type lines: iterable
+
+    :return: generator for read sequences
+    :rtype: generator
+    """
+    for l, line in enumerate(lines):  # noqa
+        if l % 4 == 1:
+            yield line.strip()
+
+
+def next_batch(iterators, size):
+    """Read the next batch of synchronized reads from a list of read iterators.
+    If the iterators are exhausted at different points, the batch is truncated
+    to the shortest.
+
+    :param iterators: list of iterators of reads, one for each FASTQ
+    :type iterators: list
+    :param size: maximum number of reads to read from each iterator
+    :type size: int
+
+    :return: list of lists of reads
+    :rtype: list
+    """
+    batch = [list(islice(iterator, size)) for iterator in iterators]
+    n = min(len(reads) for reads in batch) if batch else 0
+    return [reads[:n] for reads in batch]
+
+
+def interleaved_batches(lines, n_files, batch_size):
+    """Generator for batches of synchronized reads from the lines of an
+    interleaved FASTQ, in which each spot is `n_files` consecutive records.
+
+    :param lines: iterable of lines of an interleaved FASTQ file
+    :type lines: iterable
+    :param n_files: number of records per spot
+    :type n_files: int
+    :param batch_size: number of spots per batch
+    :type batch_size: int
+
+    :return: generator for lists of `n_files` lists of reads
+    :rtype: generator
+    """
+    batch = [[] for _ in range(n_files)]
+    for l, line in enumerate(lines):  # noqa
+        if l % 4 != 1:
+            continue
+        i = l // 4
+        batch[i % n_files].append(line.strip())
+        if i % n_files == n_files - 1 and len(batch[-1]) == batch_size:
+            yield batch
+            batch = [[] for _ in range(n_files)]
+    if batch[-1]:
+        # Drop any incomplete spot at the end.
+        yield [reads[:len(batch[-1])] for reads in batch]
+
 
 class Fastq:
     """Class that represents a single FASTQ file.
@@ -14,30 +108,16 @@ class Fastq:
         self.path = path
 
     def open(self, mode='r'):
+        parse = urlparse(self.path)
+        if mode == 'r' and self.path.endswith('.gz') and not parse.scheme:
+            return open_decompressed(self.path, 'rt')
+
         open_func = gzip.open if self.path.endswith('.gz') else open
         mode = f'{mode}t' if self.path.endswith('.gz') else mode
-        parse = urlparse(self.path)
         return open_func(
             urlopen(self.path) if parse.scheme else self.path, mode
         )
 
     def __getitem__(self, index):
-        if not isinstance(index, slice):
-            raise NotImplementedError('Indexing is not supported. Use slice.')
-        if index.stop is None or index.start < 0 or index.stop < 0 or (
-                index.step is not None and index.step < 0):
-            raise NotImplementedError(
-                'Slices must only contain non-negative integers.'
-            )
-        indices = set(range(index.start or 0, index.stop, index.step or 1))
-
-        reads = []
         with self.open('r') as f:
-            for l, line in enumerate(f):  # noqa
-                i = (l - 1) / 4
-                if i > index.stop - 1:
-                    break
-
-                if i in indices:
-                    reads.append(line.strip())
-        return reads
+            return slice_reads(f, index)
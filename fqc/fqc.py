@@ -1,14 +1,26 @@
+import gzip
+import hashlib
+import io
 import logging
+import os
 from collections import OrderedDict
-from itertools import permutations
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+from itertools import islice, permutations
 
 import numpy as np
 import scipy.stats as stats
 
-from .bam import BAM
-from .fastq import Fastq
+from .bam import BAM, read_checksums, write_checksums
+from .bgzf import is_bgzf_file, sample_fastqs
+from .config import BATCH_SIZE, MAX_OPEN_FILES, STOP_CONFIDENCE
+from .discovery import discover
+from .fastq import Fastq, interleaved_batches, next_batch, sequences
+from .plan import compile_plan
+from .remote import fetch_heads, is_remote, RemoteFiles
+from .resources import get_resources
 from .technologies import OrderedTechnology, TECHNOLOGIES
-from .utils import open_as_text
+from .utils import read_barcodes, read_groups
 
 logger = logging.getLogger(__name__)
 
@@ -34,224 +46,111 @@ def all_ordered_technologies(technologies=None, n=1):
     return ordered
 
 
-def extract_barcodes_umis(reads, technologies=None):
-    """Extract all sequences in barcode and UMI positions for each given
-    technology for all possible orderings of the FASTQs.
-
-    This function returns a 3-tuple of `barcodes`, `umis`, `invalids`.
-    `barcodes`: Has technology names as outer keys, and FASTQ orderings as inner
-                keys. For example, `barcodes['10xv2'][(1, 0)]` contains all
-                barcode sequences extracted according to the 10xv2 technology,
-                where read 0 comes from FASTQ 1 and read 1 comes from FASTQ 0.
-                The list of barcodes is actually a list of list of barcodes,
-                since there can be multiple barcode sections for a given technology.
-    `umis`: Same structure as `barcodes`, but instead contains UMI sequences.
-    `invalids`: A dictionary with technology names as keys and a set
-                of FASTQ orderings as values. Any FASTQ ordering in the `invalids`
-                dictionary, along with the specific technology, is invalid.
-
-    :param reads: an ordered dictionary with the path to fastqs as keys and
-                  a list of reads as values
-    :type reads: OrderedDict
-    :param technologies: list of OrderedTechnology objects to consider, defaults to `None`
-    :type technologies: list, optional
-
-    :return: 3-tuple (`barcodes`, `umis`, `invalids`) of dictionaries
-    :rtype: list
-    """
-    logger.debug('Extracting barcode and UMI sequences')
-    technologies = technologies or all_ordered_technologies(
-        TECHNOLOGIES, len(reads)
-    )
-
-    # Dictionaries that contain list of barcodes/umis for each possible
-    # permutation.
-    barcodes = {}
-    umis = {}
-    invalids = {}
-    for i, reads in enumerate(zip(*list(reads.values()))):
-        for ordered in technologies:
-            technology = ordered.technology
-            permutation = ordered.permutation
-
-            t_barcodes = barcodes.setdefault(technology.name, {})
-            t_umis = umis.setdefault(technology.name, {})
-            t_invalid = invalids.setdefault(technology.name, set())
-
-            # If the permutation is [1, 0, 2], then read 0 is from fastq 1,
-            # read 1 is from fastq 0, and read 2 is from fastq 2
-            if permutation not in t_invalid:
-                p_barcodes = t_barcodes.setdefault(permutation, [])
-                p_umis = t_umis.setdefault(permutation, [])
-
-                bc_list = []
-                for substring in technology.barcode_positions:
-                    read = reads[permutation[substring.file]]
-
-                    if len(read) <= substring.start or len(read
-                                                           ) < substring.stop:
-                        logger.debug((
-                            f'Technology {ordered} is '
-                            'invalid due to barcode sequence length.'
-                        ))
-                        t_invalid.add(permutation)
-                        break
-
-                    bc_list.append(read[substring.start:substring.stop])
-                p_barcodes.append(bc_list)
-
-                umi_list = []
-                for substring in technology.umi_positions:
-                    read = reads[permutation[substring.file]]
-
-                    if len(read) <= substring.start or len(read
-                                                           ) < substring.stop:
-                        logger.debug((
-                            f'Technology {ordered} is '
-                            'invalid due to UMI sequence length.'
-                        ))
-                        t_invalid.add(permutation)
-                        break
-
-                    umi_list.append(read[substring.start:substring.stop])
-                p_umis.append(umi_list)
-
-                if permutation in t_invalid:
-                    del barcodes[technology.name][permutation]
-                    del umis[technology.name][permutation]
-
-    return barcodes, umis, invalids
-
-
-def filter_files(reads, technologies=None):
-    """Filter for possible technologies using the number of files (`n_files`).
-
-    :param reads: an ordered dictionary with the path to fastqs as keys and
-                  a list of reads as values
-    :type reads: OrderedDict
-    :param technologies: list of possible OrderedTechnology objects, defaults to `None`
-    :type technologies: list, optional
-
-    :return: list of OrderedTechnology objects. All technologies in the returned
-             list are possible technologies the FASTQs were derived from.
-    :rtype: list
-    """
-    technologies = technologies or all_ordered_technologies(
-        TECHNOLOGIES, len(reads)
-    )
-
-    # Filter
-    possible = []
-    for ordered in technologies:
-        technology = ordered.technology
-        if len(reads) == technology.n_files:
-            possible.append(ordered)
+class Detector:
+    """Incrementally detect single-cell technology and file ordering from
+    batches of synchronized reads. The counts of matching barcodes are kept
+    as running totals, so that the current ranking of candidate technologies
+    is available at any time.
 
-    return possible
-
-
-def filter_barcodes_umis(reads, technologies=None):
-    """Filter for possible technologies using barcodes and UMI positions.
-
-    :param reads: an ordered dictionary with the path to fastqs as keys and
-                  a list of reads as values
-    :type reads: OrderedDict
+    :param n_files: number of reads per spot (i.e. number of FASTQs)
+    :type n_files: int
     :param technologies: list of possible OrderedTechnology objects, defaults to `None`
     :type technologies: list, optional
-
-    :return: list of OrderedTechnology objects. All technologies in the returned
-             list are possible technologies the FASTQs were derived from.
-    :rtype: list
+    :param threshold: minimum fraction of matching barcodes for a technology to
+                      be detected, defaults to `0.5`
+    :type threshold: float, optional
     """
-    technologies = technologies or all_ordered_technologies(
-        TECHNOLOGIES, len(reads)
-    )
-    barcodes, umis, invalids = extract_barcodes_umis(reads, technologies)
-    possible = []
-
-    # Filter with barcodes.
-    # For all technologies with available whitelist, count the number of
-    # sequences that match the barcodes.
-    barcode_technologies = [
-        technology for technology in TECHNOLOGIES
-        if technology.whitelist_path and technology.name in
-        [ordered.technology.name for ordered in technologies]
-    ]
 
-    logger.debug(
-        f'Checking technologies with whitelists: {", ".join(str(technology) for technology in barcode_technologies)}'
-    )
-    max_ordered = None
-    max_count = 0
-    for technology in barcode_technologies:
-        with open_as_text(technology.whitelist_path, 'r') as f:
-            whitelist = set(f.read().splitlines())
-
-        for p in barcodes[technology.name]:
-            ordered = OrderedTechnology(technology, p)
-            n = len(barcodes[technology.name][p])
-            count = 0
-            for bc_list in barcodes[technology.name][p]:
-                if ''.join(bc_list) in whitelist:
-                    count += 1
-
-            logger.debug(
-                f'Technology {ordered} has {count}/{n} matching barcodes.'
+    def __init__(self, n_files, technologies=None, threshold=0.5):
+        self.n_files = n_files
+        self.threshold = threshold
+        technologies = technologies or all_ordered_technologies(
+            TECHNOLOGIES, n_files
+        )
+        # Only technologies with whitelists can be detected.
+        self.technologies = [
+            ordered for ordered in technologies
+            if ordered.technology.n_files == n_files and (
+                ordered.technology.whitelist_path
+                or ordered.technology.segment_whitelist_paths
             )
-            if count / n > 0.5 and count > max_count:
-                max_ordered = ordered
-                max_count = count
-    if max_ordered is not None:
-        possible.append(max_ordered)
+        ]
         logger.debug(
-            f'Technology {max_ordered} passed whitelist filter with {max_count}/{n} matching barcodes'
+            f'Checking technologies with whitelists: {", ".join(str(ordered) for ordered in self.technologies)}'
+        )
+        self.plan = compile_plan(self.technologies)
+        self.counts = np.zeros(len(self.technologies), dtype=np.int64)
+        self.invalid = np.zeros(len(self.technologies), dtype=bool)
+        self.n = 0
+
+    def update(self, reads):
+        """Update the running counts with a batch of synchronized reads.
+
+        :param reads: list of lists of reads, one list per file, with the `i`th
+                      read of each list coming from the same spot
+        :type reads: list
+        """
+        if len(reads) != self.n_files:
+            raise Exception(
+                f'Expected reads from {self.n_files} files, got {len(reads)}'
+            )
+        counts, n, invalid = self.plan.count(reads)
+        self.counts += counts
+        self.invalid |= invalid
+        self.n += n
+
+    @property
+    def ranking(self):
+        """List of (OrderedTechnology, number of matching barcodes) tuples of
+        all valid candidate technologies, sorted from best to worst.
+        """
+        ranking = [(ordered, int(count))
+                   for ordered, count, invalid in
+                   zip(self.technologies, self.counts, self.invalid)
+                   if not invalid]
+        return sorted(ranking, key=lambda item: item[1], reverse=True)
+
+    @property
+    def best(self):
+        """The best candidate OrderedTechnology if more than `threshold` of its
+        barcodes match, `None` otherwise.
+        """
+        ranking = self.ranking
+        if ranking and self.n > 0 and ranking[0][
+                1] > 0 and ranking[0][1] / self.n > self.threshold:
+            return ranking[0][0]
+        return None
+
+    @property
+    def confidence(self):
+        """Probability that the match rate of the best candidate is greater than
+        both the threshold and the observed match rate of the runner-up, using
+        a uniform prior on the match rate. `0` if there is no best candidate.
+        """
+        if self.best is None:
+            return 0.
+        ranking = self.ranking
+        count = ranking[0][1]
+        second = ranking[1][1] / self.n if len(ranking) > 1 else 0.
+        return float(
+            stats.beta.sf(
+                max(self.threshold, second), count + 1, self.n - count + 1
+            )
         )
-    return possible
-
-    # # Check technologies without whitelist
-    # other_technologies = [
-    #     technology for technology in TECHNOLOGIES
-    #     if not technology.whitelist_path and technology.name in
-    #     [ordered.technology.name for ordered in technologies]
-    # ]
-    # logger.debug(
-    #     f'Checking technologies without whitelists: {", ".join(str(ordered) for ordered in other_technologies)}'
-    # )
-    #
-    # def passes_stats_threshold(mean, std, kurtosis, skew):
-    #     """Helper function to check if the barcode statistics passes a
-    #     certain threshold.
-    #
-    #     TODO: is there a way to make these numbers not arbitrary/manually selected?
-    #     """
-    #     if mean > 2 and std > 10 and kurtosis < 2000 and skew < 50:
-    #         return True
-    #     return False
-    #
-    # max_ordered = None
-    # max_mean = 0
-    # for technology in other_technologies:
-    #     for p in barcodes[technology.name]:
-    #         bcs = [''.join(bc_list) for bc_list in barcodes[technology.name][p]]
-    #         counts = list(Counter(bcs).values())
-    #         mean = np.mean(counts)
-    #         std = np.std(counts)
-    #         kurtosis = stats.kurtosis(counts)
-    #         skew = stats.skew(counts)
-    #         logger.debug((
-    #             f'Barcodes for technology {technology} has {len(set(bcs))}/{n} unique barcodes, '
-    #             f'mean={mean:.2f}, std={std:.2f}, kurtosis={kurtosis:.2f}, skew={skew:.2f}'
-    #         ))
-    #         if mean > max_mean and passes_stats_threshold(mean, std, kurtosis,
-    #                                                       skew):
-    #             max_ordered = OrderedTechnology(technology, p)
-    #             max_mean = mean
-    # if max_ordered is not None:
-    #     possible.append(max_ordered)
-    #     logger.debug(f'Technology {max_ordered} passed barcode filter')
-    #     return possible
-    #
-    # return possible
+
+    def log(self):
+        """Log the current number of matching barcodes of each candidate.
+        """
+        for ordered, invalid in zip(self.technologies, self.invalid):
+            if invalid:
+                logger.debug((
+                    f'Technology {ordered} is '
+                    'invalid due to barcode or UMI sequence length.'
+                ))
+        for ordered, count in self.ranking:
+            logger.debug(
+                f'Technology {ordered} has {count}/{self.n} matching barcodes.'
+            )
 
 
 def is_single_cell(reads):
@@ -299,16 +198,475 @@ def is_single_cell(reads):
     return False
 
 
-def fqc_bam(path, split=False, prefix='', threads=4):
-    bam = BAM(path)
-    if split:
-        return bam.to_fastq(prefix=prefix, threads=threads)
-    return bam.technology
+def load_bam(path, head=None):
+    """Open a BAM and detect its technology. For remote BAMs, only the
+    beginning of the file is downloaded to detect the technology.
+
+    :param path: path to BAM, may be remote
+    :type path: str
+    :param head: path to an already downloaded beginning of the BAM, which is
+                 not removed, defaults to `None`
+    :type head: str, optional
+
+    :return: BAM object
+    :rtype: BAM
+    """
+    if head is not None or not is_remote(path):
+        return BAM(path, head=head)
+    head = fetch_heads([path])[0]
+    try:
+        return BAM(path, head=head)
+    finally:
+        os.remove(head)
+
+
+def bam_whitelist(technology, whitelist_path=None, technology_whitelist=False):
+    """Get the set of barcodes to write when splitting a BAM.
+
+    :param technology: detected technology of the BAM
+    :type technology: Technology
+    :param whitelist_path: path to list of barcodes, defaults to `None`
+    :type whitelist_path: str, optional
+    :param technology_whitelist: whether to only write barcodes in the
+                                 technology's whitelist, defaults to `False`
+    :type technology_whitelist: bool, optional
+
+    :return: set of barcodes, or `None` if all barcodes should be written
+    :rtype: set
+    """
+    whitelist = read_barcodes(whitelist_path) if whitelist_path else None
+    if technology_whitelist:
+        if not technology.whitelist_path:
+            raise Exception(
+                f'Technology {technology} does not have a whitelist.'
+            )
+        if not os.path.exists(technology.whitelist_path):
+            raise Exception((
+                f'Whitelist {technology.whitelist_path} for technology '
+                f'{technology} does not exist.'
+            ))
+        technology_barcodes = read_barcodes(technology.whitelist_path)
+        whitelist = technology_barcodes if whitelist is None else whitelist & technology_barcodes
+    return whitelist
+
+
+def fqc_bam(
+    path,
+    split=False,
+    prefix='',
+    threads=4,
+    split_cells=False,
+    whitelist_path=None,
+    technology_whitelist=False,
+    min_count=0,
+    groups_path=None,
+    max_open=MAX_OPEN_FILES,
+    fraction=1.,
+    max_records=None,
+    seed=0,
+    bus_path=None,
+    resume=False,
+    chunk_records=None,
+    chunk_bytes=None,
+):
+    """Detect the single-cell technology of a BAM, and optionally split it
+    into FASTQs or convert it into a binary file of barcode, UMI and sequence
+    records.
+
+    :param path: path to BAM, may be remote
+    :type path: str
+    :param split: whether to split the BAM into FASTQs, defaults to `False`
+    :type split: bool, optional
+    :param prefix: prefix to output FASTQ files, defaults to empty string
+    :type prefix: str, optional
+    :param threads: number of threads to use to read the BAM file, defaults to `4`
+    :type threads: int, optional
+    :param split_cells: whether to split the BAM into FASTQs per cell barcode,
+                        defaults to `False`
+    :type split_cells: bool, optional
+    :param whitelist_path: path to list of barcodes to write when splitting,
+                           defaults to `None`
+    :type whitelist_path: str, optional
+    :param technology_whitelist: whether to only write barcodes in the detected
+                                 technology's whitelist when splitting,
+                                 defaults to `False`
+    :type technology_whitelist: bool, optional
+    :param min_count: minimum number of entries of a barcode to write it when
+                      splitting per cell, defaults to `0`
+    :type min_count: int, optional
+    :param groups_path: path to tab-separated file of barcodes and group names,
+                        to split per group instead of per cell, defaults to `None`
+    :type groups_path: str, optional
+    :param max_open: maximum number of open files when splitting per cell,
+                     defaults to `256`
+    :type max_open: int, optional
+    :param fraction: fraction of entries to write when splitting, defaults to `1.`
+    :type fraction: float, optional
+    :param max_records: maximum number of entries to write when splitting,
+                        defaults to `None`
+    :type max_records: int, optional
+    :param seed: seed for subsampling, defaults to `0`
+    :type seed: int, optional
+    :param bus_path: path to write barcode, UMI and sequence records to instead
+                     of splitting into FASTQs, defaults to `None`
+    :type bus_path: str, optional
+    :param resume: whether to resume splitting into FASTQs from the last
+                   checkpoint, defaults to `False`
+    :type resume: bool, optional
+    :param chunk_records: maximum number of entries per chunk of FASTQs,
+                          defaults to `None`
+    :type chunk_records: int, optional
+    :param chunk_bytes: maximum number of uncompressed bytes per chunk of
+                        FASTQs, defaults to `None`
+    :type chunk_bytes: int, optional
+
+    :return: the detected Technology if not splitting, otherwise a tuple of the
+             generated FASTQs (or the binary file) and a list of
+             OrderedTechnology objects
+    :rtype: Technology or tuple
+    """
+    bam = load_bam(path)
+    if not split and not split_cells and not bus_path:
+        return bam.technology
+
+    whitelist = bam_whitelist(
+        bam.technology, whitelist_path, technology_whitelist
+    )
+    kwargs = {
+        'prefix': prefix,
+        'threads': threads,
+        'whitelist': whitelist,
+        'fraction': fraction,
+        'max_records': max_records,
+        'seed': seed,
+    }
+    if bus_path:
+        del kwargs['prefix']
+        bam.to_bus(bus_path, **kwargs)
+        return bus_path, [
+            OrderedTechnology(
+                bam.technology, tuple(range(bam.technology.n_files))
+            )
+        ]
+    if split_cells:
+        return bam.split_cells(
+            min_count=min_count,
+            groups=read_groups(groups_path) if groups_path else None,
+            max_open=max_open,
+            **kwargs
+        )
+    return bam.to_fastq(
+        resume=resume,
+        chunk_records=chunk_records,
+        chunk_bytes=chunk_bytes,
+        **kwargs
+    )
+
+
+def _split_bam(path, prefix, technology, kwargs):
+    """Helper function to split a single BAM, whose technology has already been
+    detected, into FASTQs in a worker process.
+    """
+    return BAM(path, technology=technology).to_fastq(prefix=prefix, **kwargs)[0]
+
+
+def fqc_bams(
+    paths,
+    split=False,
+    prefix='',
+    threads=4,
+    whitelist_path=None,
+    technology_whitelist=False,
+    fraction=1.,
+    max_records=None,
+    seed=0,
+    merge=True,
+    processes=None,
+):
+    """Detect the single-cell technology of multiple BAMs of the same sample
+    (i.e. multiple lanes or libraries), which must all be the same, and
+    optionally split them into FASTQs.
+
+    The BAMs are split concurrently, each in its own process, into a shard of
+    FASTQs per BAM. Since every FASTQ is a series of gzip members, the shards
+    are then merged by appending them to the first shard, without
+    decompressing. The checksums of the merged FASTQs are computed while
+    appending.
+
+    :param paths: paths to BAMs, may be remote
+    :type paths: list
+    :param split: whether to split the BAMs into FASTQs, defaults to `False`
+    :type split: bool, optional
+    :param prefix: prefix to output FASTQ files, defaults to empty string
+    :type prefix: str, optional
+    :param threads: total number of threads to use, defaults to `4`
+    :type threads: int, optional
+    :param whitelist_path: path to list of barcodes to write when splitting,
+                           defaults to `None`
+    :type whitelist_path: str, optional
+    :param technology_whitelist: whether to only write barcodes in the detected
+                                 technology's whitelist when splitting,
+                                 defaults to `False`
+    :type technology_whitelist: bool, optional
+    :param fraction: fraction of entries to write when splitting, defaults to `1.`
+    :type fraction: float, optional
+    :param max_records: maximum number of entries to write from each BAM when
+                        splitting, defaults to `None`
+    :type max_records: int, optional
+    :param seed: seed for subsampling, defaults to `0`
+    :type seed: int, optional
+    :param merge: whether to merge the shards of all BAMs into a single set of
+                  FASTQs, defaults to `True`. If `False`, the shards, named
+                  `{prefix}_shard{j}_{i}.fastq.gz`, are kept instead.
+    :type merge: bool, optional
+    :param processes: number of BAMs to split at once, defaults to `None`,
+                      which splits up to `threads` BAMs at once
+    :type processes: int, optional
+
+    :return: the detected Technology if not splitting, otherwise a tuple of the
+             generated FASTQs (a list of shards if not merging) and a list of
+             OrderedTechnology objects
+    :rtype: Technology or tuple
+    """
+    # The beginnings of all remote BAMs are downloaded concurrently.
+    remote = list(
+        OrderedDict.fromkeys(path for path in paths if is_remote(path))
+    )
+    heads = dict(zip(remote, fetch_heads(remote)))
+    try:
+        technologies = OrderedDict(
+            (path, load_bam(path, heads.get(path)).technology) for path in paths
+        )
+    finally:
+        for head in heads.values():
+            os.remove(head)
+    technology = technologies[paths[0]]
+    if any(t != technology for t in technologies.values()):
+        raise Exception((
+            'BAMs have different technologies: '
+            f'{", ".join(f"{path} ({t})" for path, t in technologies.items())}'
+        ))
+    logger.info(f'All {len(paths)} BAMs have technology {technology}')
+    if not split:
+        return technology
+
+    whitelist = bam_whitelist(technology, whitelist_path, technology_whitelist)
+    processes = min(len(paths), processes or threads)
+    kwargs = {
+        'threads': max(threads // processes, 1),
+        'whitelist': whitelist,
+        'fraction': fraction,
+        'max_records': max_records,
+        'seed': seed,
+    }
+    base = f'{prefix}_shard' if prefix else 'shard'
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = [
+            executor.submit(
+                _split_bam, path, f'{base}{j+1}', technology, kwargs
+            ) for j, path in enumerate(paths)
+        ]
+        shards = [future.result() for future in futures]
+    ordered = [OrderedTechnology(technology, tuple(range(technology.n_files)))]
+    if not merge:
+        return shards, ordered
+
+    fastqs = [
+        f'{prefix}_{i+1}.fastq.gz' if prefix else f'{i+1}.fastq.gz'
+        for i in range(technology.n_files)
+    ]
+    logger.info(f'Merging {len(shards)} shards into {", ".join(fastqs)}')
+    # The checksums of the merged FASTQs are computed while copying, and their
+    # counts are the sums of the counts of the shards.
+    counts = {}
+    for j in range(len(shards)):
+        checksums_path = f'{base}{j+1}.checksums.tsv'
+        for shard, _, _, records, bases in read_checksums(checksums_path):
+            counts[shard] = (records, bases)
+        os.remove(checksums_path)
+    rows = []
+    for i, fastq in enumerate(fastqs):
+        # The first shard is renamed into place, so that only the others are
+        # copied. It is still read to compute the checksum.
+        md5 = hashlib.md5()
+        os.replace(shards[0][i], fastq)
+        with open(fastq, 'rb') as f:
+            for data in iter(lambda: f.read(1 << 20), b''):
+                md5.update(data)
+        with open(fastq, 'ab') as out:
+            for shard in shards[1:]:
+                with open(shard[i], 'rb') as f:
+                    for data in iter(lambda: f.read(1 << 20), b''):
+                        out.write(data)
+                        md5.update(data)
+                os.remove(shard[i])
+        rows.append((
+            fastq, md5.hexdigest(), os.path.getsize(fastq),
+            sum(counts[shard[i]][0] for shard in shards),
+            sum(counts[shard[i]][1] for shard in shards)
+        ))
+    write_checksums(
+        f'{prefix}.checksums.tsv' if prefix else 'checksums.tsv', rows
+    )
+    return fastqs, ordered
+
+
+def open_fastqs(stack, fastqs):
+    """Open a list of FASTQs for reading text. All remote FASTQs are opened
+    concurrently.
+
+    :param stack: exit stack that all opened files are registered with
+    :type stack: contextlib.ExitStack
+    :param fastqs: paths to FASTQs, may be remote
+    :type fastqs: list
 
+    :return: list of text file objects
+    :rtype: list
+    """
+    remote = [path for path in fastqs if is_remote(path)]
+    remote_files = dict(zip(remote, stack.enter_context(RemoteFiles(remote))))
+    files = []
+    for path in fastqs:
+        if path in remote_files:
+            f = remote_files[path]
+            if path.endswith('.gz'):
+                f = gzip.GzipFile(fileobj=io.BufferedReader(f))
+            f = io.TextIOWrapper(f)
+        else:
+            f = Fastq(path).open()
+        files.append(stack.enter_context(f))
+    return files
+
+
+def detect_fastqs(
+    fastqs,
+    skip,
+    n,
+    technologies=None,
+    batch_size=BATCH_SIZE,
+    sample_chunks=0,
+    stop_confidence=None,
+):
+    """Detect single-cell technology and file ordering, and return the Detector
+    with the counts of all candidates. See `fqc_fastq`.
+
+    :param fastqs: paths to FASTQs
+    :type fastqs: list
+    :param skip: number of reads to skip at the beginning
+    :type skip: int
+    :param n: number of reads to consider
+    :type n: int
+    :param technologies: list of possible OrderedTechnology objects, defaults to `None`
+    :type technologies: list, optional
+    :param batch_size: number of reads per batch, defaults to `10000`
+    :type batch_size: int, optional
+    :param sample_chunks: number of positions to sample BGZF-compressed FASTQs
+                          at, defaults to `0`, which reads from the start
+    :type sample_chunks: int, optional
+    :param stop_confidence: confidence at which to stop reading before `n`
+                            reads, defaults to `None`, which never stops early
+    :type stop_confidence: float, optional
+
+    :return: tuple of a list of paths to FASTQs that are not index reads and
+             the Detector, which is `None` if all FASTQs are index reads
+    :rtype: tuple
+    """
+    if sample_chunks and not all(
+            not is_remote(path) and path.endswith('.gz') and is_bgzf_file(path)
+            for path in fastqs):
+        logger.warning((
+            'Not all FASTQs are local BGZF-compressed files, so they can not be '
+            'sampled. Reading from the start instead.'
+        ))
+        sample_chunks = 0
+    with ExitStack() as stack:
+        if sample_chunks:
+            logger.info(
+                f'Sampling {n} reads from {sample_chunks} positions in each FASTQ'
+            )
+            skip = 0
+            reads = sample_fastqs(
+                fastqs, n, sample_chunks, threads=get_resources().threads
+            )
+            iterators = [iter(rs) for rs in reads]
+        else:
+            iterators = [sequences(f) for f in open_fastqs(stack, fastqs)]
+        # Skip the first `skip` reads
+        for iterator in iterators:
+            next(islice(iterator, skip, skip), None)
+
+        # Use the first batch to check for index fastqs, which will have very
+        # low variation.
+        batch = next_batch(iterators, min(batch_size, n))
+        if not batch or not batch[0]:
+            raise Exception(
+                f'No reads were read after skipping the first {skip} reads'
+            )
+        keep = []
+        for i, (path, rs) in enumerate(zip(fastqs, batch)):
+            if len(set(rs)) / len(rs) < 0.05:
+                logger.warning((
+                    f'FASTQ {path} has {len(set(rs))}/{len(rs)} unique sequences. '
+                    'This file will be considered an index read and will be ignored.'
+                ))
+                continue
+            keep.append(i)
+        if not keep:
+            logger.warning('All FASTQs were considered index reads')
+            return fastqs, None
+        paths = [fastqs[i] for i in keep]
+        iterators = [iterators[i] for i in keep]
+        logger.info('Only the following FASTQs will be considered:')
+        for path in paths:
+            logger.info(f'\t{path}')
+
+        # if not is_single_cell(list(reads.values())):
+        #     raise Exception(
+        #         'The provided FASTQs are not from a single-cell experiment.'
+        #     )
+
+        logger.info(f'Filtering based on number of files: {len(paths)}')
+        detector = Detector(len(paths), technologies)
+        logger.debug((
+            f'{len(detector.technologies)} passed the filter: '
+            f'{", ".join(str(technology) for technology in detector.technologies)}'
+        ))
+
+        logger.info('Filtering based on barcode and UMI sequences')
+        batch = first = [batch[i] for i in keep]
+        while batch[0]:
+            detector.update(batch)
+            if (stop_confidence is not None and detector.best is not None
+                    and detector.confidence >= stop_confidence):
+                break
+            batch = next_batch(iterators, min(batch_size, n - detector.n))
+    logger.info(
+        f'Read {detector.n} reads after skipping the first {skip} reads'
+    )
 
-def fqc_fastq(fastqs, skip, n, technologies=None):
+    detector.log()
+    if detector.best is None:
+        log_discoveries(discover(first), paths)
+    return paths, detector
+
+
+def fqc_fastq(
+    fastqs,
+    skip,
+    n,
+    technologies=None,
+    batch_size=BATCH_SIZE,
+    sample_chunks=0,
+    stop_confidence=None,
+):
     """Detect single-cell technology and file ordering.
 
+    The FASTQs are read in lockstep, in batches of synchronized reads, and only
+    running counts of matching barcodes are kept, so memory usage does not
+    depend on `n`. If `sample_chunks` is given and all FASTQs are local and
+    BGZF-compressed, the reads are instead sampled from that many positions
+    across the files, in which case `skip` is ignored.
+
     :param fastqs: paths to FASTQs
     :type fastqs: list
     :param skip: number of reads to skip at the beginning
@@ -317,46 +675,194 @@ def fqc_fastq(fastqs, skip, n, technologies=None):
     :type n: int
     :param technologies: list of possible OrderedTechnology objects, defaults to `None`
     :type technologies: list, optional
+    :param batch_size: number of reads per batch, defaults to `10000`
+    :type batch_size: int, optional
+    :param sample_chunks: number of positions to sample BGZF-compressed FASTQs
+                          at, defaults to `0`, which reads from the start
+    :type sample_chunks: int, optional
+    :param stop_confidence: confidence at which to stop reading before `n`
+                            reads, defaults to `None`, which never stops early
+    :type stop_confidence: float, optional
 
     :return: tuple of a list of paths to FASTQs and a list of TechnologyOrdering objects
     :rtype: tuple
     """
-    # Read n reads, starting from read skip
-    reads = OrderedDict()
-    for path in fastqs:
-        fastq = Fastq(path)
-        rs = fastq[skip:skip + n]
-        logger.info(
-            f'Read {len(rs)} reads after skipping the first {skip} reads from {path}'
-        )
-
-        # Check if index fastq, which will have very low variation.
-        if len(set(rs)) / len(rs) < 0.05:
-            logger.warning((
-                f'FASTQ {path} has {len(set(rs))}/{len(rs)} unique sequences. '
-                'This file will be considered an index read and will be ignored.'
-            ))
-            continue
-        reads[path] = rs
-    logger.info('Only the following FASTQs will be considered:')
-    for path in reads.keys():
-        logger.info(f'\t{path}')
-
-    # if not is_single_cell(list(reads.values())):
-    #     raise Exception(
-    #         'The provided FASTQs are not from a single-cell experiment.'
-    #     )
-
-    logger.info(f'Filtering based on number of files: {len(reads)}')
-    technologies = filter_files(reads)
-    logger.debug(
-        f'{len(technologies)} passed the filter: {", ".join(str(technology) for technology in technologies)}'
+    paths, detector = detect_fastqs(
+        fastqs,
+        skip,
+        n,
+        technologies=technologies,
+        batch_size=batch_size,
+        sample_chunks=sample_chunks,
+        stop_confidence=stop_confidence
     )
-
-    logger.info('Filtering based on barcode and UMI sequences')
-    technologies = filter_barcodes_umis(reads, technologies)
+    technologies = [detector.best] if detector is not None \
+        and detector.best is not None else []
     logger.debug(
         f'{len(technologies)} passed the filter: {", ".join(str(technology) for technology in technologies)}'
     )
+    return paths, technologies
+
+
+def log_discoveries(discoveries, paths):
+    """Log barcode positions found by `discovery.discover`.
+
+    :param discoveries: list of Discovery objects
+    :type discoveries: list
+    :param paths: paths to FASTQs that were scanned
+    :type paths: list
+    """
+    if not discoveries:
+        logger.info('No barcodes of any whitelist were found at any position')
+        return
+    logger.warning((
+        'No known technology was detected, but barcodes of the following '
+        'whitelists were found at other positions:'
+    ))
+    for discovery in discoveries:
+        logger.warning((
+            f'\t{paths[discovery.file]} [{discovery.start}:{discovery.stop}]: '
+            f'{discovery.rate:.2%} of reads in '
+            f'{os.path.basename(discovery.whitelist_path)} '
+            f'({", ".join(discovery.technologies) or "no technology"})'
+        ))
+
+
+def fqc_samples(
+    groups,
+    skip,
+    n,
+    technologies=None,
+    threads=4,
+    batch_size=BATCH_SIZE,
+):
+    """Detect single-cell technology and file ordering of multiple samples, each
+    with one or more lanes of FASTQs. Only one representative lane per sample is
+    used for detection, and samples are detected in parallel. The detected
+    ordering of reads is then applied to all lanes of the sample.
+
+    :param groups: ordered dictionary with samples as keys and ordered
+                   dictionaries as values, which have lanes as keys and ordered
+                   dictionaries of reads (i.e. `R1`) and FASTQ paths as values,
+                   as returned by `illumina.group_fastqs`
+    :type groups: OrderedDict
+    :param skip: number of reads to skip at the beginning
+    :type skip: int
+    :param n: number of reads to consider
+    :type n: int
+    :param technologies: list of possible OrderedTechnology objects, defaults to `None`
+    :type technologies: list, optional
+    :param threads: number of samples to detect in parallel, defaults to `4`
+    :type threads: int, optional
+    :param batch_size: number of reads per batch, defaults to `10000`
+    :type batch_size: int, optional
+
+    :return: ordered dictionary with samples as keys and tuples of
+             (OrderedTechnology or `None`, ordered dictionary of lanes and lists of
+             ordered FASTQ paths) as values
+    :rtype: OrderedDict
+    """
+    representatives = OrderedDict((sample, next(iter(lanes.values())))
+                                  for sample, lanes in groups.items())
+    with ProcessPoolExecutor(max_workers=max(1, min(threads, len(groups)))
+                             ) as executor:
+        futures = OrderedDict((
+            sample,
+            executor.submit(
+                fqc_fastq,
+                list(reads.values()),
+                skip,
+                n,
+                technologies,
+                batch_size=batch_size
+            )
+        ) for sample, reads in representatives.items())
+
+        results = OrderedDict()
+        for sample, future in futures.items():
+            reads = representatives[sample]
+            try:
+                fastqs, detected = future.result()
+            except Exception as e:
+                logger.error(f'Failed to detect technology of {sample}: {e}')
+                detected = []
+            if len(detected) != 1:
+                logger.error(f'Failed to detect technology of {sample}')
+                results[sample] = (None, OrderedDict())
+                continue
+
+            ordered = detected[0]
+            logger.info(
+                f'Detected technology of {sample}: {ordered}, '
+                f'from {", ".join(fastqs)}'
+            )
+            # Apply the ordering of reads (i.e. R2, R1) to all lanes.
+            path_reads = {path: read for read, path in reads.items()}
+            order = [path_reads[fastqs[i]] for i in ordered.permutation]
+            lanes = OrderedDict()
+            for lane, lane_reads in groups[sample].items():
+                if not all(read in lane_reads for read in order):
+                    logger.warning((
+                        f'Lane {lane} of {sample} is missing some of the '
+                        f'reads {", ".join(order)}. This lane will be ignored.'
+                    ))
+                    continue
+                lanes[lane] = [lane_reads[read] for read in order]
+            results[sample] = (ordered, lanes)
+    return results
+
+
+def fqc_stream(
+    lines,
+    n_files,
+    skip,
+    n,
+    technologies=None,
+    batch_size=BATCH_SIZE,
+    stop_confidence=STOP_CONFIDENCE
+):
+    """Detect single-cell technology and read ordering from an interleaved
+    FASTQ stream (i.e. standard input). Reads are consumed in batches, and
+    reading stops as soon as the detected technology reaches `stop_confidence`.
+
+    :param lines: iterable of lines of an interleaved FASTQ
+    :type lines: iterable
+    :param n_files: number of records per spot
+    :type n_files: int
+    :param skip: number of spots to skip at the beginning
+    :type skip: int
+    :param n: maximum number of spots to consider
+    :type n: int
+    :param technologies: list of possible OrderedTechnology objects, defaults to `None`
+    :type technologies: list, optional
+    :param batch_size: number of spots per batch, defaults to `10000`
+    :type batch_size: int, optional
+    :param stop_confidence: confidence at which to stop reading, defaults to `0.999`
+    :type stop_confidence: float, optional
+
+    :return: Detector object
+    :rtype: Detector
+    """
+    detector = Detector(n_files, technologies)
+    skipped = 0
+    for batch in interleaved_batches(lines, n_files, batch_size):
+        if skipped < skip:
+            drop = min(skip - skipped, len(batch[0]))
+            batch = [reads[drop:] for reads in batch]
+            skipped += drop
+        batch = [reads[:n - detector.n] for reads in batch]
+        if not batch[0]:
+            if detector.n >= n:
+                break
+            continue
 
-    return list(reads.keys()), technologies
+        detector.update(batch)
+        logger.debug((
+            f'Read {detector.n} spots, current best is {detector.best} '
+            f'with confidence {detector.confidence:.4f}'
+        ))
+        if detector.n >= n or (detector.best is not None
+                               and detector.confidence >= stop_confidence):
+            break
+    detector.log()
+    return detector
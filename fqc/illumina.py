@@ -0,0 +1,87 @@
+import os
+import re
+from collections import namedtuple, OrderedDict
+
+# Illumina (bcl2fastq) FASTQ naming convention, i.e.
+# SAMPLE_S1_L001_R1_001.fastq.gz. The lane is missing if bcl2fastq was run
+# with --no-lane-splitting.
+ILLUMINA_PATTERN = re.compile(
+    r'^(?P<sample>.+)_S(?P<number>\d+)(?:_L(?P<lane>\d{3}))?'
+    r'_(?P<read>[RI]\d)_(?P<chunk>\d{3})\.(?:fastq|fq)(?:\.gz)?$'
+)
+
+IlluminaFastq = namedtuple(
+    'IlluminaFastq', ['path', 'sample', 'lane', 'read', 'chunk']
+)
+
+
+def parse_illumina(path):
+    """Parse the sample, lane, read and chunk of a FASTQ following the Illumina
+    naming convention.
+
+    :param path: path to FASTQ
+    :type path: str
+
+    :return: an IlluminaFastq object, or `None` if the file name does not follow
+             the convention
+    :rtype: IlluminaFastq
+    """
+    match = ILLUMINA_PATTERN.match(os.path.basename(path))
+    if not match:
+        return None
+    return IlluminaFastq(
+        path,
+        f'{match.group("sample")}_S{match.group("number")}',
+        match.group('lane') or '',
+        match.group('read'),
+        match.group('chunk'),
+    )
+
+
+def group_fastqs(paths):
+    """Group FASTQs following the Illumina naming convention into samples and
+    lanes. Chunks of the same sample, lane and read are considered separate
+    lanes, since they are independent sets of synchronized reads.
+
+    :param paths: paths to FASTQs
+    :type paths: list
+
+    :return: (groups, others) tuple, where `groups` is an ordered dictionary
+             with samples as keys and ordered dictionaries as values, which
+             have lanes as keys and ordered dictionaries of reads (i.e. `R1`)
+             and FASTQ paths as values, and `others` is a list of paths that
+             do not follow the naming convention
+    :rtype: tuple
+    """
+    groups = OrderedDict()
+    others = []
+    parsed = []
+    for path in paths:
+        fastq = parse_illumina(path)
+        if fastq is None:
+            others.append(path)
+        else:
+            parsed.append(fastq)
+
+    parsed = sorted(parsed, key=lambda f: (f.sample, f.lane, f.chunk, f.read))
+    for fastq in parsed:
+        lane = f'{fastq.lane}_{fastq.chunk}' if fastq.lane else fastq.chunk
+        lanes = groups.setdefault(fastq.sample, OrderedDict())
+        lanes.setdefault(lane, OrderedDict())[fastq.read] = fastq.path
+    return groups, others
+
+
+def scan_directory(directory):
+    """Find and group all FASTQs following the Illumina naming convention in a
+    directory, i.e. the output of bcl2fastq. Subdirectories are also searched.
+
+    :param directory: path to directory
+    :type directory: str
+
+    :return: ordered dictionary of groups, as returned by `group_fastqs`
+    :rtype: OrderedDict
+    """
+    paths = []
+    for root, _, files in os.walk(directory):
+        paths.extend(os.path.join(root, file) for file in files)
+    return group_fastqs(paths)[0]
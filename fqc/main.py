@@ -1,14 +1,127 @@
 import argparse
 import logging
+import os
 import sys
 
 from . import __version__
-from .config import N_READS, SKIP_READS
-from .fqc import fqc_bam, fqc_fastq
+from .client import detect as detect_with_server
+from .compression import BACKENDS, set_backend
+from .config import (
+    DECOMPRESSION_BACKEND,
+    LEASE_TIMEOUT,
+    MAX_MEMORY,
+    MAX_OPEN_FILES,
+    N_READS,
+    SKIP_READS,
+    SOCKET_PATH,
+)
+from .illumina import group_fastqs, scan_directory
+from .resources import set_resources
+from .technologies import OrderedTechnology, TECHNOLOGIES_MAPPING
 
 logger = logging.getLogger(__name__)
 
 
+def print_samples(results):
+    """Print the technology and ordered FASTQs of each lane of each sample, as
+    tab-separated lines.
+
+    :param results: results of `fqc_samples`
+    :type results: OrderedDict
+    """
+    for sample, (technology, lanes) in results.items():
+        if technology is None:
+            print(f'{sample}\t\t\t')
+            continue
+        for lane, fastqs in lanes.items():
+            print(
+                f'{sample}\t{lane}\t{technology.technology}\t{" ".join(fastqs)}'
+            )
+
+
+def print_technologies(fastqs, technologies):
+    """Print the detected technology and ordered FASTQs, or log that no
+    technology or multiple technologies were detected.
+
+    :param fastqs: list of FASTQs
+    :type fastqs: list
+    :param technologies: list of detected OrderedTechnology objects
+    :type technologies: list
+    """
+    if not technologies:
+        logger.error('Failed to detect technology')
+    elif len(technologies) == 1:
+        technology = technologies[0]
+        logger.info(f'Detected technology: {technology}')
+        print(technology.technology)
+        print(' '.join(fastqs[i] for i in technology.permutation))
+    else:
+        logger.warning(
+            f'Ambiguous technologies {", ".join(str(technology) for technology in technologies)}'
+        )
+
+
+def write_profiles(fastqs, args):
+    """Profile all reads of FASTQs in parallel, and write the report to the
+    path given with `--profile`.
+
+    :param fastqs: paths to FASTQs
+    :type fastqs: list
+    :param args: parsed command-line arguments
+    :type args: argparse.Namespace
+    """
+    from .profiling import profile_fastqs, write_report
+    resources = set_resources(args.threads, args.max_memory, jobs=len(fastqs))
+    write_report(
+        profile_fastqs(fastqs, processes=resources.processes), args.profile
+    )
+    logger.info(f'Profiled {len(fastqs)} FASTQs into {args.profile}')
+
+
+def parse_memory(value):
+    """Parse an amount of memory, in bytes or with a K, M or G suffix.
+
+    :param value: amount of memory, i.e. `4G`
+    :type value: str
+
+    :return: number of bytes
+    :rtype: int
+    """
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+    value = value.strip().upper().rstrip('B')
+    try:
+        if value and value[-1] in units:
+            return int(float(value[:-1]) * units[value[-1]])
+        return int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'Invalid amount of memory: {value}')
+
+
+def can_forward(args):
+    """Determine whether the command can be forwarded to a server started with
+    `fqc serve`, which is the case when the technology of a single set of FASTQs
+    or a single BAM is only detected.
+
+    :param args: parsed command-line arguments
+    :type args: argparse.Namespace
+
+    :return: whether the command can be forwarded
+    :rtype: bool
+    """
+    if args.no_server or args.queue or args.files in ([], ['-']) \
+            or not os.path.exists(args.socket):
+        return False
+    if len(args.files) == 1 and args.files[0].endswith('.bam'):
+        return not (args.split_bam or args.split_cells or args.to_bus)
+    if args.sample_chunks or args.profile or not all(
+            file.endswith(('.fastq.gz', '.fastq')) for file in args.files):
+        return False
+    groups, others = group_fastqs(args.files)
+    return bool(others) or (
+        len(groups) == 1 and all(len(lanes) == 1 for lanes in groups.values())
+    )
+
+
 def main():
     """Command-line entrypoint.
     """
@@ -19,8 +132,14 @@ def main():
     parser.add_argument(
         'files',
         metavar='FILES',
-        help='Input files (FASTQs or a single BAM)',
-        nargs='+'
+        help=(
+            'Input files (FASTQs, or one or more BAMs of the same sample), '
+            'a directory of FASTQs following the Illumina naming convention, '
+            'or `-` to read an interleaved FASTQ from standard input. With '
+            '`--queue`, a manifest of samples. Use `serve` to start a server '
+            'that detects the technology of files for other fqc commands'
+        ),
+        nargs='*'
     )
     fastq_args = parser.add_argument_group('optional arguments for FASTQ files')
     fastq_args.add_argument(
@@ -37,6 +156,39 @@ def main():
         type=int,
         default=N_READS
     )
+    fastq_args.add_argument(
+        '--interleaved',
+        metavar='N',
+        help=(
+            'Number of consecutive records per spot when reading an interleaved '
+            'FASTQ from standard input (default: 2)'
+        ),
+        type=int,
+        default=2
+    )
+    fastq_args.add_argument(
+        '--sample-chunks',
+        metavar='N',
+        help=(
+            'Sample reads from N evenly spaced positions across the FASTQs '
+            'instead of from the start, ignoring -s. Only supported for local '
+            'BGZF-compressed (bgzip) FASTQs (default: 0)'
+        ),
+        type=int,
+        default=0
+    )
+    fastq_args.add_argument(
+        '--profile',
+        metavar='PATH',
+        help=(
+            'After detecting, also profile all reads of the FASTQs (read '
+            'lengths, poly-A tails, poly-T heads, N content and base '
+            'composition per position), in parallel, and write a JSON report '
+            'to PATH. Not supported with BAMs or stdin'
+        ),
+        type=str,
+        default=None
+    )
     bam_args = parser.add_argument_group('optional arguments for BAM files')
     bam_args.add_argument(
         '-p',
@@ -47,13 +199,6 @@ def main():
         type=str,
         default=''
     )
-    bam_args.add_argument(
-        '-t',
-        metavar='THREADS',
-        help='Number of threads (default: 4)',
-        type=int,
-        default=4
-    )
     bam_args.add_argument(
         '--split-bam',
         help=(
@@ -63,6 +208,220 @@ def main():
         ),
         action='store_true'
     )
+    bam_args.add_argument(
+        '--resume',
+        help=(
+            'Resume an interrupted `--split-bam` from its last checkpoint, '
+            'which is written to PREFIX.checkpoint.json while splitting.'
+        ),
+        action='store_true'
+    )
+    bam_args.add_argument(
+        '--chunk-records',
+        metavar='RECORDS',
+        help=(
+            'Used with `--split-bam`. Rotate to a new set of FASTQ files, '
+            'named PREFIX_i.partJ.fastq.gz, every RECORDS reads. The chunks '
+            'are listed in PREFIX.manifest.tsv.'
+        ),
+        type=int,
+        default=None
+    )
+    bam_args.add_argument(
+        '--chunk-bytes',
+        metavar='BYTES',
+        help=(
+            'Used with `--split-bam`. Rotate to a new set of FASTQ files '
+            'every BYTES bytes of uncompressed FASTQ records.'
+        ),
+        type=int,
+        default=None
+    )
+    bam_args.add_argument(
+        '--split-cells',
+        help=(
+            'Split the BAM file into FASTQ files per cell barcode, named '
+            'PREFIX_BARCODE_i.fastq.gz if `-p` is provided, '
+            'BARCODE_i.fastq.gz otherwise.'
+        ),
+        action='store_true'
+    )
+    bam_args.add_argument(
+        '--to-bus',
+        metavar='PATH',
+        help=(
+            'Convert the BAM file directly into a binary file of 2-bit packed '
+            'barcode, UMI and sequence records (in the style of the BUS '
+            'format), instead of FASTQ files.'
+        ),
+        type=str,
+        default=None
+    )
+    bam_args.add_argument(
+        '--cell-whitelist',
+        metavar='WHITELIST',
+        help='Only write cell barcodes in this list when splitting.',
+        type=str,
+        default=None
+    )
+    bam_args.add_argument(
+        '--technology-whitelist',
+        help=(
+            'Only write cell barcodes in the whitelist of the detected '
+            'technology when splitting.'
+        ),
+        action='store_true'
+    )
+    bam_args.add_argument(
+        '--fraction',
+        metavar='FRACTION',
+        help=(
+            'Fraction of reads to write when splitting, selected '
+            'deterministically by read name (default: 1)'
+        ),
+        type=float,
+        default=1.
+    )
+    bam_args.add_argument(
+        '--max-records',
+        metavar='RECORDS',
+        help='Maximum number of reads to write when splitting',
+        type=int,
+        default=None
+    )
+    bam_args.add_argument(
+        '--seed',
+        metavar='SEED',
+        help='Seed used with `--fraction` (default: 0)',
+        type=int,
+        default=0
+    )
+    bam_args.add_argument(
+        '--min-count',
+        metavar='COUNT',
+        help=(
+            'Only write cell barcodes with at least this many reads. '
+            'Used with `--split-cells`. (default: 0)'
+        ),
+        type=int,
+        default=0
+    )
+    bam_args.add_argument(
+        '--cell-groups',
+        metavar='GROUPS',
+        help=(
+            'Tab-separated file of cell barcodes and group names. If provided, '
+            'FASTQ files are written per group instead of per cell barcode. '
+            'Used with `--split-cells`.'
+        ),
+        type=str,
+        default=None
+    )
+    bam_args.add_argument(
+        '--max-open-files',
+        metavar='FILES',
+        help=(
+            'Maximum number of output files to keep open at once. '
+            f'Used with `--split-cells`. (default: {MAX_OPEN_FILES})'
+        ),
+        type=int,
+        default=MAX_OPEN_FILES
+    )
+    bam_args.add_argument(
+        '--keep-shards',
+        help=(
+            'When splitting multiple BAMs, keep one set of FASTQ files per BAM, '
+            'named PREFIX_shardJ_i.fastq.gz, instead of merging them.'
+        ),
+        action='store_true'
+    )
+    queue_args = parser.add_argument_group('optional arguments for work queues')
+    queue_args.add_argument(
+        '--queue',
+        metavar='DIRECTORY',
+        help=(
+            'Detect the technology of every sample in a manifest (FILES), '
+            'with a sample name followed by its FASTQs or BAM on each '
+            'tab-separated line, through a work queue in DIRECTORY. Any number '
+            'of workers on any nodes that share DIRECTORY may run the same '
+            'command, and each claims samples until none are left.'
+        ),
+        type=str,
+        default=None
+    )
+    queue_args.add_argument(
+        '--worker',
+        metavar='NAME',
+        help='Name of this worker (default: host name and process id)',
+        type=str,
+        default=None
+    )
+    queue_args.add_argument(
+        '--lease-timeout',
+        metavar='SECONDS',
+        help=(
+            'Seconds after which a sample whose worker stopped renewing its '
+            f'lease is retried (default: {LEASE_TIMEOUT})'
+        ),
+        type=int,
+        default=LEASE_TIMEOUT
+    )
+    queue_args.add_argument(
+        '--merge',
+        help=(
+            'Print the combined results of all workers of `--queue`, instead '
+            'of processing samples'
+        ),
+        action='store_true'
+    )
+    server_args = parser.add_argument_group('optional arguments for servers')
+    server_args.add_argument(
+        '--socket',
+        metavar='PATH',
+        help=(
+            'Unix socket of the server started with `fqc serve`. When a server '
+            'is listening, detecting the technology of a single set of FASTQs '
+            f'or a single BAM is forwarded to it (default: {SOCKET_PATH})'
+        ),
+        type=str,
+        default=SOCKET_PATH
+    )
+    server_args.add_argument(
+        '--no-server', help='Never forward to a server', action='store_true'
+    )
+    parser.add_argument(
+        '-t',
+        '--threads',
+        metavar='THREADS',
+        help=(
+            'Total number of threads, used to read BAMs, decompress BGZF '
+            'FASTQs and detect samples or split BAMs in parallel (default: 4)'
+        ),
+        type=int,
+        default=4
+    )
+    parser.add_argument(
+        '--max-memory',
+        metavar='MEMORY',
+        help=(
+            'Maximum memory to use, in bytes or with a K, M or G suffix '
+            '(i.e. 4G). Batch sizes, buffers and the number of samples or '
+            'BAMs processed in parallel are reduced to fit, and whitelists '
+            'are memory-mapped from disk if they do not fit (default: no limit)'
+        ),
+        type=parse_memory,
+        default=MAX_MEMORY
+    )
+    parser.add_argument(
+        '--decompression',
+        help=(
+            'Backend used to decompress gzipped inputs '
+            f'(default: {DECOMPRESSION_BACKEND})'
+        ),
+        type=str,
+        choices=['auto'] + list(BACKENDS.keys()),
+        default=DECOMPRESSION_BACKEND
+    )
     parser.add_argument(
         '--verbose', help='Print debugging information', action='store_true'
     )
@@ -80,12 +439,150 @@ def main():
 
     logger.debug('Printing verbose output')
     logger.debug(args)
+    set_backend(args.decompression)
 
-    if len(args.files) == 1 and args.files[0].endswith('.bam'):
+    if args.profile and (args.queue or args.files in ([], ['-'], ['serve'])
+                         or any(file.endswith('.bam') for file in args.files)):
+        parser.error(
+            '`--profile` is only supported with FASTQs or a directory of FASTQs'
+        )
+
+    if can_forward(args):
+        try:
+            technologies = detect_with_server(
+                args.files, args.s, args.n, path=args.socket
+            )
+        except Exception as e:
+            # The server may not be reachable, time out, or fail to detect (i.e.
+            # because it can not read the files).
+            logger.warning((
+                f'Failed to detect with server at {args.socket}: {e}. '
+                'Detecting locally instead.'
+            ))
+        else:
+            logger.info(f'Running in mode: client of server at {args.socket}')
+            if args.files[0].endswith('.bam'):
+                technology = technologies[0][0] if technologies else None
+                logger.info(f'Detected technology: {technology}')
+                print(technology)
+                return
+            print_technologies(
+                args.files, [
+                    OrderedTechnology(TECHNOLOGIES_MAPPING[name], permutation)
+                    for name, permutation in technologies
+                ]
+            )
+            return
+
+    # Imported here, so that commands that are forwarded to a server do not need
+    # to import numpy, scipy and pysam.
+    from .fqc import fqc_bam, fqc_bams, fqc_fastq, fqc_samples, fqc_stream
+    from .workqueue import init_queue, merge, work
+
+    if args.files == ['serve'] and not os.path.exists('serve'):
+        from .server import serve
+        logger.info('Running in mode: server')
+        resources = set_resources(
+            args.threads, args.max_memory, jobs=args.threads
+        )
+        serve(args.socket, processes=resources.processes)
+        return
+    elif args.queue:
+        if args.merge:
+            logger.info('Running in mode: merge queue')
+            results = merge(args.queue)
+            for sample, (status, technology, paths) in results.items():
+                print('\t'.join([sample, status, technology] + paths))
+            return
+        if len(args.files) != 1:
+            parser.error('`--queue` requires a single manifest of samples')
+        logger.info('Running in mode: queue worker')
+        set_resources(args.threads, args.max_memory)
+        init_queue(args.queue, args.files[0], timeout=args.lease_timeout)
+        work(
+            args.queue,
+            worker=args.worker,
+            skip=args.s,
+            n=args.n,
+            timeout=args.lease_timeout
+        )
+        return
+    elif not args.files:
+        parser.error('No input files were provided')
+
+    if args.files == ['-']:
+        logger.info('Running in mode: stdin')
+        resources = set_resources(args.threads, args.max_memory)
+        detector = fqc_stream(
+            sys.stdin,
+            args.interleaved,
+            args.s,
+            args.n,
+            batch_size=resources.batch_size
+        )
+        technology = detector.best
+        if technology is None:
+            logger.error('Failed to detect technology')
+        else:
+            logger.info((
+                f'Detected technology: {technology} from {detector.n} spots '
+                f'with confidence {detector.confidence:.4f}'
+            ))
+            print(technology.technology)
+            print(' '.join(str(i) for i in technology.permutation))
+        return
+    elif len(args.files) == 1 and args.files[0].endswith('.bam'):
         logger.info('Running in mode: BAM')
+        if args.resume and (args.split_cells or args.to_bus
+                            or not args.split_bam):
+            parser.error(
+                '`--resume` is only supported with `--split-bam`, without '
+                '`--split-cells` or `--to-bus`'
+            )
+        resources = set_resources(args.threads, args.max_memory)
         result = fqc_bam(
-            args.files[0], split=args.split_bam, prefix=args.p, threads=args.t
+            args.files[0],
+            split=args.split_bam,
+            prefix=args.p,
+            threads=resources.threads,
+            split_cells=args.split_cells,
+            whitelist_path=args.cell_whitelist,
+            technology_whitelist=args.technology_whitelist,
+            min_count=args.min_count,
+            groups_path=args.cell_groups,
+            max_open=args.max_open_files,
+            fraction=args.fraction,
+            max_records=args.max_records,
+            seed=args.seed,
+            bus_path=args.to_bus,
+            resume=args.resume,
+            chunk_records=args.chunk_records,
+            chunk_bytes=args.chunk_bytes,
         )
+        if args.to_bus:
+            path, technologies = result
+            logger.info(
+                f'Detected technology: {technologies[0]}, converted into {path}'
+            )
+            print(technologies[0].technology)
+            return
+        if args.split_bam and not args.split_cells and (
+                args.chunk_records is not None or args.chunk_bytes is not None):
+            chunks, technologies = result
+            logger.info(
+                f'Detected technology: {technologies[0]}, split into '
+                f'{len(chunks)} chunks of FASTQs'
+            )
+            print(technologies[0].technology)
+            return
+        if args.split_cells:
+            fastqs, technologies = result
+            logger.info(
+                f'Detected technology: {technologies[0]}, split into FASTQs '
+                f'for {len(fastqs)} cells or groups'
+            )
+            print(technologies[0].technology)
+            return
         if not args.split_bam:
             logger.info((
                 'Use `--split-bam` to revert the BAM file to its constituent FASTQ '
@@ -94,24 +591,104 @@ def main():
             logger.info(f'Detected technology: {result}')
             print(result)
             return
+    elif len(args.files) > 1 and all(file.endswith('.bam')
+                                     for file in args.files):
+        logger.info('Running in mode: multiple BAMs')
+        if args.split_cells or args.to_bus or args.chunk_records is not None \
+                or args.chunk_bytes is not None:
+            parser.error(
+                'Only `--split-bam` is supported with multiple BAM files'
+            )
+        if args.resume:
+            parser.error('`--resume` is not supported with multiple BAM files')
+        resources = set_resources(
+            args.threads, args.max_memory, jobs=len(args.files)
+        )
+        result = fqc_bams(
+            args.files,
+            split=args.split_bam,
+            prefix=args.p,
+            threads=args.threads,
+            whitelist_path=args.cell_whitelist,
+            technology_whitelist=args.technology_whitelist,
+            fraction=args.fraction,
+            max_records=args.max_records,
+            seed=args.seed,
+            merge=not args.keep_shards,
+            processes=resources.processes,
+        )
+        if not args.split_bam:
+            logger.info(f'Detected technology: {result}')
+            print(result)
+            return
+        if args.keep_shards:
+            shards, technologies = result
+            logger.info(f'Detected technology: {technologies[0]}')
+            print(technologies[0].technology)
+            for shard in shards:
+                print(' '.join(shard))
+            return
+    elif len(args.files) == 1 and os.path.isdir(args.files[0]):
+        logger.info('Running in mode: directory')
+        groups = scan_directory(args.files[0])
+        if not groups:
+            parser.error(
+                f'No FASTQs following the Illumina naming convention in {args.files[0]}'
+            )
+        resources = set_resources(
+            args.threads, args.max_memory, jobs=len(groups)
+        )
+        print_samples(
+            fqc_samples(
+                groups,
+                args.s,
+                args.n,
+                threads=resources.processes,
+                batch_size=resources.batch_size
+            )
+        )
+        if args.profile:
+            write_profiles([
+                path for lanes in groups.values() for reads in lanes.values()
+                for path in reads.values()
+            ], args)
+        return
     elif all(file.endswith(('.fastq.gz', '.fastq')) for file in args.files):
+        groups, others = group_fastqs(args.files)
+        if not others and (len(groups) > 1
+                           or any(len(lanes) > 1 for lanes in groups.values())):
+            # Multiple samples or lanes, which are detected separately.
+            logger.info('Running in mode: FASTQ (multiple samples or lanes)')
+            resources = set_resources(
+                args.threads, args.max_memory, jobs=len(groups)
+            )
+            print_samples(
+                fqc_samples(
+                    groups,
+                    args.s,
+                    args.n,
+                    threads=resources.processes,
+                    batch_size=resources.batch_size
+                )
+            )
+            if args.profile:
+                write_profiles(args.files, args)
+            return
         logger.info('Running in mode: FASTQ')
-        result = fqc_fastq(args.files, args.s, args.n)
+        resources = set_resources(args.threads, args.max_memory)
+        result = fqc_fastq(
+            args.files,
+            args.s,
+            args.n,
+            batch_size=resources.batch_size,
+            sample_chunks=args.sample_chunks
+        )
 
     else:
         parser.error(
-            'All input files must be FASTQ (either .fastq.gz or .fastq) or a single BAM (.bam)'
+            'All input files must be FASTQ (either .fastq.gz or .fastq) or BAM (.bam)'
         )
 
-    fastqs, technologies = result
-    if not technologies:
-        logger.error('Failed to detect technology')
-    elif len(technologies) == 1:
-        technology = technologies[0]
-        logger.info(f'Detected technology: {technology}')
-        print(technology.technology)
-        print(' '.join(fastqs[i] for i in technology.permutation))
-    else:
-        logger.warning(
-            f'Ambiguous technologies {", ".join(str(technology) for technology in technologies)}'
-        )
+    print_technologies(*result)
+    if args.profile:
+        write_profiles(args.files, args)
@@ -0,0 +1,454 @@
+import logging
+import os
+from collections import OrderedDict, namedtuple
+from functools import lru_cache
+from itertools import islice
+
+import numpy as np
+
+from .config import WHITELIST_CACHE_DIR
+from .resources import get_resources
+from .technologies import AnchoredSubstring
+from .utils import open_as_text
+
+logger = logging.getLogger(__name__)
+
+# Maps each ASCII character to its 2-bit encoding. Anything other than
+# A, C, G, T (in either case) can not be encoded and maps to 255.
+ENCODING = np.full(256, 255, dtype=np.uint8)
+for i, base in enumerate('ACGT'):
+    ENCODING[ord(base)] = i
+    ENCODING[ord(base.lower())] = i
+# Maximum length of a sequence that fits in a 64-bit integer.
+MAX_ENCODED_LENGTH = 32
+
+# A substring of a read, where `file` is the index of the physical FASTQ file
+# (as opposed to the read index of a ReadSubstring).
+Window = namedtuple('Window', ['file', 'start', 'stop'])
+# A window at a variable position, located relative to an anchor sequence, as
+# described by an AnchoredSubstring.
+AnchoredWindow = namedtuple(
+    'AnchoredWindow', [
+        'file', 'anchor', 'start', 'stop', 'search_start', 'search_stop',
+        'max_mismatches'
+    ]
+)
+
+
+def to_matrix(sequences, length=None):
+    """Convert a list of sequences into a 2D array of ASCII codes, one row per
+    sequence. Shorter sequences are padded to the right with spaces.
+
+    :param sequences: list of sequences
+    :type sequences: list
+    :param length: number of columns, defaults to `None`, which uses the length
+                   of the longest sequence
+    :type length: int, optional
+
+    :return: (matrix, lengths) tuple, where `lengths` contains the length of
+             each sequence
+    :rtype: tuple
+    """
+    lengths = np.fromiter((len(s) for s in sequences),
+                          dtype=np.int64,
+                          count=len(sequences))
+    length = length if length is not None else int(lengths.max(initial=0))
+    data = ''.join(s[:length].ljust(length) for s in sequences)
+    matrix = np.frombuffer(data.encode('ascii', 'replace'), dtype=np.uint8)
+    return matrix.reshape(len(sequences), length), lengths
+
+
+def encode(matrix):
+    """2-bit encode each row of a 2D array of ASCII codes into a 64-bit integer.
+
+    :param matrix: 2D array of ASCII codes with at most 32 columns
+    :type matrix: numpy.ndarray
+
+    :return: (codes, valid) tuple, where `valid` is `False` for any row that
+             contains a character that is not A, C, G or T
+    :rtype: tuple
+    """
+    if matrix.shape[1] > MAX_ENCODED_LENGTH:
+        raise Exception(
+            f'Sequences longer than {MAX_ENCODED_LENGTH} can not be encoded.'
+        )
+    values = ENCODING[matrix]
+    valid = (values != 255).all(axis=1)
+    codes = np.zeros(matrix.shape[0], dtype=np.uint64)
+    for j in range(matrix.shape[1]):
+        codes = (codes << np.uint64(2)) | values[:, j].astype(np.uint64)
+    return codes, valid
+
+
+def find_anchor(
+    matrix, lengths, anchor, search_start, search_stop, max_mismatches
+):
+    """Find the best match of an anchor sequence in each row of a 2D array of
+    ASCII codes. All rows and candidate positions are compared at once, one
+    anchor base at a time.
+
+    :param matrix: 2D array of ASCII codes, as returned by `to_matrix`
+    :type matrix: numpy.ndarray
+    :param lengths: length of each sequence
+    :type lengths: numpy.ndarray
+    :param anchor: anchor sequence
+    :type anchor: str
+    :param search_start: first position to search
+    :type search_start: int
+    :param search_stop: position to stop searching at, or `None` to search to
+                        the end of the sequences
+    :type search_stop: int
+    :param max_mismatches: maximum number of mismatches
+    :type max_mismatches: int
+
+    :return: (positions, found) tuple, where `positions` contains the start of
+             the best match in each row, and `found` is `False` for rows
+             without a match
+    :rtype: tuple
+    """
+    n, width = matrix.shape
+    stop = width if search_stop is None else min(search_stop, width)
+    n_positions = stop - len(anchor) - search_start + 1
+    if n_positions <= 0:
+        return np.zeros(n, dtype=np.int64), np.zeros(n, dtype=bool)
+
+    target = np.frombuffer(anchor.upper().encode(), dtype=np.uint8)
+    mismatches = np.zeros((n, n_positions), dtype=np.int64)
+    for j, base in enumerate(target):
+        start = search_start + j
+        mismatches += matrix[:, start:start + n_positions] != base
+    best = mismatches.argmin(axis=1)
+    positions = search_start + best
+    found = (mismatches[np.arange(n), best] <= max_mismatches) & (
+        positions + len(anchor) <= lengths
+    )
+    return positions, found
+
+
+def extract_anchored(matrix, lengths, positions, found, start, stop):
+    """Extract a window at a different position in each row of a 2D array of
+    ASCII codes.
+
+    :param matrix: 2D array of ASCII codes, as returned by `to_matrix`
+    :type matrix: numpy.ndarray
+    :param lengths: length of each sequence
+    :type lengths: numpy.ndarray
+    :param positions: position of the anchor in each row
+    :type positions: numpy.ndarray
+    :param found: whether the anchor was found in each row
+    :type found: numpy.ndarray
+    :param start: start of the window, relative to the anchor
+    :type start: int
+    :param stop: end of the window, relative to the anchor
+    :type stop: int
+
+    :return: (window, valid) tuple, where `window` is a 2D array of ASCII codes
+             and `valid` is `False` for rows without the anchor or where the
+             window does not fit in the sequence
+    :rtype: tuple
+    """
+    columns = positions[:, None] + np.arange(start, stop)
+    valid = found & (positions + start >= 0) & (positions + stop <= lengths)
+    columns = np.clip(columns, 0, max(matrix.shape[1] - 1, 0))
+    return matrix[np.arange(matrix.shape[0])[:, None], columns], valid
+
+
+def load_whitelist(path, mode=None):
+    """Load a whitelist as a sorted array of 2-bit encoded barcodes. Loaded
+    whitelists are cached.
+
+    In `mmap` mode, the encoded barcodes are saved to `WHITELIST_CACHE_DIR` the
+    first time the whitelist is loaded, and memory-mapped from there, so that
+    they do not need to be kept in memory.
+
+    :param path: path to whitelist
+    :type path: str
+    :param mode: either `memory` or `mmap`, defaults to `None`, which uses the
+                 whitelist mode of the planned resources
+    :type mode: str, optional
+
+    :return: sorted array of encoded barcodes
+    :rtype: numpy.ndarray
+    """
+    return _load_whitelist(path, mode or get_resources().whitelist_mode)
+
+
+def encode_whitelist(path, chunk_size=1 << 20):
+    """Encode a whitelist, `chunk_size` barcodes at a time.
+
+    :param path: path to whitelist
+    :type path: str
+    :param chunk_size: number of barcodes to encode at once, defaults to
+                       `1048576`
+    :type chunk_size: int, optional
+
+    :return: sorted array of encoded barcodes
+    :rtype: numpy.ndarray
+    """
+    chunks = []
+    with open_as_text(path, 'r') as f:
+        while True:
+            barcodes = [
+                line.strip() for line in islice(f, chunk_size) if line.strip()
+            ]
+            if not barcodes:
+                break
+            codes, valid = encode(to_matrix(barcodes)[0])
+            chunks.append(codes[valid])
+    if not chunks:
+        return np.array([], dtype=np.uint64)
+    return np.unique(np.concatenate(chunks))
+
+
+@lru_cache(maxsize=None)
+def _load_whitelist(path, mode):
+    logger.debug(f'Loading whitelist {path} ({mode})')
+    if mode != 'mmap':
+        return encode_whitelist(path)
+
+    stat = os.stat(path)
+    cache_path = os.path.join(
+        WHITELIST_CACHE_DIR,
+        f'{os.path.basename(path)}.{stat.st_size}.{int(stat.st_mtime)}.npy'
+    )
+    if not os.path.exists(cache_path):
+        os.makedirs(WHITELIST_CACHE_DIR, exist_ok=True)
+        temp_path = f'{cache_path}.{os.getpid()}.tmp'
+        with open(temp_path, 'wb') as f:
+            np.save(f, encode_whitelist(path))
+        os.replace(temp_path, cache_path)
+    return np.load(cache_path, mmap_mode='r')
+
+
+def lookup(codes, whitelist):
+    """Check which encoded barcodes are in an encoded whitelist.
+
+    :param codes: array of encoded barcodes
+    :type codes: numpy.ndarray
+    :param whitelist: sorted array of encoded barcodes
+    :type whitelist: numpy.ndarray
+
+    :return: boolean array that is `True` for barcodes in the whitelist
+    :rtype: numpy.ndarray
+    """
+    if len(whitelist) == 0:
+        return np.zeros(len(codes), dtype=bool)
+    indices = np.searchsorted(whitelist, codes)
+    indices[indices == len(whitelist)] = 0
+    return whitelist[indices] == codes
+
+
+class ExtractionPlan:
+    """Compiled plan to extract and check barcodes for a list of
+    OrderedTechnology objects at once.
+
+    Many technologies and FASTQ orderings read their barcodes from the same
+    positions of the same physical file. The plan deduplicates these windows,
+    so that each distinct window is extracted and encoded once, and each
+    distinct (windows, whitelist) pair is looked up once, per batch of reads.
+
+    :param technologies: list of OrderedTechnology objects
+    :type technologies: list
+    """
+
+    def __init__(self, technologies):
+        self.technologies = list(technologies)
+        self.windows = []
+        self.window_indices = {}
+        # Indices of all windows (barcode and UMI) that must be fully
+        # contained in the reads for each ordered technology.
+        self.required = []
+        # Distinct (tuple of barcode window indices, whitelist path) pairs as
+        # keys and the indices of ordered technologies that use them as values.
+        self.lookups = OrderedDict()
+        # Lookups that must all match for each ordered technology. There is
+        # one lookup per barcode segment for combinatorial barcodes.
+        self.checks = []
+        missing = set()
+        for i, ordered in enumerate(self.technologies):
+            technology = ordered.technology
+            permutation = ordered.permutation
+            barcode_windows = tuple(
+                self._add_window(permutation, substring)
+                for substring in technology.barcode_positions
+            )
+            umi_windows = tuple(
+                self._add_window(permutation, substring)
+                for substring in technology.umi_positions
+            )
+            self.required.append(barcode_windows + umi_windows)
+            lengths = [
+                substring.stop - substring.start
+                for substring in technology.barcode_positions
+            ]
+            if technology.segment_whitelist_paths:
+                keys = [
+                    ((window,), path) for window, path in
+                    zip(barcode_windows, technology.segment_whitelist_paths)
+                ]
+            else:
+                lengths = [sum(lengths)]
+                keys = [(barcode_windows, technology.whitelist_path)]
+            if max(lengths, default=0) > MAX_ENCODED_LENGTH:
+                raise Exception(
+                    f'Barcodes of technology {technology} are too long.'
+                )
+
+            paths = [path for _, path in keys]
+            if not all(paths):
+                self.checks.append([])
+                continue
+            absent = [path for path in paths if not os.path.exists(path)]
+            if absent:
+                for path in set(absent) - missing:
+                    missing.add(path)
+                    logger.warning((
+                        f'Whitelist {path} for technology '
+                        f'{technology} does not exist. Skipping.'
+                    ))
+                self.checks.append([])
+                continue
+            for key in keys:
+                self.lookups.setdefault(key, []).append(i)
+            self.checks.append(keys)
+        # Windows that need to be encoded.
+        self.encoded = sorted({
+            window
+            for windows, _ in self.lookups.keys()
+            for window in windows
+        })
+        logger.debug((
+            f'Compiled {len(self.technologies)} technologies into '
+            f'{len(self.windows)} distinct windows and '
+            f'{len(self.lookups)} distinct whitelist lookups'
+        ))
+
+    def _add_window(self, permutation, substring):
+        """Helper function to add a window to the plan, if it has not been
+        added already, and return its index.
+        """
+        # If the permutation is [1, 0, 2], then read 0 is from fastq 1,
+        # read 1 is from fastq 0, and read 2 is from fastq 2
+        if isinstance(substring, AnchoredSubstring):
+            window = AnchoredWindow(permutation[substring.file], *substring[1:])
+        else:
+            window = Window(
+                permutation[substring.file], substring.start, substring.stop
+            )
+        if window not in self.window_indices:
+            self.window_indices[window] = len(self.windows)
+            self.windows.append(window)
+        return self.window_indices[window]
+
+    def count(self, reads):
+        """Count the number of barcodes that are in each technology's whitelist.
+
+        :param reads: list of lists of synchronized reads, one list per FASTQ
+        :type reads: list
+
+        :return: (counts, n, invalid) tuple, where `counts` is an array of the
+                 number of matching barcodes for each ordered technology,
+                 `n` is the number of reads, and `invalid` is a boolean
+                 array that is `True` for technologies whose barcode or UMI
+                 positions do not fit in the reads
+        :rtype: tuple
+        """
+        n = min(len(rs) for rs in reads) if reads else 0
+        matrices = {}
+        lengths = {}
+        for file in {window.file for window in self.windows}:
+            if file < len(reads):
+                matrices[file], lengths[file] = to_matrix(reads[file][:n])
+
+        # Check each distinct window once. Whether anchored windows fit
+        # depends on each read, which is checked when they are extracted.
+        fits = []
+        for window in self.windows:
+            if isinstance(window, AnchoredWindow):
+                fits.append(window.file in lengths and n > 0)
+            else:
+                fits.append(
+                    window.file in lengths and n > 0
+                    and bool((lengths[window.file] >= window.stop).all())
+                    and bool((lengths[window.file] > window.start).all())
+                )
+        invalid = np.array([
+            not all(fits[w] for w in windows) for windows in self.required
+        ],
+                           dtype=bool)
+
+        # Encode each distinct window once, and search for each distinct
+        # anchor once.
+        codes = {}
+        anchors = {}
+        for w in self.encoded:
+            if not fits[w]:
+                continue
+            window = self.windows[w]
+            matrix = matrices[window.file]
+            if isinstance(window, AnchoredWindow):
+                key = (window.file,) + window[1:2] + window[4:]
+                if key not in anchors:
+                    anchors[key] = find_anchor(
+                        matrix, lengths[window.file], *key[1:]
+                    )
+                extracted, found = extract_anchored(
+                    matrix, lengths[window.file], *anchors[key], window.start,
+                    window.stop
+                )
+                window_codes, valid = encode(extracted)
+                codes[w] = (window_codes, valid & found)
+            else:
+                codes[w] = encode(matrix[:, window.start:window.stop])
+
+        # Look up each distinct (windows, whitelist) pair once.
+        matches = {}
+        for windows, whitelist_path in self.lookups.keys():
+            if not all(fits[w] for w in windows):
+                continue
+            combined, valid = codes[windows[0]]
+            for w in windows[1:]:
+                window = self.windows[w]
+                shift = np.uint64(2 * (window.stop - window.start))
+                combined = (combined << shift) | codes[w][0]
+                valid = valid & codes[w][1]
+            matches[
+                (windows, whitelist_path)
+            ] = lookup(combined, load_whitelist(whitelist_path)) & valid
+
+        # A read matches a technology if all of its lookups match.
+        counts = np.zeros(len(self.technologies), dtype=np.int64)
+        sums = {}
+        for i, keys in enumerate(self.checks):
+            if not keys or not all(key in matches for key in keys):
+                continue
+            if len(keys) == 1:
+                if keys[0] not in sums:
+                    sums[keys[0]] = int(matches[keys[0]].sum())
+                counts[i] = sums[keys[0]]
+            else:
+                counts[i] = int(
+                    np.logical_and.reduce([matches[key] for key in keys]).sum()
+                )
+        return counts, n, invalid
+
+
+_plans = {}
+
+
+def compile_plan(technologies):
+    """Compile an ExtractionPlan for a list of OrderedTechnology objects.
+    Compiled plans are cached, so that each list of technologies is compiled
+    only once per process.
+
+    :param technologies: list of OrderedTechnology objects
+    :type technologies: list
+
+    :return: the compiled plan
+    :rtype: ExtractionPlan
+    """
+    # Technologies contain lists, so they can not be hashed directly.
+    key = tuple(repr(ordered) for ordered in technologies)
+    if key not in _plans:
+        _plans[key] = ExtractionPlan(technologies)
+    return _plans[key]
@@ -0,0 +1,268 @@
+import json
+import logging
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from urllib.parse import urlparse
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+from .compression import open_decompressed
+from .config import PROFILE_CHUNK_SIZE
+
+logger = logging.getLogger(__name__)
+
+# Maps each ASCII character to the index of its base in BASES. Anything other
+# than A, C, G, T (in either case) is counted as an N.
+BASES = 'ACGTN'
+CODES = np.full(256, 4, dtype=np.uint8)
+for i, base in enumerate(BASES[:4]):
+    CODES[ord(base)] = i
+    CODES[ord(base.lower())] = i
+
+
+def _add(counts, values):
+    """Helper function to add an array of counts to another, along the first
+    axis, padding whichever is shorter with zeros.
+    """
+    if len(values) > len(counts):
+        counts = np.concatenate([
+            counts,
+            np.zeros((len(values) - len(counts),) + counts.shape[1:],
+                     dtype=counts.dtype)
+        ])
+    counts[:len(values)] += values
+    return counts
+
+
+class Profile:
+    """Running statistics of the reads of a FASTQ: histograms of read lengths,
+    of the lengths of poly-A tails (trailing A's) and poly-T heads (leading
+    T's), and of the number of N's per read, and the base composition of each
+    position. As in `fqc.is_single_cell`, N's are counted as part of poly-A
+    tails (and poly-T heads).
+
+    The histograms are arrays in which the `i`th element is the number of reads
+    with a value of `i`, and the composition is an array with a row for each
+    position and a column for each base in `BASES`.
+    """
+
+    def __init__(self):
+        self.n = 0
+        self.lengths = np.zeros(0, dtype=np.int64)
+        self.poly_a = np.zeros(0, dtype=np.int64)
+        self.poly_t = np.zeros(0, dtype=np.int64)
+        self.n_content = np.zeros(0, dtype=np.int64)
+        self.composition = np.zeros((0, len(BASES)), dtype=np.int64)
+
+    def update(self, data, newlines):
+        """Update the statistics with a chunk of complete FASTQ records.
+
+        :param data: bytes of the records
+        :type data: numpy.ndarray
+        :param newlines: indices of all newlines in `data`, which must be a
+                         multiple of 4 and include the last byte of `data`
+        :type newlines: numpy.ndarray
+        """
+        record_starts = np.concatenate([[0], newlines[3:-1:4] + 1])
+        if not (data[record_starts] == ord('@')).all() or not (
+                data[newlines[1::4] + 1] == ord('+')).all():
+            raise Exception('Invalid FASTQ record')
+        starts = newlines[0::4] + 1
+        ends = newlines[1::4]
+        # Ignore carriage returns of Windows line endings.
+        ends = ends - (data[ends - 1] == ord('\r'))
+        lengths = ends - starts
+        self.n += len(lengths)
+        self.lengths = _add(self.lengths, np.bincount(lengths))
+
+        # Reads are profiled in groups of lengths that are within a factor of
+        # 2 of each other (i.e. with the same number of bits), so that a few
+        # long reads do not pad all other reads to their length.
+        padded = np.concatenate([
+            data, np.zeros(int(lengths.max()), dtype=np.uint8)
+        ])
+        groups = np.frexp(lengths)[1]
+        for group in np.unique(groups):
+            selected = groups == group
+            self._update(padded, starts[selected], lengths[selected])
+
+    def _update(self, padded, starts, lengths):
+        """Helper method to update the statistics, except for the read lengths,
+        with reads of similar lengths.
+
+        :param padded: bytes of the records, followed by at least as many zeros
+                       as the length of the longest read
+        :type padded: numpy.ndarray
+        :param starts: indices of the first base of each read in `padded`
+        :type starts: numpy.ndarray
+        :param lengths: length of each read
+        :type lengths: numpy.ndarray
+        """
+        length = int(lengths.max())
+        if length == 0:
+            self.poly_a = _add(self.poly_a, [len(lengths)])
+            self.poly_t = _add(self.poly_t, [len(lengths)])
+            self.n_content = _add(self.n_content, [len(lengths)])
+            return
+
+        # Copy the sequences into a matrix with a row per read, through a view
+        # of the data with a row starting at every byte. Positions past the end
+        # of shorter reads are set to 5.
+        windows = as_strided(
+            padded, (len(padded) - length + 1, length), (1, 1), writeable=False
+        )
+        codes = CODES.take(windows[starts])
+        if lengths.min() < length:
+            codes[np.arange(length) >= lengths[:, None]] = 5
+
+        # The number of N's at each position is the number of reads that
+        # cover it minus the number of other bases.
+        composition = np.zeros((length, len(BASES)), dtype=np.int64)
+        for i in range(len(BASES) - 1):
+            composition[:, i] = np.count_nonzero(codes == i, axis=0)
+        covered = len(lengths) - np.cumsum(np.bincount(lengths))[:length]
+        composition[:, -1] = covered - composition.sum(axis=1)
+        n_content = np.count_nonzero(codes == 4, axis=1)
+
+        # The poly-A tail ends at the last base (before any padding) that is
+        # not an A or N, and the poly-T head at the first base that is not a T
+        # or N. `argmin` finds the first `False`, and is 0 if there is none.
+        rows = np.arange(len(lengths))
+        is_a = (codes == 0) | (codes >= 4)
+        trailing = np.argmin(is_a[:, ::-1], axis=1)
+        trailing[is_a[rows, length - 1 - trailing]] = length
+        poly_a = trailing - (length - lengths)
+        is_t = (codes == 3) | (codes == 4)
+        poly_t = np.argmin(is_t, axis=1)
+        poly_t[is_t[rows, poly_t]] = length
+
+        self.poly_a = _add(self.poly_a, np.bincount(poly_a))
+        self.poly_t = _add(self.poly_t, np.bincount(poly_t))
+        self.n_content = _add(self.n_content, np.bincount(n_content))
+        self.composition = _add(self.composition, composition)
+
+    def to_dict(self):
+        """Convert the statistics into a dictionary that can be serialized to
+        JSON.
+
+        :return: dictionary with the number of reads and bases, the histograms
+                 as lists, and the composition as a dictionary with bases as
+                 keys and lists of counts per position as values
+        :rtype: dict
+        """
+        return OrderedDict([
+            ('reads', self.n),
+            ('bases', int(self.composition.sum())),
+            ('lengths', self.lengths.tolist()),
+            ('poly_a', self.poly_a.tolist()),
+            ('poly_t', self.poly_t.tolist()),
+            ('n_content', self.n_content.tolist()),
+            (
+                'composition',
+                OrderedDict((base, self.composition[:, i].tolist())
+                            for i, base in enumerate(BASES))
+            ),
+        ])
+
+
+def profile_fastq(path, chunk_size=PROFILE_CHUNK_SIZE):
+    """Profile all reads of a local FASTQ in a single pass. The FASTQ is read
+    `chunk_size` bytes at a time, and each chunk of complete records is
+    profiled at once with numpy while the next chunk is decompressed, so that
+    profiling keeps up with decompression.
+
+    :param path: path to FASTQ
+    :type path: str
+    :param chunk_size: number of bytes to read at once, defaults to `4194304`
+    :type chunk_size: int, optional
+
+    :return: the profile
+    :rtype: Profile
+    """
+    if urlparse(path).scheme:
+        raise Exception(f'Only local FASTQs can be profiled, not {path}')
+    start = time.time()
+    profile = Profile()
+    remainder = b''
+    if path.endswith('.gz'):
+        f = open_decompressed(path, 'rb')
+    else:
+        f = open(path, 'rb')
+    # The next chunk is read (and decompressed) in another thread while the
+    # current one is profiled.
+    with f, ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(f.read, chunk_size)
+        while True:
+            chunk = future.result()
+            if chunk:
+                future = executor.submit(f.read, chunk_size)
+            data = remainder + chunk
+            if not chunk and data and not data.endswith(b'\n'):
+                # The last line may not end with a newline.
+                data += b'\n'
+            array = np.frombuffer(data, dtype=np.uint8)
+            newlines = np.flatnonzero(array == ord('\n'))
+            n = len(newlines) // 4 * 4
+            end = int(newlines[n - 1]) + 1 if n else 0
+            if n:
+                try:
+                    profile.update(array[:end], newlines[:n])
+                except Exception as e:
+                    raise Exception(f'Failed to profile {path}: {e}')
+            remainder = data[end:]
+            if not chunk:
+                break
+    if remainder.strip():
+        raise Exception(f'{path} ends with an incomplete record')
+    logger.debug(
+        f'Profiled {profile.n} reads of {path} in {time.time() - start:.2f} '
+        'seconds'
+    )
+    return profile
+
+
+def profile_fastqs(paths, processes=4, chunk_size=PROFILE_CHUNK_SIZE):
+    """Profile multiple FASTQs in parallel, with `profile_fastq`.
+
+    :param paths: paths to FASTQs
+    :type paths: list
+    :param processes: number of FASTQs to profile in parallel, defaults to `4`
+    :type processes: int, optional
+    :param chunk_size: number of bytes to read at once, defaults to `4194304`
+    :type chunk_size: int, optional
+
+    :return: ordered dictionary with paths as keys and profiles as values
+    :rtype: OrderedDict
+    """
+    with ProcessPoolExecutor(max_workers=max(1, min(processes, len(paths)))
+                             ) as executor:
+        futures = OrderedDict(
+            (path, executor.submit(profile_fastq, path, chunk_size))
+            for path in paths
+        )
+        return OrderedDict((path, future.result())
+                           for path, future in futures.items())
+
+
+def write_report(profiles, path):
+    """Write profiles to a JSON report, with FASTQs as keys and the
+    dictionaries of `Profile.to_dict` as values.
+
+    :param profiles: ordered dictionary with paths as keys and profiles as
+                     values, as returned by `profile_fastqs`
+    :type profiles: OrderedDict
+    :param path: path to report
+    :type path: str
+
+    :return: path to report
+    :rtype: str
+    """
+    with open(path, 'w') as f:
+        json.dump(
+            OrderedDict((fastq, profile.to_dict())
+                        for fastq, profile in profiles.items()), f
+        )
+        f.write('\n')
+    return path
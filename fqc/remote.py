@@ -0,0 +1,361 @@
+import asyncio
+import concurrent.futures
+import io
+import logging
+import os
+import ssl
+import tempfile
+import threading
+from functools import partial
+from urllib.parse import urljoin, urlparse
+from urllib.request import urlopen
+
+from . import __version__
+from .bgzf import BGZF_EOF, bgzf_complete_length, is_bgzf
+from .config import BAM_HEAD_BYTES, REMOTE_CONCURRENCY, REMOTE_TIMEOUT
+
+logger = logging.getLogger(__name__)
+
+MAX_REDIRECTS = 5
+READ_AHEAD_BYTES = 1 << 20
+
+
+def is_remote(path):
+    """Determine whether a path is a url.
+
+    :param path: path or url
+    :type path: str
+
+    :return: whether or not the path is remote
+    :rtype: bool
+    """
+    return bool(urlparse(path).scheme)
+
+
+class StreamReader(io.RawIOBase):
+    """Blocking file-like view of an asyncio stream, to be read from a worker
+    thread while the event loop (running in another thread) does the network I/O.
+
+    :param reader: stream to read from
+    :type reader: asyncio.StreamReader
+    :param loop: event loop that owns the stream
+    :type loop: asyncio.AbstractEventLoop
+    :param timeout: seconds to wait for any single read, defaults to `None`
+    :type timeout: float, optional
+    :param url: url of the stream, used for error messages, defaults to `None`
+    :type url: str, optional
+    """
+
+    def __init__(self, reader, loop, timeout=None, url=None):
+        super().__init__()
+        self.reader = reader
+        self.loop = loop
+        self.timeout = timeout
+        self.url = url
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        future = asyncio.run_coroutine_threadsafe(
+            self.reader.read(len(b)), self.loop
+        )
+        try:
+            data = future.result(self.timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise Exception(
+                f'Timed out after {self.timeout} seconds reading {self.url}'
+            )
+        b[:len(data)] = data
+        return len(data)
+
+
+async def open_url(
+    url, nbytes=None, redirects=MAX_REDIRECTS, limit=READ_AHEAD_BYTES
+):
+    """Open an http or https url as an asyncio stream, following redirects.
+
+    HTTP/1.0 is used so that the server never chunks the response body, and
+    closes the connection when the body is done.
+
+    :param url: url to open
+    :type url: str
+    :param nbytes: only request the first `nbytes` bytes, defaults to `None`
+    :type nbytes: int, optional
+    :param redirects: maximum number of redirects to follow, defaults to `5`
+    :type redirects: int, optional
+    :param limit: number of bytes to read ahead of the consumer, defaults to
+                  `1048576`
+    :type limit: int, optional
+
+    :return: (reader, writer) tuple positioned at the start of the body
+    :rtype: tuple
+    """
+    parse = urlparse(url)
+    https = parse.scheme == 'https'
+    port = parse.port or (443 if https else 80)
+    reader, writer = await asyncio.open_connection(
+        parse.hostname,
+        port,
+        ssl=ssl.create_default_context() if https else None,
+        limit=limit
+    )
+    path = parse.path or '/'
+    if parse.query:
+        path = f'{path}?{parse.query}'
+    headers = [
+        f'GET {path} HTTP/1.0',
+        f'Host: {parse.netloc}',
+        f'User-Agent: fqc/{__version__}',
+    ]
+    if nbytes is not None:
+        headers.append(f'Range: bytes=0-{nbytes - 1}')
+    writer.write(('\r\n'.join(headers) + '\r\n\r\n').encode('latin-1'))
+    await writer.drain()
+
+    status_line = (await reader.readline()).decode('latin-1').strip()
+    try:
+        status = int(status_line.split()[1])
+    except (IndexError, ValueError):
+        writer.close()
+        raise Exception(f'Invalid HTTP response from {url}: {status_line}')
+    location = None
+    while True:
+        line = (await reader.readline()).decode('latin-1').strip()
+        if not line:
+            break
+        key, _, value = line.partition(':')
+        if key.strip().lower() == 'location':
+            location = value.strip()
+
+    if 300 <= status < 400 and location:
+        writer.close()
+        if redirects <= 0:
+            raise Exception(f'Too many redirects while opening {url}')
+        location = urljoin(url, location)
+        logger.debug(f'Following redirect from {url} to {location}')
+        return await open_url(location, nbytes, redirects - 1, limit)
+    if not 200 <= status < 300:
+        writer.close()
+        raise Exception(f'Failed to fetch {url}: {status_line}')
+    return reader, writer
+
+
+async def fetch(
+    url, parse, semaphore, executor, nbytes=None, timeout=REMOTE_TIMEOUT
+):
+    """Fetch a single url and parse its body in a worker thread.
+
+    :param url: url to fetch
+    :type url: str
+    :param parse: function that is called with a binary file object of the
+                  body, and whose return value is returned
+    :type parse: callable
+    :param semaphore: semaphore bounding the number of open connections
+    :type semaphore: asyncio.Semaphore
+    :param executor: executor to run `parse` in
+    :type executor: concurrent.futures.Executor
+    :param nbytes: only fetch the first `nbytes` bytes, defaults to `None`
+    :type nbytes: int, optional
+    :param timeout: seconds to wait for a connection or for any single read,
+                    defaults to `60`
+    :type timeout: float, optional
+
+    :return: the return value of `parse`
+    """
+    loop = asyncio.get_event_loop()
+    async with semaphore:
+        if urlparse(url).scheme not in ('http', 'https'):
+            # Let urllib deal with any other schemes (i.e. ftp).
+            def _parse():
+                with urlopen(url, timeout=timeout) as f:
+                    return parse(f)
+
+            return await loop.run_in_executor(executor, _parse)
+
+        logger.debug(f'Fetching {url}')
+        try:
+            reader, writer = await asyncio.wait_for(
+                open_url(url, nbytes), timeout
+            )
+        except asyncio.TimeoutError:
+            raise Exception(
+                f'Timed out after {timeout} seconds connecting to {url}'
+            )
+        try:
+            f = StreamReader(reader, loop, timeout=timeout, url=url)
+            return await loop.run_in_executor(executor, parse, f)
+        finally:
+            writer.close()
+
+
+def fetch_all(
+    urls,
+    parse,
+    nbytes=None,
+    concurrency=REMOTE_CONCURRENCY,
+    timeout=REMOTE_TIMEOUT
+):
+    """Concurrently fetch and parse a list of urls. Network I/O is done by an
+    asyncio event loop, while decompression and parsing happen in a pool of
+    worker threads, so the total time approaches that of the slowest url.
+
+    :param urls: list of urls
+    :type urls: list
+    :param parse: function that is called with each url and a binary file
+                  object of its body, and whose return value is returned
+    :type parse: callable
+    :param nbytes: only fetch the first `nbytes` bytes, defaults to `None`
+    :type nbytes: int, optional
+    :param concurrency: maximum number of simultaneous connections, defaults to `8`
+    :type concurrency: int, optional
+    :param timeout: seconds to wait for a connection or for any single read,
+                    defaults to `60`
+    :type timeout: float, optional
+
+    :return: list of return values of `parse`, in the same order as `urls`
+    :rtype: list
+    """
+    if not urls:
+        return []
+
+    async def _fetch_all(executor):
+        # The semaphore must be created inside the running loop.
+        semaphore = asyncio.Semaphore(concurrency)
+        return await asyncio.gather(
+            *(
+                fetch(
+                    url,
+                    partial(parse, url),
+                    semaphore,
+                    executor,
+                    nbytes=nbytes,
+                    timeout=timeout
+                ) for url in urls
+            )
+        )
+
+    loop = asyncio.new_event_loop()
+    try:
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=max(1, min(concurrency, len(urls)))) as executor:
+            return loop.run_until_complete(_fetch_all(executor))
+    finally:
+        loop.close()
+
+
+class RemoteFiles:
+    """Context manager that concurrently opens a list of urls as blocking
+    binary file objects. An event loop in a background thread keeps reading
+    ahead on all http and https connections, so that the files can be consumed
+    in lockstep (i.e. synchronized FASTQs) without paying each file's network
+    latency in turn. Urls with any other scheme (i.e. ftp) are opened with
+    urllib, concurrently in worker threads.
+
+    :param urls: list of urls
+    :type urls: list
+    :param timeout: seconds to wait for a connection or for any single read,
+                    defaults to `60`
+    :type timeout: float, optional
+    """
+
+    def __init__(self, urls, timeout=REMOTE_TIMEOUT):
+        self.urls = urls
+        self.timeout = timeout
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(
+            target=self.loop.run_forever, daemon=True
+        )
+        self.writers = []
+        self.responses = []
+
+    async def _open(self, url):
+        """Helper method to open a single url, as a tuple of an asyncio stream
+        and its writer for http and https, or of a file object and `None`.
+        """
+        if urlparse(url).scheme in ('http', 'https'):
+            return await asyncio.wait_for(open_url(url), self.timeout)
+        response = await self.loop.run_in_executor(
+            None, partial(urlopen, url, timeout=self.timeout)
+        )
+        return response, None
+
+    def __enter__(self):
+        self.thread.start()
+        try:
+            futures = [
+                asyncio.run_coroutine_threadsafe(self._open(url), self.loop)
+                for url in self.urls
+            ]
+            files = []
+            for url, future in zip(self.urls, futures):
+                try:
+                    reader, writer = future.result()
+                except (asyncio.TimeoutError, concurrent.futures.TimeoutError):
+                    raise Exception(
+                        f'Timed out after {self.timeout} seconds connecting to {url}'
+                    )
+                if writer is None:
+                    self.responses.append(reader)
+                    files.append(reader)
+                    continue
+                self.writers.append(writer)
+                files.append(
+                    StreamReader(
+                        reader, self.loop, timeout=self.timeout, url=url
+                    )
+                )
+            return files
+        except Exception:
+            self.__exit__()
+            raise
+
+    def __exit__(self, *args):
+        for response in self.responses:
+            response.close()
+        for writer in self.writers:
+            self.loop.call_soon_threadsafe(writer.close)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+
+def _parse_head(url, f, nbytes):
+    """Helper function to write up to `nbytes` bytes of a binary stream to a
+    temporary file. If the stream is BGZF-compressed (i.e. a BAM), the file is
+    truncated to the last complete block and terminated with an EOF block, so
+    that it can be read as a valid (but shorter) file.
+    """
+    suffix = os.path.splitext(urlparse(url).path)[1]
+    data = bytearray()
+    while len(data) < nbytes:
+        chunk = f.read(min(nbytes - len(data), 1 << 16))
+        if not chunk:
+            break
+        data.extend(chunk)
+
+    if is_bgzf(data):
+        data = data[:bgzf_complete_length(data)] + BGZF_EOF
+    with tempfile.NamedTemporaryFile(suffix=suffix, delete=False) as out:
+        out.write(data)
+    return out.name
+
+
+def fetch_heads(urls, nbytes=BAM_HEAD_BYTES, **kwargs):
+    """Concurrently download the first `nbytes` bytes of each of a list of urls
+    into temporary files. For BAMs, this is enough to read the header and the
+    first few records locally.
+
+    :param urls: list of urls
+    :type urls: list
+    :param nbytes: number of bytes to download, defaults to `1048576`
+    :type nbytes: int, optional
+    :param **kwargs: additional keyword arguments to `fetch_all`
+
+    :return: list of paths to temporary files, in the same order as `urls`
+    :rtype: list
+    """
+    return fetch_all(
+        urls, partial(_parse_head, nbytes=nbytes), nbytes=nbytes, **kwargs
+    )
@@ -0,0 +1,193 @@
+import gzip
+import logging
+import os
+import struct
+from collections import namedtuple
+
+from .config import (
+    BATCH_SIZE,
+    BGZF_TASK_MEMORY,
+    MAX_BUFFERED_BYTES,
+    MAX_MEMORY,
+    MIN_BATCH_SIZE,
+    PROCESS_MEMORY,
+    SPOT_MEMORY,
+    THREADS,
+)
+from .technologies import TECHNOLOGIES
+
+logger = logging.getLogger(__name__)
+
+# How a budget of threads and memory is spent. `processes` is the number of
+# samples or BAMs processed in parallel, each with `threads` threads and its
+# share of the memory. `queue_depth` is the number of groups of BGZF blocks in
+# flight per file, and `whitelist_mode` is either `memory` to load whitelists
+# into memory or `mmap` to memory-map them from disk.
+Resources = namedtuple(
+    'Resources', [
+        'threads', 'max_memory', 'processes', 'batch_size', 'queue_depth',
+        'max_buffered', 'whitelist_mode'
+    ]
+)
+
+_resources = None
+
+
+def whitelist_paths():
+    """Get the paths to all whitelists of all technologies that exist.
+
+    :return: sorted list of paths
+    :rtype: list
+    """
+    paths = set()
+    for technology in TECHNOLOGIES:
+        for path in [technology.whitelist_path] + list(
+                technology.segment_whitelist_paths or []):
+            if path and os.path.exists(path):
+                paths.add(path)
+    return sorted(paths)
+
+
+def whitelist_memory(path):
+    """Estimate the memory used by a loaded whitelist, from its barcode length
+    and its uncompressed size, without reading the whole file. The uncompressed
+    size of a gzip file is in its last four bytes.
+
+    :param path: path to whitelist
+    :type path: str
+
+    :return: estimated size in bytes
+    :rtype: int
+    """
+    if path.endswith('.gz'):
+        with gzip.open(path, 'rt') as f:
+            length = len(f.readline().strip())
+        with open(path, 'rb') as f:
+            f.seek(-4, os.SEEK_END)
+            size = struct.unpack('<I', f.read(4))[0]
+    else:
+        with open(path, 'r') as f:
+            length = len(f.readline().strip())
+        size = os.path.getsize(path)
+    # One 64-bit code per barcode.
+    return 8 * (size // (length + 1))
+
+
+def plan_resources(threads=THREADS, max_memory=MAX_MEMORY, jobs=1):
+    """Fit worker pools, batch sizes, queue depths and the representation of
+    whitelists into a budget of threads and memory. Whenever the budget forces
+    a slower strategy, such as smaller batches or memory-mapped whitelists, a
+    warning is logged.
+
+    :param threads: total number of threads, defaults to the number of cpus
+    :type threads: int, optional
+    :param max_memory: total memory in bytes, defaults to `None`, which does not
+                       limit memory
+    :type max_memory: int, optional
+    :param jobs: number of samples or BAMs that could be processed in parallel,
+                 defaults to `1`
+    :type jobs: int, optional
+
+    :return: the planned resources
+    :rtype: Resources
+    """
+    threads = max(threads, 1)
+    processes = max(min(jobs, threads), 1)
+    if max_memory is None:
+        return Resources(
+            threads=max(threads // processes, 1),
+            max_memory=None,
+            processes=processes,
+            batch_size=BATCH_SIZE,
+            queue_depth=2 * max(threads // processes, 1),
+            max_buffered=MAX_BUFFERED_BYTES,
+            whitelist_mode='memory',
+        )
+
+    # Every process loads its own whitelists, so run fewer processes than
+    # requested if they do not all fit.
+    whitelists = sum(whitelist_memory(path) for path in whitelist_paths())
+    fit = max_memory // (PROCESS_MEMORY + whitelists + BATCH_SIZE * SPOT_MEMORY)
+    if fit < processes and processes > 1:
+        logger.warning((
+            f'Processing {max(fit, 1)} instead of {processes} samples or BAMs '
+            'in parallel to fit the memory limit'
+        ))
+        processes = max(fit, 1)
+    per_process = max(threads // processes, 1)
+    available = max_memory // processes - PROCESS_MEMORY
+
+    whitelist_mode = 'memory'
+    if whitelists > available // 2:
+        logger.warning((
+            f'Whitelists need about {whitelists / 1024**2:.0f} MB, which does '
+            'not fit the memory limit. Whitelists will be memory-mapped from '
+            'disk instead, which is slower.'
+        ))
+        whitelist_mode = 'mmap'
+    else:
+        available -= whitelists
+    available = max(available, 0)
+
+    batch_size = max(
+        min(BATCH_SIZE, available // 2 // SPOT_MEMORY), MIN_BATCH_SIZE
+    )
+    if batch_size < BATCH_SIZE:
+        logger.warning((
+            f'Reducing the number of reads per batch to {batch_size} to fit '
+            'the memory limit, which is slower'
+        ))
+    queue_depth = max(
+        min(2 * per_process, available // 8 // BGZF_TASK_MEMORY), 1
+    )
+    if queue_depth < per_process:
+        logger.info((
+            f'Decompressing at most {queue_depth} group(s) of BGZF blocks at '
+            f'once, with {per_process} threads, to fit the memory limit'
+        ))
+    max_buffered = max(min(MAX_BUFFERED_BYTES, available * 3 // 8), 1 << 20)
+    if max_buffered < MAX_BUFFERED_BYTES:
+        logger.info((
+            f'Buffering at most {max_buffered / 1024**2:.0f} MB of FASTQ records '
+            'when splitting BAMs, to fit the memory limit'
+        ))
+    return Resources(
+        threads=per_process,
+        max_memory=max_memory,
+        processes=processes,
+        batch_size=batch_size,
+        queue_depth=queue_depth,
+        max_buffered=max_buffered,
+        whitelist_mode=whitelist_mode,
+    )
+
+
+def set_resources(threads=THREADS, max_memory=MAX_MEMORY, jobs=1):
+    """Plan the resources to use, with `plan_resources`.
+
+    :param threads: total number of threads, defaults to the number of cpus
+    :type threads: int, optional
+    :param max_memory: total memory in bytes, defaults to `None`, which does not
+                       limit memory
+    :type max_memory: int, optional
+    :param jobs: number of samples or BAMs that could be processed in parallel,
+                 defaults to `1`
+    :type jobs: int, optional
+
+    :return: the planned resources
+    :rtype: Resources
+    """
+    global _resources
+    _resources = plan_resources(threads, max_memory, jobs)
+    logger.debug(f'Using resources: {_resources}')
+    return _resources
+
+
+def get_resources():
+    """Get the planned resources, planning them with the defaults if they have
+    not been planned yet.
+
+    :return: the planned resources
+    :rtype: Resources
+    """
+    return _resources or set_resources()
@@ -0,0 +1,192 @@
+import json
+import logging
+import os
+import socketserver
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from . import __version__
+from .client import is_running
+from .config import N_READS, SKIP_READS, SOCKET_PATH
+from .fqc import Detector, fqc_bam, fqc_fastq
+from .plan import load_whitelist
+from .resources import get_resources, set_resources, whitelist_paths
+from .technologies import TECHNOLOGIES
+
+logger = logging.getLogger(__name__)
+
+
+def warm():
+    """Load all whitelists and compile the extraction plans of all technologies,
+    so that they are cached before any requests are handled.
+    """
+    start = time.time()
+    for path in whitelist_paths():
+        load_whitelist(path)
+    for n_files in sorted({technology.n_files for technology in TECHNOLOGIES}):
+        Detector(n_files)
+    logger.debug(f'Loaded whitelists in {time.time() - start:.2f} seconds')
+
+
+def _init_worker(threads, max_memory):
+    """Helper function to plan the resources of, and warm, a worker process.
+    """
+    set_resources(threads, max_memory)
+    warm()
+
+
+def detect(paths, skip=SKIP_READS, n=N_READS):
+    """Detect the technology of FASTQs or a single BAM.
+
+    :param paths: paths to FASTQs, or to a single BAM
+    :type paths: list
+    :param skip: number of reads to skip at the beginning, defaults to `1000`
+    :type skip: int, optional
+    :param n: number of reads to consider, defaults to `100000`
+    :type n: int, optional
+
+    :return: list of dictionaries with the name and permutation of each detected
+             technology
+    :rtype: list
+    """
+    if len(paths) == 1 and paths[0].endswith('.bam'):
+        technology = fqc_bam(paths[0])
+        if technology is None:
+            return []
+        return [{
+            'technology': technology.name,
+            'permutation': list(range(technology.n_files))
+        }]
+    _, technologies = fqc_fastq(paths, skip, n)
+    return [{
+        'technology': ordered.technology.name,
+        'permutation': list(ordered.permutation)
+    } for ordered in technologies]
+
+
+def handle(message, executor):
+    """Handle a single request.
+
+    A request is a dictionary with a `command`, which is either `ping`,
+    `detect` (with `paths`, and optionally `skip` and `n`) or `shutdown`.
+
+    :param message: request
+    :type message: dict
+    :param executor: pool of workers to detect with
+    :type executor: concurrent.futures.Executor
+
+    :return: response, with a `status` that is either `ok` or `error`
+    :rtype: dict
+    """
+    command = message.get('command', 'detect')
+    if command in ('ping', 'shutdown'):
+        return {'status': 'ok', 'version': __version__, 'pid': os.getpid()}
+    if command != 'detect':
+        return {'status': 'error', 'error': f'Unknown command {command}'}
+
+    paths = message.get('paths')
+    if not paths or not isinstance(paths, list):
+        return {'status': 'error', 'error': 'No paths were provided'}
+    start = time.time()
+    try:
+        technologies = executor.submit(
+            detect, paths, message.get('skip', SKIP_READS),
+            message.get('n', N_READS)
+        ).result()
+    except Exception as e:
+        logger.error(f'Failed to detect {" ".join(paths)}: {e}')
+        return {'status': 'error', 'error': str(e)}
+    logger.info((
+        f'Detected {", ".join(t["technology"] for t in technologies) or "none"} '
+        f'for {" ".join(paths)} in {time.time() - start:.2f} seconds'
+    ))
+    return {'status': 'ok', 'technologies': technologies}
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    """Handle each line of a connection as a JSON request, and respond with a
+    line of JSON.
+    """
+
+    def handle(self):
+        for line in self.rfile:
+            shutdown = False
+            try:
+                message = json.loads(line.decode())
+                if not isinstance(message, dict):
+                    raise ValueError('Request is not an object')
+            except ValueError as e:
+                response = {'status': 'error', 'error': f'Invalid request: {e}'}
+            else:
+                response = handle(message, self.server.executor)
+                shutdown = message.get('command') == 'shutdown'
+            self.wfile.write((json.dumps(response) + '\n').encode())
+            self.wfile.flush()
+            if shutdown:
+                # `shutdown` waits for `serve_forever` to return, so it must be
+                # called from another thread.
+                threading.Thread(target=self.server.shutdown).start()
+                return
+
+
+class Server(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+def serve(path=SOCKET_PATH, processes=None):
+    """Serve detection requests on a Unix socket until a `shutdown` request is
+    received or the process is interrupted. Whitelists and compiled extraction
+    plans are kept in memory by a pool of worker processes, so that requests do
+    not need to load them again.
+
+    :param path: path to the Unix socket, defaults to `SOCKET_PATH`
+    :type path: str, optional
+    :param processes: number of worker processes, which is the number of
+                      requests that are handled in parallel, defaults to `None`,
+                      which uses the planned number of processes
+    :type processes: int, optional
+    """
+    if os.path.exists(path):
+        if is_running(path):
+            raise Exception(f'A server is already listening on {path}')
+        logger.warning(f'Removing stale socket {path}')
+        os.remove(path)
+
+    resources = get_resources()
+    processes = processes or resources.processes
+    max_memory = resources.max_memory
+    if max_memory is not None:
+        max_memory //= processes
+    # Whitelists are loaded before the workers are started, so that forked
+    # workers share them.
+    warm()
+    with ProcessPoolExecutor(max_workers=processes, initializer=_init_worker,
+                             initargs=(resources.threads,
+                                       max_memory)) as executor:
+        # Since Python 3.9, workers are only started when tasks are submitted
+        # and none is idle. Start all of them now, with tasks that keep them
+        # busy, so that none is forked after the server has started handling
+        # requests in other threads, which is unsafe.
+        list(executor.map(time.sleep, [0.1] * processes))
+
+        # Only allow the current user to connect. The socket is created with
+        # these permissions, instead of changing them after it is bound.
+        umask = os.umask(0o177)
+        try:
+            server = Server(path, RequestHandler)
+        finally:
+            os.umask(umask)
+        server.executor = executor
+        try:
+            logger.info(
+                f'Listening on {path} with {processes} worker processes'
+            )
+            server.serve_forever()
+        except KeyboardInterrupt:
+            logger.info('Interrupted')
+        finally:
+            server.server_close()
+            if os.path.exists(path):
+                os.remove(path)
+    logger.info('Server stopped')
@@ -4,15 +4,21 @@ from collections import namedtuple
 from .config import WHITELIST_DIR
 
 
-class Technology(
-        namedtuple('Technology',
-                   ['name', 'description', 'n_files', 'reads_file',
-                    'umi_positions', 'barcode_positions', 'whitelist_path'])):
+# For combinatorial barcodes, `segment_whitelist_paths` has a whitelist for
+# each of the `barcode_positions`, and each segment is checked against its own
+# whitelist instead of checking the joined barcode against `whitelist_path`.
+class Technology(namedtuple(
+        'Technology',
+    ['name', 'description', 'n_files', 'reads_file', 'umi_positions',
+     'barcode_positions', 'whitelist_path', 'segment_whitelist_paths'])):
 
     def __str__(self):
         return str(self.name)
 
 
+Technology.__new__.__defaults__ = (None,)
+
+
 # If the permutation is [1, 0, 2], then read 0 is from fastq 1,
 # read 1 is from fastq 0, and read 2 is from fastq 2
 class OrderedTechnology(namedtuple('OrderedTechnology',
@@ -23,6 +29,16 @@ class OrderedTechnology(namedtuple('OrderedTechnology',
 
 
 ReadSubstring = namedtuple('ReadSubstring', ['file', 'start', 'stop'])
+# A substring at a variable position, located relative to an anchor (i.e. a
+# linker) sequence. The anchor is searched for at positions
+# [search_start, search_stop) of the read, allowing up to `max_mismatches`
+# mismatches, and `start` and `stop` are relative to where the anchor starts.
+AnchoredSubstring = namedtuple(
+    'AnchoredSubstring', [
+        'file', 'anchor', 'start', 'stop', 'search_start', 'search_stop',
+        'max_mismatches'
+    ]
+)
 
 TECHNOLOGIES = [
     # Technology(
@@ -81,14 +97,18 @@ TECHNOLOGIES = [
     #      ReadSubstring(1, 30, 38)],
     #     None,
     # ),
-    # Technology(
-    #     'indropsv3',
-    #     'inDrops version 3',
-    #     3,
-    #     ReadSubstring(2, None, None),
-    #     [ReadSubstring(1, 8, 14)],
-    #     [ReadSubstring(0, 0, 8), ReadSubstring(1, 0, 8)],
-    #     os.path.join(WHITELIST_DIR, 'indropsv3_whitelist.txt.gz'),
-    # ),
+    Technology(
+        'indropsv3',
+        'inDrops version 3',
+        3,
+        ReadSubstring(2, None, None),
+        [ReadSubstring(1, 8, 14)],
+        [ReadSubstring(0, 0, 8), ReadSubstring(1, 0, 8)],
+        os.path.join(WHITELIST_DIR, 'indropsv3_whitelist.txt.gz'),
+        [
+            os.path.join(WHITELIST_DIR, 'indropsv3_bc1_whitelist.txt.gz'),
+            os.path.join(WHITELIST_DIR, 'indropsv3_bc2_whitelist.txt.gz'),
+        ],
+    ),
 ]
 TECHNOLOGIES_MAPPING = {t.name: t for t in TECHNOLOGIES}
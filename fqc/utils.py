@@ -5,6 +5,8 @@ from urllib.request import urlopen
 
 from tqdm import tqdm
 
+from .compression import open_decompressed
+
 
 class TqdmLoggingHandler(logging.Handler):
     """Custom logging handler so that logging does not affect progress bars.
@@ -35,8 +37,44 @@ def open_as_text(path, mode):
     :return: file object
     :rtype: file object
     """
-    return gzip.open(path,
-                     f'{mode}t') if path.endswith('.gz') else open(path, mode)
+    if path.endswith('.gz'):
+        return open_decompressed(path, 'rt') if mode == 'r' else gzip.open(
+            path, f'{mode}t'
+        )
+    return open(path, mode)
+
+
+def read_barcodes(path):
+    """Read a list of barcodes, one per line, into a set.
+
+    :param path: path to textfile or gzip
+    :type path: str
+
+    :return: set of barcodes
+    :rtype: set
+    """
+    with open_as_text(path, 'r') as f:
+        return set(f.read().split())
+
+
+def read_groups(path):
+    """Read a tab-separated file of barcodes and group names.
+
+    :param path: path to textfile or gzip, with a barcode and its group name
+                 on each line
+    :type path: str
+
+    :return: dictionary of barcodes as keys and group names as values
+    :rtype: dict
+    """
+    groups = {}
+    with open_as_text(path, 'r') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            barcode, group = line.strip().split('\t')
+            groups[barcode] = group
+    return groups
 
 
 def fastq_reads(path):
@@ -49,10 +87,14 @@ def fastq_reads(path):
     :rtype: generator
     """
     parse = urlparse(path)
-    open_func = gzip.open if path.endswith('.gz') else open
-    mode = 'rt' if path.endswith('.gz') else 'r'
-
-    with open_func(urlopen(path) if parse.scheme else path, mode) as f:
+    if path.endswith('.gz') and not parse.scheme:
+        f = open_decompressed(path, 'rt')
+    else:
+        open_func = gzip.open if path.endswith('.gz') else open
+        mode = 'rt' if path.endswith('.gz') else 'r'
+        f = open_func(urlopen(path) if parse.scheme else path, mode)
+
+    with f:
         for n, line in enumerate(f):
             if (n + 3) % 4 == 0:
                 yield line.strip()
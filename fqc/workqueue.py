@@ -0,0 +1,357 @@
+import logging
+import os
+import re
+import socket
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+from .config import (
+    LEASE_TIMEOUT,
+    MAX_ATTEMPTS,
+    N_READS,
+    POLL_INTERVAL,
+    SKIP_READS,
+)
+from .fqc import fqc_bam, fqc_fastq
+
+logger = logging.getLogger(__name__)
+
+# Layout of a queue directory. Each sample is a task file that moves from
+# `todo` to `leases` (while a worker processes it) by atomic renames. Tasks are
+# named `{task}.{attempt}` in `todo` and `failed`, and
+# `{task}.{attempt}.{worker}` in `leases`. Each worker appends its results to
+# its own file in `results`.
+MANIFEST = 'manifest.tsv'
+TODO = 'todo'
+LEASES = 'leases'
+RESULTS = 'results'
+FAILED = 'failed'
+
+
+def read_manifest(path):
+    """Read a manifest of samples, with a sample name followed by one or more
+    FASTQs or a single BAM on each tab-separated line.
+
+    :param path: path to manifest
+    :type path: str
+
+    :return: ordered dictionary of samples as keys and lists of paths as values
+    :rtype: OrderedDict
+    """
+    samples = OrderedDict()
+    with open(path, 'r') as f:
+        for line in f:
+            if not line.strip() or line.startswith('#'):
+                continue
+            sample, *paths = line.rstrip('\n').split('\t')
+            if not paths:
+                raise Exception(f'Sample {sample} in {path} has no files')
+            if sample in samples:
+                raise Exception(f'Sample {sample} appears twice in {path}')
+            samples[sample] = paths
+    return samples
+
+
+def default_worker():
+    """Get a worker name that is unique across nodes, from the host name and
+    process id.
+
+    :return: worker name
+    :rtype: str
+    """
+    return re.sub(r'[^\w-]', '_', f'{socket.gethostname()}-{os.getpid()}')
+
+
+def init_queue(directory, manifest_path, timeout=LEASE_TIMEOUT):
+    """Create a queue of samples in a (shared) directory. This is safe to call
+    from many workers at once, as the manifest is created atomically with a
+    hard link, and only the worker that creates it creates the tasks.
+
+    :param directory: path to queue directory
+    :type directory: str
+    :param manifest_path: path to manifest of samples, see `read_manifest`
+    :type manifest_path: str
+    :param timeout: seconds to wait for another worker to create the tasks,
+                    defaults to `600`
+    :type timeout: int, optional
+
+    :return: whether this call created the queue
+    :rtype: bool
+    """
+    samples = read_manifest(manifest_path)
+    for name in (LEASES, RESULTS, FAILED):
+        os.makedirs(os.path.join(directory, name), exist_ok=True)
+
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.manifest')
+    with os.fdopen(fd, 'w') as f:
+        for sample, paths in samples.items():
+            f.write('\t'.join([sample] + paths) + '\n')
+    try:
+        os.link(temp_path, os.path.join(directory, MANIFEST))
+        created = True
+    except FileExistsError:
+        created = False
+    finally:
+        os.remove(temp_path)
+
+    todo = os.path.join(directory, TODO)
+    if created:
+        temp_dir = tempfile.mkdtemp(dir=directory, prefix='.todo')
+        for i, (sample, paths) in enumerate(samples.items()):
+            with open(os.path.join(temp_dir, f'{i:06d}.1'), 'w') as f:
+                f.write('\t'.join([sample] + paths) + '\n')
+        os.rename(temp_dir, todo)
+        logger.info(f'Created queue of {len(samples)} samples in {directory}')
+        return True
+
+    if read_manifest(os.path.join(directory, MANIFEST)) != samples:
+        raise Exception(
+            f'Queue {directory} was created with a different manifest'
+        )
+    start = time.time()
+    while not os.path.isdir(todo):
+        if time.time() - start > timeout:
+            raise Exception(f'Queue {directory} was never fully created')
+        time.sleep(0.1)
+    return False
+
+
+def claim(directory, worker):
+    """Claim a task by renaming it from `todo` into `leases`. Only one worker
+    can succeed in renaming a file.
+
+    :param directory: path to queue directory
+    :type directory: str
+    :param worker: worker name
+    :type worker: str
+
+    :return: path to the lease, or `None` if there are no tasks left
+    :rtype: str
+    """
+    todo = os.path.join(directory, TODO)
+    for name in sorted(os.listdir(todo)):
+        path = os.path.join(todo, name)
+        lease = os.path.join(directory, LEASES, f'{name}.{worker}')
+        try:
+            # Renames keep the modification time, which is when the lease
+            # was last renewed.
+            os.utime(path)
+            os.rename(path, lease)
+        except FileNotFoundError:
+            continue
+        os.utime(lease)
+        return lease
+    return None
+
+
+def reclaim(directory, timeout=LEASE_TIMEOUT, max_attempts=MAX_ATTEMPTS):
+    """Return tasks with stale leases to `todo` to be retried, or move them to
+    `failed` if they have been attempted `max_attempts` times. Since leases
+    are compared against the local clock, `timeout` must be much longer than
+    the clock skew between nodes.
+
+    :param directory: path to queue directory
+    :type directory: str
+    :param timeout: seconds after which a lease that has not been renewed is
+                    stale, defaults to `600`
+    :type timeout: int, optional
+    :param max_attempts: maximum number of attempts per task, defaults to `3`
+    :type max_attempts: int, optional
+
+    :return: number of reclaimed tasks
+    :rtype: int
+    """
+    leases = os.path.join(directory, LEASES)
+    n = 0
+    for name in os.listdir(leases):
+        path = os.path.join(leases, name)
+        try:
+            if time.time() - os.path.getmtime(path) < timeout:
+                continue
+        except FileNotFoundError:
+            continue
+        task, attempt, worker = name.split('.', 2)
+        attempt = int(attempt)
+        if attempt >= max_attempts:
+            target = os.path.join(directory, FAILED, f'{task}.{attempt}')
+        else:
+            target = os.path.join(directory, TODO, f'{task}.{attempt + 1}')
+        try:
+            os.rename(path, target)
+        except FileNotFoundError:
+            continue
+        logger.warning((
+            f'Lease of task {task} by {worker} is stale after attempt '
+            f'{attempt}. '
+            f'{"Giving up." if attempt >= max_attempts else "Retrying."}'
+        ))
+        n += 1
+    return n
+
+
+def _renew(lease, interval, stop):
+    """Helper function to keep renewing a lease until `stop` is set.
+    """
+    while not stop.wait(interval):
+        try:
+            os.utime(lease)
+        except FileNotFoundError:
+            logger.warning(f'Lease {lease} was reclaimed by another worker')
+            return
+
+
+def detect(paths, skip=SKIP_READS, n=N_READS):
+    """Detect the technology of a single sample.
+
+    :param paths: paths to FASTQs, or to a single BAM
+    :type paths: list
+    :param skip: number of reads to skip at the beginning, defaults to `1000`
+    :type skip: int, optional
+    :param n: number of reads to consider, defaults to `100000`
+    :type n: int, optional
+
+    :return: (technology name or `None` if none was detected, ordered paths)
+    :rtype: tuple
+    """
+    if len(paths) == 1 and paths[0].endswith('.bam'):
+        technology = fqc_bam(paths[0])
+        return (technology.name, paths) if technology else (None, [])
+    fastqs, technologies = fqc_fastq(paths, skip, n)
+    if len(technologies) != 1:
+        return None, []
+    ordered = technologies[0]
+    return ordered.technology.name, [fastqs[i] for i in ordered.permutation]
+
+
+def work(
+    directory,
+    worker=None,
+    skip=SKIP_READS,
+    n=N_READS,
+    timeout=LEASE_TIMEOUT,
+    max_attempts=MAX_ATTEMPTS,
+    poll_interval=POLL_INTERVAL,
+):
+    """Process samples from a queue until none are left. Any number of workers,
+    on any number of nodes, may work on the same queue.
+
+    The lease of a sample is renewed while it is processed. Each result is
+    appended to `results/{worker}.tsv` as a line with the sample, its status
+    (`ok`, `undetected` or `error`), technology, worker, time in seconds and
+    ordered paths. A sample may be processed more than once if its lease
+    becomes stale, which `merge` accounts for.
+
+    :param directory: path to queue directory
+    :type directory: str
+    :param worker: worker name, defaults to `None`, which uses the host name
+                   and process id
+    :type worker: str, optional
+    :param skip: number of reads to skip at the beginning, defaults to `1000`
+    :type skip: int, optional
+    :param n: number of reads to consider, defaults to `100000`
+    :type n: int, optional
+    :param timeout: seconds after which a lease that has not been renewed is
+                    stale, defaults to `600`
+    :type timeout: int, optional
+    :param max_attempts: maximum number of attempts per task, defaults to `3`
+    :type max_attempts: int, optional
+    :param poll_interval: seconds to wait before checking for stale leases
+                          when there are no tasks left, defaults to `10`
+    :type poll_interval: int, optional
+
+    :return: number of samples processed by this worker
+    :rtype: int
+    """
+    worker = worker or default_worker()
+    results_path = os.path.join(directory, RESULTS, f'{worker}.tsv')
+    n_processed = 0
+    while True:
+        reclaim(directory, timeout, max_attempts)
+        lease = claim(directory, worker)
+        if lease is None:
+            # Wait for any samples still leased by other workers, which may
+            # become stale.
+            if not os.listdir(os.path.join(directory, LEASES)):
+                break
+            time.sleep(poll_interval)
+            continue
+
+        with open(lease, 'r') as f:
+            sample, *paths = f.read().rstrip('\n').split('\t')
+        logger.info(f'Worker {worker} processing sample {sample}')
+        stop = threading.Event()
+        thread = threading.Thread(
+            target=_renew, args=(lease, timeout / 3, stop), daemon=True
+        )
+        thread.start()
+        start = time.time()
+        try:
+            technology, ordered = detect(paths, skip, n)
+            status = 'ok' if technology else 'undetected'
+        except Exception as e:
+            logger.error(f'Failed to process sample {sample}: {e}')
+            technology, ordered, status = None, [], 'error'
+        finally:
+            stop.set()
+            thread.join()
+
+        with open(results_path, 'a') as f:
+            f.write(
+                '\t'.join([
+                    sample, status, technology or '', worker,
+                    f'{time.time() - start:.1f}'
+                ] + ordered) + '\n'
+            )
+            f.flush()
+            os.fsync(f.fileno())
+        try:
+            os.remove(lease)
+        except FileNotFoundError:
+            pass
+        n_processed += 1
+    logger.info(f'Worker {worker} processed {n_processed} samples')
+    return n_processed
+
+
+def merge(directory):
+    """Combine the results of all workers on a queue. If a sample was processed
+    more than once, a successful result is preferred.
+
+    :param directory: path to queue directory
+    :type directory: str
+
+    :return: ordered dictionary with samples as keys, in the order of the
+             manifest, and tuples of (status, technology name, ordered paths)
+             as values. The status of samples that were given up on after
+             stale leases is `failed`, and of samples without a result yet is
+             `pending`.
+    :rtype: OrderedDict
+    """
+    samples = read_manifest(os.path.join(directory, MANIFEST))
+    results = {}
+    results_dir = os.path.join(directory, RESULTS)
+    for name in sorted(os.listdir(results_dir)):
+        with open(os.path.join(results_dir, name), 'r') as f:
+            for line in f:
+                # Skip any line that a worker did not finish writing.
+                if not line.endswith('\n'):
+                    continue
+                # The worker and time (fields 3 and 4) are not kept.
+                fields = line.rstrip('\n').split('\t')
+                if results.get(fields[0], ('',))[0] != 'ok':
+                    results[fields[0]] = (fields[1], fields[2], fields[5:])
+    failed = {
+        name.split('.')[0]
+        for name in os.listdir(os.path.join(directory, FAILED))
+    }
+
+    merged = OrderedDict()
+    for i, sample in enumerate(samples):
+        if sample in results:
+            merged[sample] = results[sample]
+        else:
+            status = 'failed' if f'{i:06d}' in failed else 'pending'
+            merged[sample] = (status, '', [])
+    return merged
@@ -0,0 +1,209 @@
+import gzip
+import hashlib
+import logging
+import os
+from collections import OrderedDict
+
+from .config import GZIP_LEVEL, MAX_BUFFERED_BYTES, MAX_OPEN_FILES
+
+logger = logging.getLogger(__name__)
+
+
+class HandlePool:
+    """Pool of open binary file handles with at most `max_open` handles open at
+    once. When the pool is full, the least recently used handle is closed. A
+    file is truncated the first time it is opened, and appended to afterwards.
+
+    :param max_open: maximum number of open handles, defaults to `256`
+    :type max_open: int, optional
+    """
+
+    def __init__(self, max_open=MAX_OPEN_FILES):
+        if max_open < 1:
+            raise Exception('At least one file must be allowed to be open.')
+        self.max_open = max_open
+        self.handles = OrderedDict()
+        self.created = set()
+        self.n_opens = 0
+
+    def get(self, path):
+        """Get an open handle to a file.
+
+        :param path: path to file
+        :type path: str
+
+        :return: open binary file handle
+        :rtype: file object
+        """
+        if path in self.handles:
+            self.handles.move_to_end(path)
+            return self.handles[path]
+
+        if len(self.handles) >= self.max_open:
+            _, handle = self.handles.popitem(last=False)
+            handle.close()
+        handle = open(path, 'ab' if path in self.created else 'wb')
+        self.created.add(path)
+        self.handles[path] = handle
+        self.n_opens += 1
+        return handle
+
+    def close(self):
+        """Close all open handles.
+        """
+        for handle in self.handles.values():
+            handle.close()
+        self.handles.clear()
+
+
+class GzipSplitWriter:
+    """Writer for a large number of gzipped text files at once, such as one
+    FASTQ per cell barcode.
+
+    Text written to each file is buffered in memory, and every flush of a buffer
+    is compressed into a separate gzip member (a file of concatenated gzip
+    members is itself a valid gzip file) and appended through a HandlePool, so
+    the number of open file descriptors stays bounded. The MD5 checksum of the
+    compressed bytes of each file is computed as they are written.
+
+    :param max_open: maximum number of open handles, defaults to `256`
+    :type max_open: int, optional
+    :param buffer_size: size in bytes at which a single file's buffer is
+                        flushed, defaults to `1048576`
+    :type buffer_size: int, optional
+    :param max_buffered: maximum total size in bytes of all buffers, defaults
+                         to `268435456`
+    :type max_buffered: int, optional
+    :param compresslevel: gzip compression level, defaults to `6`
+    :type compresslevel: int, optional
+    """
+
+    def __init__(
+        self,
+        max_open=MAX_OPEN_FILES,
+        buffer_size=1 << 20,
+        max_buffered=MAX_BUFFERED_BYTES,
+        compresslevel=GZIP_LEVEL,
+    ):
+        self.pool = HandlePool(max_open)
+        self.buffer_size = buffer_size
+        self.max_buffered = max_buffered
+        self.compresslevel = compresslevel
+        self.buffers = {}
+        self.buffer_sizes = {}
+        self.buffered = 0
+        self.paths = []
+        self.md5s = {}
+
+    def _add(self, path):
+        self.buffers[path] = []
+        self.buffer_sizes[path] = 0
+        self.paths.append(path)
+        self.md5s[path] = hashlib.md5()
+
+    def write(self, path, text):
+        """Write text to a file.
+
+        :param path: path to gzip file
+        :type path: str
+        :param text: text to write
+        :type text: str
+        """
+        data = text.encode()
+        if path not in self.buffers:
+            self._add(path)
+        self.buffers[path].append(data)
+        self.buffer_sizes[path] += len(data)
+        self.buffered += len(data)
+
+        if self.buffer_sizes[path] >= self.buffer_size:
+            self.flush(path)
+        elif self.buffered >= self.max_buffered:
+            self.flush()
+
+    def flush(self, path=None):
+        """Compress and write out buffered text.
+
+        :param path: only flush the buffer of this file, defaults to `None`,
+                     which flushes all buffers
+        :type path: str, optional
+        """
+        paths = [path] if path is not None else list(self.buffers.keys())
+        for p in paths:
+            if not self.buffer_sizes.get(p):
+                continue
+            data = gzip.compress(
+                b''.join(self.buffers[p]), compresslevel=self.compresslevel
+            )
+            self.pool.get(p).write(data)
+            self.md5s[p].update(data)
+            self.buffered -= self.buffer_sizes[p]
+            self.buffers[p] = []
+            self.buffer_sizes[p] = 0
+
+    def truncate(self, sizes):
+        """Truncate files to the given sizes (creating any that do not exist),
+        so that all following writes are appended after them. Used to resume
+        writing from a checkpoint. The bytes that are kept are read once to
+        restore their checksums.
+
+        :param sizes: dictionary of paths as keys and sizes in bytes as values
+        :type sizes: dict
+        """
+        for path, size in sizes.items():
+            current = os.path.getsize(path) if os.path.exists(path) else 0
+            if current < size:
+                raise Exception(
+                    f'{path} is shorter than expected ({current} < {size} bytes)'
+                )
+            with open(path, 'ab') as f:
+                f.truncate(size)
+            self.pool.created.add(path)
+            if path not in self.buffers:
+                self._add(path)
+            # Checksum the bytes that are kept.
+            self.md5s[path] = hashlib.md5()
+            with open(path, 'rb') as f:
+                for data in iter(lambda: f.read(1 << 20), b''):
+                    self.md5s[path].update(data)
+
+    def checkpoint(self):
+        """Flush all buffers, so that every file ends at a clean gzip member
+        boundary, and sync all open files to disk.
+
+        :return: dictionary of paths as keys and sizes in bytes as values
+        :rtype: dict
+        """
+        self.flush()
+        for handle in self.pool.handles.values():
+            handle.flush()
+            os.fsync(handle.fileno())
+        return {path: os.path.getsize(path) for path in self.paths}
+
+    def checksums(self):
+        """Get the MD5 checksums of the compressed bytes written to each file
+        so far, not including any buffered text.
+
+        :return: dictionary of paths as keys and hexadecimal MD5 checksums as
+                 values
+        :rtype: dict
+        """
+        return {path: self.md5s[path].hexdigest() for path in self.paths}
+
+    def close(self):
+        """Flush all buffers and close all files.
+        """
+        try:
+            self.flush()
+        finally:
+            self.pool.close()
+        logger.debug((
+            f'Wrote {len(self.paths)} files with {self.pool.n_opens} '
+            f'file opens (at most {self.pool.max_open} open at once)'
+        ))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
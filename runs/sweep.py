@@ -0,0 +1,417 @@
+"""Sweep detection settings (number of reads to skip, number of reads to
+consider and confidence to stop at) over labelled runs and synthetic data,
+and report accuracy against cost, to choose defaults for `config.py`.
+
+Usage:
+    python runs/sweep.py --synthetic 5 runs/10xv2.txt -o results.tsv
+"""
+import argparse
+import gzip
+import io
+import logging
+import os
+import random
+import shutil
+import statistics
+import tempfile
+import time
+import tracemalloc
+from contextlib import contextmanager
+from itertools import product
+
+import fqc.fqc as fqc
+from fqc.compression import (
+    Backend,
+    BACKENDS,
+    get_backend,
+    register_backend,
+    set_backend,
+)
+from fqc.plan import load_whitelist
+from fqc.remote import RemoteFiles
+from fqc.resources import set_resources
+from fqc.technologies import TECHNOLOGIES
+from fqc.utils import open_as_text
+
+logging.getLogger('fqc').setLevel(logging.ERROR)
+
+SEQUENCE_LENGTH = 98
+
+# Number of compressed bytes read since the last reset.
+COUNTER = [0]
+
+
+def read_runs(path):
+    with open(path, 'r') as f:
+        lines = f.readlines()
+    return [
+        line.strip().split(',')
+        for line in lines
+        if not line.isspace() and not line.startswith('#')
+    ]
+
+
+def labelled_runs(paths):
+    """Read labelled FASTQ runs from files like `runs/10xv2.txt`, where the file
+    name is the technology. BAMs are skipped, since they are not sampled.
+
+    :return: list of (name, paths, expected technology name, expected
+             permutation or `None` if unknown) tuples
+    :rtype: list
+    """
+    runs = []
+    for path in paths:
+        technology = os.path.splitext(os.path.basename(path))[0]
+        for i, run in enumerate(read_runs(path)):
+            if not run[0].endswith('.bam'):
+                runs.append((f'{technology}_{i+1}', run, technology, None))
+    return runs
+
+
+def random_sequence(rng, length):
+    return ''.join(rng.choice('ACGT') for _ in range(length))
+
+
+def generate(
+    directory,
+    name,
+    technology,
+    n_reads,
+    hit_rate=0.9,
+    bad_head=0,
+    shuffle=True,
+    seed=0,
+):
+    """Generate synthetic gzipped FASTQs for a technology. Each barcode is
+    sampled from the whitelist with probability `hit_rate` and is random
+    otherwise. The first `bad_head` reads only hit the whitelist with a tenth
+    of that probability, like the low quality reads at the start of a run.
+
+    :return: (name, paths, expected technology name, expected permutation)
+    :rtype: tuple
+    """
+    rng = random.Random(seed)
+    with open_as_text(technology.whitelist_path, 'r') as f:
+        whitelist = f.read().split()
+    lengths = [0] * technology.n_files
+    for substring in technology.barcode_positions + technology.umi_positions:
+        lengths[substring.file] = max(lengths[substring.file], substring.stop)
+    lengths[technology.reads_file.file] = SEQUENCE_LENGTH
+
+    # If the permutation is [1, 0], then read 0 is written to fastq 1.
+    permutation = list(range(technology.n_files))
+    if shuffle:
+        rng.shuffle(permutation)
+    paths = [
+        os.path.join(directory, f'{name}_{i+1}.fastq.gz')
+        for i in range(technology.n_files)
+    ]
+    files = [gzip.open(paths[p], 'wt', compresslevel=1) for p in permutation]
+    try:
+        for i in range(n_reads):
+            rate = hit_rate / 10 if i < bad_head else hit_rate
+            reads = [list(random_sequence(rng, length)) for length in lengths]
+            barcode = rng.choice(whitelist) if rng.random() < rate else ''
+            start = 0
+            for substring in technology.barcode_positions:
+                length = substring.stop - substring.start
+                if barcode:
+                    reads[substring.file][substring.start:substring.stop] = \
+                        barcode[start:start + length]
+                start += length
+            for f, read in zip(files, reads):
+                read = ''.join(read)
+                f.write(f'@read{i}\n{read}\n+\n{"F" * len(read)}\n')
+    finally:
+        for f in files:
+            f.close()
+    return name, paths, technology.name, tuple(permutation)
+
+
+def synthetic_runs(directory, n_runs, n_reads, seed=0):
+    """Generate synthetic runs for every technology with a whitelist: clean
+    runs, runs with a low quality start, runs with a low whitelist hit rate
+    and, as negative controls, runs with only random barcodes.
+    """
+    runs = []
+    rng = random.Random(seed)
+    for technology in TECHNOLOGIES:
+        if not technology.whitelist_path or not os.path.exists(
+                technology.whitelist_path):
+            continue
+        for i in range(n_runs):
+            for kind, kwargs in [
+                ('clean', {}),
+                ('bad_head', {'bad_head': min(5000, n_reads // 4)}),
+                ('low_hit', {'hit_rate': 0.6}),
+                ('random', {'hit_rate': 0.}),
+            ]:
+                name, paths, expected, permutation = generate(
+                    directory,
+                    f'{technology.name}_{kind}_{i+1}',
+                    technology,
+                    n_reads,
+                    seed=rng.randrange(2**32),
+                    **kwargs
+                )
+                runs.append((
+                    name,
+                    paths,
+                    None if kind == 'random' else expected,
+                    None if kind == 'random' else permutation,
+                ))
+    return runs
+
+
+class CountedReader(io.RawIOBase):
+    """Binary file that adds the number of bytes read from another binary file
+    to `COUNTER`.
+    """
+
+    def __init__(self, f):
+        super().__init__()
+        self.f = f
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        n = self.f.readinto(b)
+        COUNTER[0] += n
+        return n
+
+    def close(self):
+        self.f.close()
+        super().close()
+
+
+def _open_counted(path):
+    f = CountedReader(open(path, 'rb'))
+    return gzip.GzipFile(fileobj=io.BufferedReader(f)), None
+
+
+# Decompression backend that counts the compressed bytes read from local
+# FASTQs.
+COUNTED_BACKEND = Backend('counted', lambda: True, _open_counted)
+
+
+class CountedRemoteFiles(RemoteFiles):
+    """RemoteFiles that counts the bytes read from remote FASTQs.
+    """
+
+    def __enter__(self):
+        return [CountedReader(f) for f in super().__enter__()]
+
+
+@contextmanager
+def counting():
+    """Count the compressed bytes read from local gzipped FASTQs and from
+    remote FASTQs into `COUNTER`, so that the cost of each setting is measured
+    in bytes that would be read from disk or network. Uncompressed local FASTQs
+    are not counted.
+    """
+    backend = get_backend()
+    register_backend(COUNTED_BACKEND, first=True)
+    fqc.RemoteFiles = CountedRemoteFiles
+    try:
+        yield
+    finally:
+        fqc.RemoteFiles = RemoteFiles
+        del BACKENDS[COUNTED_BACKEND.name]
+        set_backend(backend.name)
+
+
+def evaluate(run, skip, n, stop_confidence, batch_size=fqc.BATCH_SIZE):
+    name, paths, expected, permutation = run
+    COUNTER[0] = 0
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        _, detector = fqc.detect_fastqs(
+            paths,
+            skip,
+            n,
+            batch_size=batch_size,
+            stop_confidence=stop_confidence
+        )
+        error = ''
+    except Exception as e:
+        detector, error = None, str(e)
+    elapsed = time.perf_counter() - start
+    n_bytes = COUNTER[0]
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    best = detector.best if detector else None
+    if expected is None:
+        correct = best is None and not error
+    elif best is None:
+        correct = False
+    else:
+        correct = best.technology.name == expected and (
+            permutation is None or best.permutation == permutation
+        )
+    ranking = detector.ranking if detector else []
+    counts = [count for _, count in ranking[:2]] + [0, 0]
+    margin = (
+        counts[0] - counts[1]
+    ) / detector.n if detector and detector.n else 0.
+    return {
+        'run': name,
+        'skip': skip,
+        'n': n,
+        'stop': stop_confidence,
+        'expected': expected or 'none',
+        'detected': str(best) if best else 'none',
+        'correct': correct,
+        'margin': margin,
+        'reads': detector.n if detector else 0,
+        'time': elapsed,
+        'bytes': n_bytes,
+        'peak_mb': peak / 1024**2,
+        'error': error,
+    }
+
+
+def report(results, min_accuracy):
+    """Summarize results per setting, and list the cheapest settings (by bytes
+    read, then time) whose accuracy is at least `min_accuracy`.
+    """
+    settings = {}
+    for result in results:
+        settings.setdefault((result['skip'], result['n'], result['stop']),
+                            []).append(result)
+
+    rows = []
+    for (skip, n, stop), rs in settings.items():
+        # Negative controls have no margin.
+        margins = [r['margin'] for r in rs if r['expected'] != 'none']
+        rows.append({
+            'skip': skip,
+            'n': n,
+            'stop': stop,
+            'accuracy': sum(r['correct'] for r in rs) / len(rs),
+            'min_margin': min(margins) if margins else 0.,
+            'median_reads': statistics.median(r['reads'] for r in rs),
+            'mean_time': statistics.mean(r['time'] for r in rs),
+            'mean_bytes': statistics.mean(r['bytes'] for r in rs),
+            'max_peak_mb': max(r['peak_mb'] for r in rs),
+        })
+
+    columns = list(rows[0].keys())
+    lines = ['\t'.join(columns)]
+    for row in sorted(rows, key=lambda r: (r['skip'], r['n'], r['stop'] or 0)):
+        lines.append('\t'.join(format_value(row[c]) for c in columns))
+
+    passing = sorted((row for row in rows if row['accuracy'] >= min_accuracy),
+                     key=lambda r: (r['mean_bytes'], r['mean_time']))
+    lines.append('')
+    lines.append(f'Cheapest settings with accuracy >= {min_accuracy}:')
+    if not passing:
+        lines.append('\tnone')
+    for row in passing[:5]:
+        lines.append((
+            f'\tskip={row["skip"]} n={row["n"]} stop={row["stop"]}: '
+            f'accuracy {row["accuracy"]:.3f}, min margin {row["min_margin"]:.3f}, '
+            f'{row["mean_bytes"] / 1024**2:.1f} MB read, {row["mean_time"]:.2f}s'
+        ))
+    return '\n'.join(lines)
+
+
+def format_value(value):
+    if isinstance(value, float):
+        return f'{value:.4g}'
+    return str(value)
+
+
+def parse_stop(value):
+    return None if value == 'none' else float(value)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        'paths', nargs='*', help='Labelled runs, i.e. runs/10xv2.txt'
+    )
+    parser.add_argument(
+        '-s', nargs='+', type=int, default=[0, 100, 1000, 10000]
+    )
+    parser.add_argument(
+        '-n', nargs='+', type=int, default=[1000, 10000, 100000]
+    )
+    parser.add_argument(
+        '--stop',
+        nargs='+',
+        type=parse_stop,
+        default=[None, 0.999],
+        help='Confidences to stop at, or `none` to never stop early'
+    )
+    parser.add_argument(
+        '--synthetic',
+        type=int,
+        default=0,
+        help='Number of synthetic runs of each kind per technology'
+    )
+    parser.add_argument('--synthetic-reads', type=int, default=120000)
+    parser.add_argument(
+        '--batch-size',
+        type=int,
+        default=fqc.BATCH_SIZE,
+        help='Early stopping is only checked after every batch'
+    )
+    parser.add_argument('--min-accuracy', type=float, default=1.)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument(
+        '-o', help='Write per-run results to this TSV', default=None
+    )
+    args = parser.parse_args()
+
+    # A single thread, so that BGZF-compressed FASTQs are also decompressed
+    # with the counting backend.
+    set_resources(1)
+    directory = tempfile.mkdtemp()
+    try:
+        runs = labelled_runs(args.paths)
+        if args.synthetic:
+            runs.extend(
+                synthetic_runs(
+                    directory,
+                    args.synthetic,
+                    args.synthetic_reads,
+                    seed=args.seed
+                )
+            )
+        if not runs:
+            parser.error('Provide labelled runs and/or `--synthetic`')
+
+        # Whitelists are loaded (and cached) once per process, so load them
+        # before any run is measured.
+        for technology in TECHNOLOGIES:
+            if technology.whitelist_path and os.path.exists(
+                    technology.whitelist_path):
+                load_whitelist(technology.whitelist_path)
+
+        results = []
+        settings = list(product(args.s, args.n, args.stop))
+        with counting():
+            for i, (skip, n, stop) in enumerate(settings):
+                print(f'skip={skip} n={n} stop={stop} ({i+1}/{len(settings)})')
+                for run in runs:
+                    results.append(
+                        evaluate(
+                            run, skip, n, stop, batch_size=args.batch_size
+                        )
+                    )
+
+        if args.o:
+            with open(args.o, 'w') as f:
+                columns = list(results[0].keys())
+                f.write('\t'.join(columns) + '\n')
+                for result in results:
+                    f.write(
+                        '\t'.join(format_value(result[c])
+                                  for c in columns) + '\n'
+                    )
+        print(report(results, args.min_accuracy))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
@@ -4,20 +4,10 @@ import logging
 import os
 
 import fqc.fqc as fqc
+from sweep import read_runs
 
 logging.getLogger('fqc').setLevel(logging.ERROR)
 
-
-def read_runs(path):
-    with open(path, 'r') as f:
-        lines = f.readlines()
-    return [
-        line.strip().split(',')
-        for line in lines
-        if not line.isspace() and not line.startswith('#')
-    ]
-
-
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('path')
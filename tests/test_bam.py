@@ -1,19 +1,47 @@
 import gzip
+import hashlib
+import json
 import os
 import tempfile
-from unittest import TestCase
+from unittest import mock, TestCase
+
+import pysam
 
 import fqc.bam as bam
+from fqc.bus import FLAG_BARCODE_N, FLAG_UMI_N, read_bus
 from fqc.technologies import OrderedTechnology, TECHNOLOGIES_MAPPING
 from tests.mixins import TestMixin
 
 
 class TestBAM(TestMixin, TestCase):
 
+    def assertChecksums(self, path):
+        """Check a checksums manifest against the FASTQs it lists.
+        """
+        rows = bam.read_checksums(path)
+        self.assertTrue(rows)
+        for fastq, md5, size, records, bases in rows:
+            with open(fastq, 'rb') as f:
+                self.assertEqual(hashlib.md5(f.read()).hexdigest(), md5)
+            self.assertEqual(os.path.getsize(fastq), size)
+            with gzip.open(fastq, 'rt') as f:
+                sequences = f.read().splitlines()[1::4]
+            self.assertEqual(len(sequences), records)
+            self.assertEqual(sum(len(s) for s in sequences), bases)
+        return rows
+
     def test_detect_technology(self):
         b = bam.BAM(self.bam_10xv2_path)
         self.assertEqual(TECHNOLOGIES_MAPPING['10xv2'], b.technology)
 
+    def test_known_technology(self):
+        with mock.patch('fqc.bam.BAM.detect_technology') as detect_technology:
+            b = bam.BAM(
+                self.bam_10xv2_path, technology=TECHNOLOGIES_MAPPING['10xv2']
+            )
+            detect_technology.assert_not_called()
+        self.assertEqual(TECHNOLOGIES_MAPPING['10xv2'], b.technology)
+
     def test_to_fastq_10x(self):
         b = bam.BAM(self.bam_10xv2_path)
         fastqs, technologies = b.to_fastq(
@@ -26,3 +54,241 @@ class TestBAM(TestMixin, TestCase):
         for fastq1, fastq2 in zip(self.fastq_10xv2_paths, fastqs):
             with gzip.open(fastq1, 'rt') as f1, gzip.open(fastq2, 'rt') as f2:
                 self.assertEqual(f1.read(), f2.read())
+
+    def test_split_cells(self):
+        b = bam.BAM(self.bam_10xv2_path)
+        prefix = os.path.join(tempfile.mkdtemp(), '10xv2')
+        fastqs, technologies = b.split_cells(prefix, max_open=2)
+
+        self.assertEqual([
+            OrderedTechnology(TECHNOLOGIES_MAPPING['10xv2'], (0, 1))
+        ], technologies)
+        counts = b.count_barcodes()
+        self.assertEqual(set(counts.keys()), set(fastqs.keys()))
+
+        # The union of all per-cell FASTQs is the same as the full split.
+        full, _ = b.to_fastq(os.path.join(tempfile.mkdtemp(), '10xv2'))
+        for i in range(2):
+            with gzip.open(full[i], 'rt') as f:
+                expected = f.read().splitlines()
+            records = []
+            for barcode, paths in fastqs.items():
+                with gzip.open(paths[i], 'rt') as f:
+                    lines = f.read().splitlines()
+                self.assertEqual(4 * counts[barcode], len(lines))
+                if i == 0:
+                    self.assertTrue(
+                        all(line.startswith(barcode) for line in lines[1::4])
+                    )
+                records.extend(lines)
+            self.assertEqual(sorted(expected), sorted(records))
+
+    def test_split_cells_filter(self):
+        b = bam.BAM(self.bam_10xv2_path)
+        counts = b.count_barcodes()
+        barcode = counts.most_common(1)[0][0]
+        fastqs, _ = b.split_cells(
+            os.path.join(tempfile.mkdtemp(), '10xv2'),
+            whitelist={barcode},
+            min_count=1,
+        )
+        self.assertEqual([barcode], list(fastqs.keys()))
+
+    def test_split_cells_groups(self):
+        b = bam.BAM(self.bam_10xv2_path)
+        groups = {barcode: 'A' for barcode in b.count_barcodes()}
+        fastqs, _ = b.split_cells(
+            os.path.join(tempfile.mkdtemp(), '10xv2'), groups=groups
+        )
+        self.assertEqual(['A'], list(fastqs.keys()))
+
+    def test_to_fastq_max_records(self):
+        b = bam.BAM(self.bam_10xv2_path)
+        fastqs, _ = b.to_fastq(
+            os.path.join(tempfile.mkdtemp(), '10xv2'), max_records=10
+        )
+        for fastq1, fastq2 in zip(self.fastq_10xv2_paths, fastqs):
+            with gzip.open(fastq1, 'rt') as f1, gzip.open(fastq2, 'rt') as f2:
+                self.assertEqual(
+                    f1.read().splitlines()[:40],
+                    f2.read().splitlines()
+                )
+
+    def test_to_fastq_fraction(self):
+        b = bam.BAM(self.bam_10xv2_path)
+        names = []
+        for _ in range(2):
+            fastqs, _ = b.to_fastq(
+                os.path.join(tempfile.mkdtemp(), '10xv2'), fraction=0.5
+            )
+            with gzip.open(fastqs[0], 'rt') as f:
+                names.append(f.read().splitlines()[::4])
+        # Subsampling is deterministic.
+        self.assertEqual(names[0], names[1])
+        self.assertLess(len(names[0]), 143 * 0.75)
+        self.assertGreater(len(names[0]), 143 * 0.25)
+
+    def test_to_fastq_whitelist(self):
+        b = bam.BAM(self.bam_10xv2_path)
+        counts = b.count_barcodes()
+        barcode = counts.most_common(1)[0][0]
+        fastqs, _ = b.to_fastq(
+            os.path.join(tempfile.mkdtemp(), '10xv2'), whitelist={barcode}
+        )
+        with gzip.open(fastqs[0], 'rt') as f:
+            lines = f.read().splitlines()
+        self.assertEqual(4 * counts[barcode], len(lines))
+
+    def test_to_bus(self):
+        b = bam.BAM(self.bam_10xv2_path)
+        path = os.path.join(tempfile.mkdtemp(), '10xv2.fqb')
+        self.assertEqual(146, b.to_bus(path))
+
+        fastqs, _ = b.to_fastq(os.path.join(tempfile.mkdtemp(), '10xv2'))
+        with gzip.open(fastqs[0], 'rt') as f1, gzip.open(fastqs[1], 'rt') as f2:
+            expected = list(
+                zip(f1.read().splitlines()[1::4],
+                    f2.read().splitlines()[1::4])
+            )
+        records = list(read_bus(path))
+        self.assertEqual(len(expected), len(records))
+        for (read1, read2), (barcode, umi, sequence, flags) in zip(expected,
+                                                                   records):
+            if not flags & (FLAG_BARCODE_N | FLAG_UMI_N):
+                self.assertEqual(read1[:26], barcode + umi)
+            self.assertEqual(read2, sequence)
+
+    def test_to_fastq_resume(self):
+        b = bam.BAM(self.bam_10xv2_path)
+        prefix = os.path.join(tempfile.mkdtemp(), '10xv2')
+        checkpoint_path = f'{prefix}.checkpoint.json'
+
+        # Interrupt the split after 100 entries, with a checkpoint every 30.
+        format_record = bam.BAM.format_record
+        calls = []
+
+        def interrupt(name, read):
+            calls.append(name)
+            if len(calls) > 200:
+                raise KeyboardInterrupt()
+            return format_record(name, read)
+
+        with mock.patch('fqc.bam.BAM.format_record', side_effect=interrupt):
+            with self.assertRaises(KeyboardInterrupt):
+                b.to_fastq(prefix, checkpoint_interval=30)
+        with open(checkpoint_path, 'r') as f:
+            checkpoint = json.load(f)
+        self.assertEqual([[[f'{prefix}_1.fastq.gz', f'{prefix}_2.fastq.gz'], 90]
+                          ], checkpoint['chunks'])
+
+        fastqs, _ = b.to_fastq(prefix, resume=True, checkpoint_interval=30)
+        self.assertFalse(os.path.exists(checkpoint_path))
+        self.assertChecksums(f'{prefix}.checksums.tsv')
+        for fastq1, fastq2 in zip(self.fastq_10xv2_paths, fastqs):
+            with gzip.open(fastq1, 'rt') as f1, gzip.open(fastq2, 'rt') as f2:
+                self.assertEqual(f1.read(), f2.read())
+
+    def test_to_fastq_stale_checkpoint(self):
+        b = bam.BAM(self.bam_10xv2_path)
+        prefix = os.path.join(tempfile.mkdtemp(), '10xv2')
+        checkpoint_path = f'{prefix}.checkpoint.json'
+        bam.write_checkpoint(checkpoint_path, {'arguments': {}})
+        # A split that is not resumed removes the checkpoint of an earlier one.
+        with mock.patch('fqc.bam.BAM.format_record',
+                        side_effect=KeyboardInterrupt()):
+            with self.assertRaises(KeyboardInterrupt):
+                b.to_fastq(prefix)
+        self.assertFalse(os.path.exists(checkpoint_path))
+
+    def test_to_fastq_checksums(self):
+        b = bam.BAM(self.bam_10xv2_path)
+        prefix = os.path.join(tempfile.mkdtemp(), '10xv2')
+        fastqs, _ = b.to_fastq(prefix)
+        rows = self.assertChecksums(f'{prefix}.checksums.tsv')
+        self.assertEqual(fastqs, [row[0] for row in rows])
+        self.assertEqual([146, 146], [row[3] for row in rows])
+
+        chunks, _ = b.to_fastq(prefix, chunk_records=40)
+        rows = self.assertChecksums(f'{prefix}.checksums.tsv')
+        self.assertEqual([fastq for fastqs in chunks for fastq in fastqs],
+                         [row[0] for row in rows])
+
+    def test_to_fastq_resume_different_arguments(self):
+        b = bam.BAM(self.bam_10xv2_path)
+        prefix = os.path.join(tempfile.mkdtemp(), '10xv2')
+        bam.write_checkpoint(f'{prefix}.checkpoint.json', {'arguments': {}})
+        with self.assertRaises(Exception):
+            b.to_fastq(prefix, resume=True)
+
+        # Resume with a different whitelist.
+        with pysam.AlignmentFile(self.bam_10xv2_path, 'rb') as f:
+            whitelist = {item.get_tag('CR') for item in f.fetch(until_eof=True)}
+        format_record = bam.BAM.format_record
+        calls = []
+
+        def interrupt(name, read):
+            calls.append(name)
+            if len(calls) > 100:
+                raise KeyboardInterrupt()
+            return format_record(name, read)
+
+        with mock.patch('fqc.bam.BAM.format_record', side_effect=interrupt):
+            with self.assertRaises(KeyboardInterrupt):
+                b.to_fastq(prefix, whitelist=whitelist, checkpoint_interval=30)
+        with self.assertRaises(Exception):
+            b.to_fastq(
+                prefix,
+                whitelist=whitelist - {sorted(whitelist)[0]},
+                resume=True
+            )
+        b.to_fastq(prefix, whitelist=whitelist, resume=True)
+
+    def test_hash_whitelist(self):
+        self.assertIsNone(bam.hash_whitelist(None))
+        self.assertEqual(
+            bam.hash_whitelist({'A', 'C', 'G'}),
+            bam.hash_whitelist({'G', 'C', 'A'})
+        )
+        self.assertNotEqual(
+            bam.hash_whitelist({'A', 'C'}), bam.hash_whitelist({'A', 'G'})
+        )
+
+    def test_to_fastq_chunks(self):
+        b = bam.BAM(self.bam_10xv2_path)
+        prefix = os.path.join(tempfile.mkdtemp(), '10xv2')
+        chunks, _ = b.to_fastq(prefix, chunk_records=40)
+
+        self.assertEqual(4, len(chunks))
+        self.assertEqual([
+            f'{prefix}_1.part0001.fastq.gz', f'{prefix}_2.part0001.fastq.gz'
+        ], chunks[0])
+        with open(f'{prefix}.manifest.tsv', 'r') as f:
+            manifest = [line.strip().split('\t') for line in f]
+        self.assertEqual(['part0001', 'part0002', 'part0003', 'part0004'],
+                         [line[0] for line in manifest])
+        self.assertEqual([40, 40, 40, 26], [int(line[1]) for line in manifest])
+        self.assertEqual(chunks, [line[2:] for line in manifest])
+
+        # The concatenation of all chunks is the same as the full split.
+        for i, fastq in enumerate(self.fastq_10xv2_paths):
+            lines = []
+            for fastqs, line in zip(chunks, manifest):
+                with gzip.open(fastqs[i], 'rt') as f:
+                    chunk = f.read().splitlines()
+                self.assertEqual(4 * int(line[1]), len(chunk))
+                lines.extend(chunk)
+            with gzip.open(fastq, 'rt') as f:
+                self.assertEqual(f.read().splitlines(), lines)
+
+    def test_to_fastq_chunk_bytes(self):
+        b = bam.BAM(self.bam_10xv2_path)
+        prefix = os.path.join(tempfile.mkdtemp(), '10xv2')
+        chunks, _ = b.to_fastq(prefix, chunk_bytes=10000)
+        self.assertGreater(len(chunks), 1)
+        for fastqs in chunks[:-1]:
+            size = 0
+            for fastq in fastqs:
+                with gzip.open(fastq, 'rt') as f:
+                    size += len(f.read())
+            self.assertLessEqual(size, 10000)
+            self.assertGreater(size, 9000)
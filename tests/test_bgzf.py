@@ -0,0 +1,153 @@
+import gzip
+import os
+import random
+import shutil
+import tempfile
+from unittest import mock, TestCase
+
+import pysam
+
+import fqc.bgzf as bgzf
+import fqc.compression as compression
+import fqc.fqc as fqc
+import fqc.resources as resources
+from fqc.technologies import TECHNOLOGIES_MAPPING
+from tests.mixins import TestMixin
+
+
+class TestBgzf(TestMixin, TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.temp_dir = tempfile.mkdtemp()
+        # BGZF files of many blocks, with the barcodes of the fixture and
+        # random UMIs and cDNA.
+        rng = random.Random(0)
+        with gzip.open(cls.fastq_10xv2_paths[0], 'rt') as f:
+            barcodes = [line[:16] for line in f.read().splitlines()[1::4]]
+        reads = [[], []]
+        for j in range(150):
+            for barcode in barcodes:
+                reads[0].append(barcode + ''.join(rng.choices('ACGT', k=10)))
+                reads[1].append(''.join(rng.choices('ACGT', k=98)))
+        cls.texts = []
+        cls.paths = []
+        for i, sequences in enumerate(reads):
+            text = ''.join(
+                f'@read{j}/{i + 1}\n{sequence}\n+\n{"F" * len(sequence)}\n'
+                for j, sequence in enumerate(sequences)
+            )
+            plain = os.path.join(cls.temp_dir, f'{i + 1}.fastq')
+            with open(plain, 'w') as f:
+                f.write(text)
+            bgzf_path = os.path.join(cls.temp_dir, f'{i + 1}.fastq.gz')
+            pysam.tabix_compress(plain, bgzf_path, force=True)
+            cls.texts.append(text)
+            cls.paths.append(bgzf_path)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.temp_dir, ignore_errors=True)
+
+    def test_is_bgzf_file(self):
+        self.assertTrue(bgzf.is_bgzf_file(self.paths[0]))
+        self.assertFalse(bgzf.is_bgzf_file(self.fastq_10xv2_paths[0]))
+
+    def test_reader(self):
+        with bgzf.BGZFReader(self.paths[1], threads=4, blocks_per_task=2) as f:
+            self.assertEqual(self.texts[1], f.read().decode())
+        with bgzf.BGZFReader(self.paths[1], threads=1) as f:
+            self.assertEqual(self.texts[1], f.read().decode())
+
+    def test_open_decompressed(self):
+        with mock.patch('fqc.compression.get_resources',
+                        return_value=resources.plan_resources(4)):
+            with compression.open_decompressed(self.paths[1]) as f:
+                self.assertEqual('bgzf', f.buffer.raw.backend)
+                self.assertEqual(self.texts[1], f.read())
+            with compression.open_decompressed(self.paths[1]) as f:
+                self.assertEqual(self.texts[1][:10], f.read(10))
+
+    def test_find_block(self):
+        with open(self.paths[1], 'rb') as f:
+            self.assertEqual(0, bgzf.find_block(f, 0))
+            offset = bgzf.find_block(f, 1)
+            f.seek(0)
+            blocks = bgzf.read_blocks(f, 1)
+            self.assertEqual(len(blocks[0]), offset)
+            self.assertIsNone(
+                bgzf.find_block(f, os.path.getsize(self.paths[1]))
+            )
+
+    def test_fastq_records(self):
+        lines = ['ACGT\n', '@a/1\n', 'ACG\n', '+\n', 'FFF\n', '@b 1:N\n', 'A\n']
+        self.assertEqual([('a', 'ACG')], list(bgzf.fastq_records(lines)))
+
+    def test_sample_fastqs(self):
+        reads = bgzf.sample_fastqs(self.paths, 1000, 4)
+        self.assertEqual([1000, 1000], [len(rs) for rs in reads])
+        # Reads are synchronized, so they must be consecutive records of
+        # both files.
+        sequences = [text.splitlines()[1::4] for text in self.texts]
+        start = sequences[0].index(reads[0][0])
+        self.assertGreater(start, 0)
+        self.assertEqual(sequences[0][start:start + 250], reads[0][:250])
+        self.assertEqual(sequences[1][start:start + 250], reads[1][:250])
+
+    def test_sample_fastqs_missing_mate(self):
+        # The second FASTQ is truncated to a few records, so the only block
+        # after the sampled position is the empty EOF block.
+        plain = os.path.join(self.temp_dir, 'mate.fastq')
+        with open(plain, 'w') as f:
+            f.write(''.join(self.texts[1].splitlines(True)[:8]))
+        path = os.path.join(self.temp_dir, 'mate.fastq.gz')
+        pysam.tabix_compress(plain, path, force=True)
+        with self.assertRaises(Exception):
+            bgzf.sample_fastqs([self.paths[0], path], 1000, 1)
+
+    def test_fqc_fastq_sample_chunks(self):
+        technologies = fqc.all_ordered_technologies([
+            TECHNOLOGIES_MAPPING['10xv2']
+        ], 2)
+        with mock.patch('fqc.fqc.sample_fastqs',
+                        wraps=bgzf.sample_fastqs) as sample_fastqs:
+            paths, ordered = fqc.fqc_fastq(
+                self.paths, 0, 2000, technologies, sample_chunks=4
+            )
+            self.assertEqual((self.paths, 2000, 4), sample_fastqs.call_args[0])
+        self.assertEqual(self.paths, paths)
+        self.assertEqual(1, len(ordered))
+        self.assertEqual('10xv2', ordered[0].technology.name)
+        self.assertEqual((0, 1), ordered[0].permutation)
+
+    def test_fqc_fastq_sample_chunks_small(self):
+        # A single block of records, so that there are no complete records
+        # after any of the sampled positions.
+        paths = []
+        for i, fastq in enumerate(self.fastq_10xv2_paths):
+            plain = os.path.join(self.temp_dir, f'small_{i + 1}.fastq')
+            with gzip.open(fastq, 'rb') as f, open(plain, 'wb') as out:
+                shutil.copyfileobj(f, out)
+            paths.append(f'{plain}.gz')
+            pysam.tabix_compress(plain, paths[-1], force=True)
+        technologies = fqc.all_ordered_technologies([
+            TECHNOLOGIES_MAPPING['10xv2']
+        ], 2)
+        with self.assertLogs('fqc.bgzf', level='WARNING'):
+            _, ordered = fqc.fqc_fastq(
+                paths, 0, 100, technologies, sample_chunks=4
+            )
+        self.assertEqual(1, len(ordered))
+        self.assertEqual('10xv2', ordered[0].technology.name)
+        self.assertEqual((0, 1), ordered[0].permutation)
+
+    def test_fqc_fastq_sample_chunks_not_bgzf(self):
+        technologies = fqc.all_ordered_technologies([
+            TECHNOLOGIES_MAPPING['10xv2']
+        ], 2)
+        with mock.patch('fqc.fqc.sample_fastqs') as sample_fastqs:
+            fqc.fqc_fastq(
+                self.fastq_10xv2_paths, 0, 100, technologies, sample_chunks=4
+            )
+            sample_fastqs.assert_not_called()
@@ -0,0 +1,51 @@
+import os
+import tempfile
+from unittest import TestCase
+
+import fqc.bus as bus
+
+
+class TestBUS(TestCase):
+
+    def test_pack_unpack_sequences(self):
+        sequences = ['ACGTACGTA', 'TTGCA', 'ANNGT', '']
+        packed, masks, lengths = bus.pack_sequences(sequences)
+        self.assertEqual([9, 5, 5, 0], list(lengths))
+        self.assertEqual(0b00011011, packed[0, 0])
+        for i, sequence in enumerate(sequences):
+            mask = masks[i].tobytes() if masks[i].any() else None
+            self.assertEqual(
+                sequence,
+                bus.unpack_sequence(packed[i].tobytes(), lengths[i], mask)
+            )
+
+    def test_decode(self):
+        self.assertEqual('ACGT', bus.decode(0b00011011, 4))
+        self.assertEqual('AAT', bus.decode(3, 3))
+
+    def test_write_read(self):
+        path = os.path.join(tempfile.mkdtemp(), 'test.fqb')
+        records = [
+            ('ACGT', 'TT', 'ACGTACGTAC'),
+            ('ANGT', 'TT', 'ACGNACGTAC'),
+            ('TTTT', 'GN', 'A'),
+        ]
+        with bus.BUSWriter(path, 4, 2, text='test', batch_size=2) as writer:
+            for record in records:
+                writer.write(*record)
+        self.assertEqual(3, writer.n_records)
+
+        self.assertEqual([
+            ('ACGT', 'TT', 'ACGTACGTAC', 0),
+            (
+                'AAGT', 'TT', 'ACGNACGTAC',
+                bus.FLAG_BARCODE_N | bus.FLAG_SEQUENCE_N
+            ),
+            ('TTTT', 'GA', 'A', bus.FLAG_UMI_N),
+        ], list(bus.read_bus(path)))
+
+    def test_write_wrong_length(self):
+        path = os.path.join(tempfile.mkdtemp(), 'test.fqb')
+        with bus.BUSWriter(path, 4, 2) as writer:
+            with self.assertRaises(Exception):
+                writer.write('ACG', 'TT', 'ACGT')
@@ -0,0 +1,97 @@
+import gzip
+import os
+import tempfile
+import uuid
+from unittest import mock, TestCase
+
+import fqc.compression as compression
+from tests.mixins import TestMixin
+
+
+class TestCompression(TestMixin, TestCase):
+
+    def setUp(self):
+        self.path = os.path.join(
+            tempfile.gettempdir(), '{}.gz'.format(uuid.uuid4())
+        )
+        with gzip.open(self.path, 'wt') as f:
+            f.write('1\n2\n3\n' * 10000)
+
+    def tearDown(self):
+        compression.set_backend('auto')
+        os.remove(self.path)
+
+    def test_backends(self):
+        for name, backend in compression.BACKENDS.items():
+            if not backend.available():
+                continue
+            compression.set_backend(name)
+            with compression.open_decompressed(self.path) as f:
+                self.assertEqual('1\n2\n3\n' * 10000, f.read())
+
+    def test_close_early(self):
+        for name, backend in compression.BACKENDS.items():
+            if not backend.available():
+                continue
+            compression.set_backend(name)
+            with compression.open_decompressed(self.path) as f:
+                self.assertEqual('1\n', f.readline())
+
+    def test_close_early_killed(self):
+        # The process is killed by SIGPIPE when its output is closed before
+        # all of it was read, which is not a failure.
+        path = os.path.join(tempfile.gettempdir(), '{}.gz'.format(uuid.uuid4()))
+        with gzip.open(path, 'wt') as f:
+            f.write('1\n2\n3\n' * 1000000)
+        try:
+            for name in ['pigz', 'gzip']:
+                if not compression.BACKENDS[name].available():
+                    continue
+                compression.set_backend(name)
+                f = compression.open_decompressed(path, 'rb')
+                self.assertEqual(b'1\n', f.readline())
+                f.raw.fileobj.close()
+                f.raw.process.wait()
+                f.close()
+        finally:
+            os.remove(path)
+
+    def test_set_backend_unavailable(self):
+        backend = compression.Backend('test', lambda: False, None)
+        with mock.patch.dict(compression.BACKENDS, {'test': backend}):
+            self.assertNotEqual('test', compression.set_backend('test').name)
+
+    def test_set_backend_unknown(self):
+        with self.assertRaises(Exception):
+            compression.set_backend('unknown')
+
+    def test_register_backend(self):
+        opened = []
+
+        def _open(path):
+            opened.append(path)
+            return gzip.open(path, 'rb'), None
+
+        backend = compression.Backend('test', lambda: True, _open)
+        try:
+            compression.register_backend(backend, first=True)
+            self.assertEqual('test', compression.get_backend().name)
+            with compression.open_decompressed(self.path, 'rb') as f:
+                self.assertEqual(b'1\n', f.readline())
+            self.assertEqual([self.path], opened)
+        finally:
+            del compression.BACKENDS['test']
+
+    def test_command_failure(self):
+        if not compression.BACKENDS['gzip'].available():
+            return
+        compression.set_backend('gzip')
+        path = os.path.join(tempfile.gettempdir(), '{}.gz'.format(uuid.uuid4()))
+        with open(path, 'w') as f:
+            f.write('not gzip')
+        try:
+            with self.assertRaises(Exception):
+                with compression.open_decompressed(path) as f:
+                    f.read()
+        finally:
+            os.remove(path)
@@ -0,0 +1,57 @@
+import random
+from unittest import TestCase
+
+import fqc.discovery as discovery
+from fqc.plan import ENCODING, to_matrix
+from fqc.technologies import TECHNOLOGIES_MAPPING
+from fqc.utils import open_as_text
+
+
+def random_sequence(rng, length):
+    return ''.join(rng.choice('ACGT') for _ in range(length))
+
+
+class TestDiscovery(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.whitelist_path = TECHNOLOGIES_MAPPING['10xv2'].whitelist_path
+        with open_as_text(cls.whitelist_path, 'r') as f:
+            cls.barcodes = [f.readline().strip() for _ in range(1000)]
+
+    def test_whitelist_length(self):
+        self.assertEqual(16, discovery.whitelist_length(self.whitelist_path))
+
+    def test_window_codes(self):
+        values = ENCODING[to_matrix(['ACGTN', 'TTTT'])[0]]
+        codes, valid = discovery.window_codes(values, 3)
+        self.assertEqual((2, 3), codes.shape)
+        self.assertEqual([0b000110, 0b011011], list(codes[0, :2]))
+        self.assertEqual([0b111111, 0b111111], list(codes[1, :2]))
+        self.assertEqual([[True, True, False], [True, True, False]],
+                         valid.tolist())
+
+    def test_discover_shifted(self):
+        rng = random.Random(0)
+        reads = [[], []]
+        for _ in range(2000):
+            barcode = rng.choice(self.barcodes) if rng.random() < 0.8 else \
+                random_sequence(rng, 16)
+            reads[0].append(random_sequence(rng, 50))
+            reads[1].append(
+                random_sequence(rng, 3) + barcode + random_sequence(rng, 13)
+            )
+        discoveries = discovery.discover(reads, [self.whitelist_path])
+        self.assertEqual(1, len(discoveries))
+        d = discoveries[0]
+        self.assertEqual((1, 3, 19), (d.file, d.start, d.stop))
+        self.assertAlmostEqual(0.8, d.rate, delta=0.05)
+        self.assertIn('10xv2', d.technologies)
+
+    def test_discover_random(self):
+        rng = random.Random(0)
+        reads = [[random_sequence(rng, 30) for _ in range(2000)]]
+        self.assertEqual([], discovery.discover(reads, [self.whitelist_path]))
+
+    def test_discover_empty(self):
+        self.assertEqual([], discovery.discover([[]]))
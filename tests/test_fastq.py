@@ -9,3 +9,14 @@ class TestFastq(TestMixin, TestCase):
     def test_getitem(self):
         f = fastq.Fastq(self.fastq_10xv2_paths[0])
         self.assertEqual(['TTCTACAGTGTGGTTTTGGACAGGTG'], f[0:1])
+
+    def test_interleaved_batches(self):
+        lines = []
+        for i in range(5):
+            lines.extend([f'@{i}', f'R1_{i}', '+', 'F'])
+            lines.extend([f'@{i}', f'R2_{i}', '+', 'F'])
+        self.assertEqual([
+            [['R1_0', 'R1_1'], ['R2_0', 'R2_1']],
+            [['R1_2', 'R1_3'], ['R2_2', 'R2_3']],
+            [['R1_4'], ['R2_4']],
+        ], list(fastq.interleaved_batches(lines, 2, 2)))
@@ -1,11 +1,18 @@
+import gzip
+import hashlib
+import os
+import shutil
+import tempfile
 from collections import OrderedDict
 from unittest import mock, TestCase
 
 import fqc.fqc as fqc
+from fqc.bam import read_checksums
 from fqc.technologies import OrderedTechnology, TECHNOLOGIES_MAPPING
+from tests.mixins import TestMixin
 
 
-class TestFqc(TestCase):
+class TestFqc(TestMixin, TestCase):
 
     def test_all_ordered_technologies(self):
         self.assertEqual([
@@ -13,68 +20,253 @@ class TestFqc(TestCase):
             OrderedTechnology(TECHNOLOGIES_MAPPING['10xv2'], (1, 0))
         ], fqc.all_ordered_technologies([TECHNOLOGIES_MAPPING['10xv2']], 2))
 
-    def test_extract_barcodes_umis(self):
-        reads = OrderedDict()
-        reads['1'] = ['2' * 50]
-        reads['2'] = ['4' * 50]
+    def test_is_single_cell(self):
+        pass
 
-        self.assertEqual(
-            ({
-                '10xv2': {(0, 1): [['2222222222222222']]}
-            }, {
-                '10xv2': {(0, 1): [['2222222222']]}
-            }, {
-                '10xv2': set()
-            }),
-            fqc.extract_barcodes_umis(
-                reads,
-                [OrderedTechnology(TECHNOLOGIES_MAPPING['10xv2'], (0, 1))]
+    def test_fqc_fastq(self):
+        technologies = fqc.all_ordered_technologies([
+            TECHNOLOGIES_MAPPING['10xv2']
+        ], 2)
+        for batch_size in [7, 10000]:
+            fastqs, result = fqc.fqc_fastq(
+                self.fastq_10xv2_paths,
+                10,
+                100,
+                technologies=technologies,
+                batch_size=batch_size
             )
+            self.assertEqual(self.fastq_10xv2_paths, fastqs)
+            self.assertEqual([
+                OrderedTechnology(TECHNOLOGIES_MAPPING['10xv2'], (0, 1))
+            ], result)
+
+    def test_detect_fastqs_stop_confidence(self):
+        technologies = fqc.all_ordered_technologies([
+            TECHNOLOGIES_MAPPING['10xv2']
+        ], 2)
+        fastqs, detector = fqc.detect_fastqs(
+            self.fastq_10xv2_paths,
+            10,
+            100,
+            technologies=technologies,
+            batch_size=7,
+            stop_confidence=0.99
         )
+        self.assertEqual(self.fastq_10xv2_paths, fastqs)
+        self.assertEqual(
+            OrderedTechnology(TECHNOLOGIES_MAPPING['10xv2'], (0, 1)),
+            detector.best
+        )
+        # Stops early once the confidence is high enough.
+        self.assertLess(detector.n, 100)
+        self.assertGreaterEqual(detector.confidence, 0.99)
 
-    def test_extract_barcodes_umis_invalid(self):
-        reads = OrderedDict()
-        reads['1'] = ['2' * 5]
-        reads['2'] = ['4' * 5]
+    def test_fqc_fastq_batches(self):
+        with mock.patch('fqc.fqc.Detector') as Detector:
+            Detector.return_value.n = 0
 
-        self.assertEqual(
-            ({
-                '10xv2': {}
-            }, {
-                '10xv2': {}
-            }, {
-                '10xv2': {(0, 1)}
-            }),
-            fqc.extract_barcodes_umis(
-                reads,
-                [OrderedTechnology(TECHNOLOGIES_MAPPING['10xv2'], (0, 1))]
+            def update(batch):
+                Detector.return_value.n += len(batch[0])
+
+            Detector.return_value.update.side_effect = update
+            fqc.fqc_fastq(self.fastq_10xv2_paths, 10, 100, batch_size=30)
+            self.assertEqual([30, 30, 30, 10], [
+                len(call[0][0][0])
+                for call in Detector.return_value.update.call_args_list
+            ])
+
+    def test_fqc_fastq_index(self):
+        path = os.path.join(tempfile.mkdtemp(), 'index.fastq')
+        with open(path, 'w') as f:
+            for i in range(200):
+                f.write(f'@{i}\nACGTACGT\n+\nFFFFFFFF\n')
+        fastqs, _ = fqc.fqc_fastq(
+            self.fastq_10xv2_paths + [path],
+            0,
+            100,
+            technologies=fqc.all_ordered_technologies([
+                TECHNOLOGIES_MAPPING['10xv2']
+            ], 2)
+        )
+        self.assertEqual(self.fastq_10xv2_paths, fastqs)
+
+        # All FASTQs are index reads.
+        fastqs, technologies = fqc.fqc_fastq([path, path], 0, 100)
+        self.assertEqual([path, path], fastqs)
+        self.assertEqual([], technologies)
+
+    def test_fqc_fastq_discover(self):
+        # Shift all barcodes by 3 bases, so that detection fails.
+        directory = tempfile.mkdtemp()
+        paths = [
+            os.path.join(directory, 'shifted_1.fastq'),
+            self.fastq_10xv2_paths[1]
+        ]
+        with gzip.open(self.fastq_10xv2_paths[0], 'rt') as f, open(paths[0],
+                                                                   'w') as out:
+            for i, line in enumerate(f):
+                out.write(line if i % 2 == 0 else f'ACG{line}')
+
+        with self.assertLogs('fqc.fqc', level='WARNING') as logs:
+            _, technologies = fqc.fqc_fastq(
+                paths,
+                0,
+                100,
+                technologies=fqc.all_ordered_technologies([
+                    TECHNOLOGIES_MAPPING['10xv2']
+                ], 2)
             )
+        self.assertEqual([], technologies)
+        self.assertTrue(
+            any(f'{paths[0]} [3:19]' in line for line in logs.output)
         )
 
-    def test_filter_files(self):
-        fastqs = [1]
-        result = fqc.filter_files(
-            fastqs, [OrderedTechnology(TECHNOLOGIES_MAPPING['10xv2'], (0, 1))]
+    def test_detector(self):
+        reads = [['AAACCTGAGAAACCAT' + 'A' * 10] * 3, ['C' * 50] * 3]
+        detector = fqc.Detector(
+            2, [
+                OrderedTechnology(TECHNOLOGIES_MAPPING['10xv2'], (0, 1)),
+                OrderedTechnology(TECHNOLOGIES_MAPPING['10xv2'], (1, 0))
+            ]
         )
-        self.assertListEqual([], result)
+        self.assertIsNone(detector.best)
+        self.assertEqual(0, detector.confidence)
 
-    def test_filter_barcodes_umis(self):
-        pass
+        detector.update(reads)
+        detector.update(reads)
+        self.assertEqual(6, detector.n)
+        self.assertEqual([
+            (OrderedTechnology(TECHNOLOGIES_MAPPING['10xv2'], (0, 1)), 6),
+            (OrderedTechnology(TECHNOLOGIES_MAPPING['10xv2'], (1, 0)), 0),
+        ], detector.ranking)
+        self.assertEqual(
+            OrderedTechnology(TECHNOLOGIES_MAPPING['10xv2'], (0, 1)),
+            detector.best
+        )
+        confidence = detector.confidence
+        self.assertGreater(confidence, 0.9)
 
-    def test_is_single_cell(self):
-        pass
+        detector.update(reads)
+        self.assertGreater(detector.confidence, confidence)
 
-    def test_fqc_fastq(self):
-        with mock.patch('fqc.fqc.Fastq') as Fastq,\
-            mock.patch('fqc.fqc.is_single_cell') as is_single_cell,\
-            mock.patch('fqc.fqc.filter_files') as filter_files,\
-            mock.patch('fqc.fqc.filter_barcodes_umis') as filter_barcodes_umis:
-            Fastq.return_value = ['r1', 'r2']
-            is_single_cell.return_value = True
-            fqc.fqc_fastq(['f1', 'f2'], 0, 2)
+    def test_fqc_stream(self):
+        lines = []
+        for i in range(20):
+            lines.extend([
+                f'@{i}\n', 'AAACCTGAGAAACCAT' + 'A' * 10 + '\n', '+\n',
+                'F' * 26 + '\n'
+            ])
+            lines.extend([f'@{i}\n', 'C' * 50 + '\n', '+\n', 'F' * 50 + '\n'])
+        detector = fqc.fqc_stream(
+            iter(lines),
+            2,
+            5,
+            100,
+            technologies=fqc.all_ordered_technologies([
+                TECHNOLOGIES_MAPPING['10xv2']
+            ], 2),
+            batch_size=4,
+            stop_confidence=0.99
+        )
+        self.assertEqual(
+            OrderedTechnology(TECHNOLOGIES_MAPPING['10xv2'], (0, 1)),
+            detector.best
+        )
+        # Stops early once the confidence is high enough.
+        self.assertLess(detector.n, 15)
+        self.assertGreaterEqual(detector.confidence, 0.99)
 
+    def test_fqc_samples(self):
+        directory = tempfile.mkdtemp()
+        groups = OrderedDict()
+        for lane in ['001', '002']:
             reads = OrderedDict()
-            reads['f1'] = ['r1', 'r2']
-            reads['f2'] = ['r1', 'r2']
-            filter_files.assert_called_once_with(reads)
-            filter_barcodes_umis.assert_called_once_with(reads, filter_files())
+            for read, path in zip(['R2', 'R1'], self.fastq_10xv2_paths):
+                # R1 and R2 are swapped, so that the detected ordering is (1, 0).
+                reads[read] = os.path.join(
+                    directory, f'a_S1_L{lane}_{read}_001.fastq.gz'
+                )
+                shutil.copy(path, reads[read])
+            groups.setdefault('a_S1', OrderedDict())[lane] = reads
+
+        results = fqc.fqc_samples(
+            groups,
+            0,
+            100,
+            technologies=fqc.all_ordered_technologies([
+                TECHNOLOGIES_MAPPING['10xv2']
+            ], 2),
+            threads=1
+        )
+        technology, lanes = results['a_S1']
+        self.assertEqual(TECHNOLOGIES_MAPPING['10xv2'], technology.technology)
+        self.assertEqual({
+            lane: [reads['R2'], reads['R1']]
+            for lane, reads in groups['a_S1'].items()
+        }, lanes)
+
+    def test_fqc_bams(self):
+        directory = tempfile.mkdtemp()
+        paths = [os.path.join(directory, f'{i}.bam') for i in range(2)]
+        for path in paths:
+            shutil.copy(self.bam_10xv2_path, path)
+        prefix = os.path.join(directory, 'merged')
+
+        self.assertEqual(
+            TECHNOLOGIES_MAPPING['10xv2'], fqc.fqc_bams(paths, threads=2)
+        )
+        fastqs, technologies = fqc.fqc_bams(
+            paths, split=True, prefix=prefix, threads=2
+        )
+        self.assertEqual([f'{prefix}_1.fastq.gz', f'{prefix}_2.fastq.gz'],
+                         fastqs)
+        self.assertEqual([
+            OrderedTechnology(TECHNOLOGIES_MAPPING['10xv2'], (0, 1))
+        ], technologies)
+        # The merged FASTQs contain the reads of both BAMs, in order.
+        for fastq1, fastq2 in zip(self.fastq_10xv2_paths, fastqs):
+            with gzip.open(fastq1, 'rt') as f1, gzip.open(fastq2, 'rt') as f2:
+                self.assertEqual(f1.read() * 2, f2.read())
+        self.assertEqual([], [
+            file for file in os.listdir(directory) if 'shard' in file
+        ])
+        rows = read_checksums(f'{prefix}.checksums.tsv')
+        self.assertEqual(fastqs, [row[0] for row in rows])
+        for fastq, md5, size, records, _ in rows:
+            with open(fastq, 'rb') as f:
+                self.assertEqual(hashlib.md5(f.read()).hexdigest(), md5)
+            self.assertEqual(os.path.getsize(fastq), size)
+            self.assertEqual(2 * 146, records)
+
+    def test_fqc_bams_shards(self):
+        directory = tempfile.mkdtemp()
+        paths = [os.path.join(directory, f'{i}.bam') for i in range(2)]
+        for path in paths:
+            shutil.copy(self.bam_10xv2_path, path)
+        prefix = os.path.join(directory, 'merged')
+        shards, _ = fqc.fqc_bams(
+            paths, split=True, prefix=prefix, threads=2, merge=False
+        )
+        self.assertEqual([[
+            f'{prefix}_shard{j}_{i}.fastq.gz' for i in range(1, 3)
+        ] for j in range(1, 3)], shards)
+
+    def test_bam_whitelist(self):
+        technology = TECHNOLOGIES_MAPPING['10xv2']
+        whitelist = fqc.bam_whitelist(technology, technology_whitelist=True)
+        self.assertIn('AAACCTGAGAAACCAT', whitelist)
+        self.assertIsNone(fqc.bam_whitelist(technology))
+        with self.assertRaises(Exception) as context:
+            fqc.bam_whitelist(
+                technology._replace(whitelist_path='missing.txt.gz'),
+                technology_whitelist=True
+            )
+        self.assertIn('does not exist', str(context.exception))
+
+    def test_fqc_bams_different_technologies(self):
+        bams = [mock.MagicMock(), mock.MagicMock()]
+        bams[0].technology = TECHNOLOGIES_MAPPING['10xv2']
+        bams[1].technology = TECHNOLOGIES_MAPPING['10xv3']
+        with mock.patch('fqc.fqc.load_bam', side_effect=bams):
+            with self.assertRaises(Exception):
+                fqc.fqc_bams(['a.bam', 'b.bam'])
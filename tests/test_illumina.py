@@ -0,0 +1,51 @@
+import os
+import tempfile
+from collections import OrderedDict
+from unittest import TestCase
+
+import fqc.illumina as illumina
+
+
+class TestIllumina(TestCase):
+
+    def test_parse_illumina(self):
+        self.assertEqual(
+            illumina.IlluminaFastq(
+                'dir/pbmc_S1_L002_R1_001.fastq.gz', 'pbmc_S1', '002', 'R1',
+                '001'
+            ), illumina.parse_illumina('dir/pbmc_S1_L002_R1_001.fastq.gz')
+        )
+        self.assertEqual(
+            '',
+            illumina.parse_illumina('pbmc_S1_I1_001.fastq').lane
+        )
+        self.assertIsNone(illumina.parse_illumina('pbmc_1.fastq.gz'))
+
+    def test_group_fastqs(self):
+        paths = [
+            f'a_S1_L00{lane}_{read}_001.fastq.gz' for lane in [2, 1]
+            for read in ['R2', 'I1', 'R1']
+        ] + ['b_S2_R1_001.fastq.gz', 'other.fastq.gz']
+        groups, others = illumina.group_fastqs(paths)
+        self.assertEqual(['other.fastq.gz'], others)
+        self.assertEqual(['a_S1', 'b_S2'], list(groups.keys()))
+        self.assertEqual(['001_001', '002_001'], list(groups['a_S1'].keys()))
+        self.assertEqual(
+            OrderedDict([
+                ('I1', 'a_S1_L001_I1_001.fastq.gz'),
+                ('R1', 'a_S1_L001_R1_001.fastq.gz'),
+                ('R2', 'a_S1_L001_R2_001.fastq.gz'),
+            ]), groups['a_S1']['001_001']
+        )
+        self.assertEqual({'001': {
+            'R1': 'b_S2_R1_001.fastq.gz'
+        }}, groups['b_S2'])
+
+    def test_scan_directory(self):
+        directory = tempfile.mkdtemp()
+        os.makedirs(os.path.join(directory, 'project'))
+        for name in ['project/a_S1_L001_R1_001.fastq.gz', 'Undetermined.txt']:
+            with open(os.path.join(directory, name), 'w'):
+                pass
+        groups = illumina.scan_directory(directory)
+        self.assertEqual(['a_S1'], list(groups.keys()))
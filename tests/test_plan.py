@@ -0,0 +1,161 @@
+import gzip
+import os
+import random
+import tempfile
+from unittest import mock, TestCase
+
+import numpy as np
+
+import fqc.fastq as fastq
+import fqc.plan as plan
+from fqc.fqc import all_ordered_technologies
+from fqc.technologies import (
+    AnchoredSubstring,
+    OrderedTechnology,
+    ReadSubstring,
+    Technology,
+    TECHNOLOGIES_MAPPING,
+)
+from tests.mixins import TestMixin
+
+
+class TestPlan(TestMixin, TestCase):
+
+    def test_encode(self):
+        matrix, lengths = plan.to_matrix(['ACGT', 'TTN', 'a'])
+        self.assertEqual([4, 3, 1], list(lengths))
+        codes, valid = plan.encode(matrix[:, :2])
+        self.assertEqual([0b0001, 0b1111], list(codes[valid]))
+        self.assertEqual([True, True, False], list(valid))
+
+    def test_lookup(self):
+        whitelist = np.array([1, 5, 9], dtype=np.uint64)
+        codes = np.array([0, 1, 5, 10], dtype=np.uint64)
+        self.assertEqual([False, True, True, False],
+                         list(plan.lookup(codes, whitelist)))
+
+    def test_load_whitelist(self):
+        path = os.path.join(tempfile.mkdtemp(), 'whitelist.txt.gz')
+        with gzip.open(path, 'wt') as f:
+            f.write('AC\nAA\nNA\nAC\n')
+        self.assertEqual([0, 1], list(plan.load_whitelist(path)))
+
+    def test_load_whitelist_mmap(self):
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'whitelist.txt')
+        with open(path, 'w') as f:
+            f.write('AC\nAA\nNA\nAC\n')
+        with mock.patch('fqc.plan.WHITELIST_CACHE_DIR', directory):
+            whitelist = plan.load_whitelist(path, 'mmap')
+        self.assertIsInstance(whitelist, np.memmap)
+        self.assertEqual([0, 1], list(whitelist))
+        self.assertEqual([
+            True, False
+        ], list(plan.lookup(np.array([1, 2], dtype=np.uint64), whitelist)))
+
+    def test_deduplicates_windows(self):
+        technologies = [
+            TECHNOLOGIES_MAPPING['10xv2'],
+            TECHNOLOGIES_MAPPING['10xv2']._replace(name='other')
+        ]
+        p = plan.ExtractionPlan(all_ordered_technologies(technologies, 2))
+        # Barcode and UMI windows for each of the two files.
+        self.assertEqual(4, len(p.windows))
+        # Same windows and whitelist for both technologies.
+        self.assertEqual(2, len(p.lookups))
+
+    def test_compile_plan(self):
+        ordered = all_ordered_technologies([TECHNOLOGIES_MAPPING['10xv2']], 2)
+        p = plan.compile_plan(ordered)
+        self.assertIs(p, plan.compile_plan(list(ordered)))
+        self.assertIsNot(p, plan.compile_plan(ordered[:1]))
+
+    def test_count(self):
+        reads = [fastq.Fastq(path)[0:100] for path in self.fastq_10xv2_paths]
+        ordered = all_ordered_technologies([TECHNOLOGIES_MAPPING['10xv2']], 2)
+        counts, n, invalid = plan.ExtractionPlan(ordered).count(reads)
+
+        whitelist = set(
+            gzip.open(TECHNOLOGIES_MAPPING['10xv2'].whitelist_path,
+                      'rt').read().split()
+        )
+        expected = sum(read[:16] in whitelist for read in reads[0])
+        self.assertEqual(len(reads[0]), n)
+        self.assertEqual(expected, counts[0])
+        self.assertFalse(invalid[0])
+
+    def test_count_invalid(self):
+        technology = Technology(
+            'test', 'test', 2, ReadSubstring(1, None, None),
+            [ReadSubstring(0, 4, 8)], [ReadSubstring(0, 0, 4)], None
+        )
+        p = plan.ExtractionPlan([
+            OrderedTechnology(technology, (0, 1)),
+            OrderedTechnology(technology, (1, 0))
+        ])
+        counts, n, invalid = p.count([['A' * 10, 'A' * 10], ['A' * 5] * 2])
+        self.assertEqual([0, 0], list(counts))
+        self.assertEqual(2, n)
+        self.assertEqual([False, True], list(invalid))
+
+    def test_find_anchor(self):
+        matrix, lengths = plan.to_matrix(['AAGGCCAA', 'GGCTAAAA', 'TTTTTTTT'])
+        positions, found = plan.find_anchor(matrix, lengths, 'GGCC', 0, None, 1)
+        self.assertEqual([2, 0], list(positions[:2]))
+        self.assertEqual([True, True, False], list(found))
+
+    def test_count_segments(self):
+        technology = TECHNOLOGIES_MAPPING['indropsv3']
+        whitelists = [
+            gzip.open(path, 'rt').read().split()
+            for path in technology.segment_whitelist_paths
+        ]
+        rng = random.Random(0)
+        reads = [[], [], []]
+        for i in range(100):
+            # Only the first 80 reads have a second segment in its whitelist.
+            bc2 = rng.choice(whitelists[1]) if i < 80 else 'ACGTACGT'
+            reads[0].append(rng.choice(whitelists[0]) + 'A' * 20)
+            reads[1].append(bc2 + 'CCCCCC')
+            reads[2].append('G' * 50)
+        ordered = all_ordered_technologies([technology], 3)
+        p = plan.ExtractionPlan(ordered)
+        # Each segment is looked up independently, so segments in the same
+        # file are shared between orderings: one lookup per segment per file.
+        self.assertEqual(2 * 3, len(p.lookups))
+        counts, n, invalid = p.count(reads)
+        self.assertEqual(100, n)
+        self.assertEqual(
+            80, counts[ordered.index(OrderedTechnology(technology, (0, 1, 2)))]
+        )
+
+    def test_count_anchored(self):
+        anchor = 'GAGTGATTGCTTGTGACGCCTT'
+        path = os.path.join(tempfile.mkdtemp(), 'whitelist.txt.gz')
+        with gzip.open(path, 'wt') as f:
+            f.write('AAAACCCC\nGGGGTTTT\n')
+        technology = Technology(
+            'anchored', 'anchored', 2, ReadSubstring(1, None, None), [
+                AnchoredSubstring(
+                    0, anchor, len(anchor),
+                    len(anchor) + 6, 0, 40, 1
+                )
+            ], [AnchoredSubstring(0, anchor, -8, 0, 0, 40, 1)], path
+        )
+        reads = [
+            [
+                'AAAACCCC' + anchor + 'ACGTAC' + 'T' * 10,
+                'TTT' + 'GGGGTTTT' + anchor + 'ACGTAC' + 'T' * 10,
+                # One mismatch in the anchor.
+                'A' + 'GGGGTTTT' + 'C' + anchor[1:] + 'ACGTAC',
+                # Not in the whitelist.
+                'TTTTTTTT' + anchor + 'ACGTAC' + 'T' * 10,
+                # No anchor.
+                'AAAACCCC' + 'A' * 40,
+            ],
+            ['G' * 50] * 5,
+        ]
+        p = plan.ExtractionPlan([OrderedTechnology(technology, (0, 1))])
+        counts, n, invalid = p.count(reads)
+        self.assertEqual([3], list(counts))
+        self.assertFalse(invalid[0])
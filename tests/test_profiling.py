@@ -0,0 +1,112 @@
+import gzip
+import json
+import os
+import tempfile
+import tracemalloc
+from unittest import TestCase
+
+import numpy as np
+
+import fqc.fastq as fastq
+import fqc.profiling as profiling
+from tests.mixins import TestMixin
+
+
+class TestProfiling(TestMixin, TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def write_fastq(self, path, reads, newline='\n'):
+        records = [
+            newline.join([f'@read{i}', read, '+', 'I' * len(read)])
+            for i, read in enumerate(reads)
+        ]
+        # The last record does not end with a newline.
+        open_func = gzip.open if path.endswith('.gz') else open
+        with open_func(path, 'wt', newline='') as f:
+            f.write(newline.join(records))
+        return path
+
+    def test_profile_fastq(self):
+        reads = ['TTACGNAA', '', 'acgtaan', 'TTTT', 'GNNA']
+        for name, newline in [('reads.fastq.gz', '\n'),
+                              ('reads.fastq', '\r\n')]:
+            path = self.write_fastq(
+                os.path.join(self.directory, name), reads, newline
+            )
+            for chunk_size in [5, 1024]:
+                profile = profiling.profile_fastq(path, chunk_size)
+                self.assertEqual(5, profile.n)
+                self.assertEqual([1, 0, 0, 0, 2, 0, 0, 1, 1],
+                                 profile.lengths.tolist())
+                self.assertEqual([2, 0, 0, 3], profile.poly_a.tolist())
+                self.assertEqual([3, 0, 1, 0, 1], profile.poly_t.tolist())
+                self.assertEqual([2, 2, 1], profile.n_content.tolist())
+                # Position 0 has 2 T's, 1 A and 1 G.
+                self.assertEqual([1, 0, 1, 2, 0],
+                                 profile.composition[0].tolist())
+                self.assertEqual(23, profile.composition.sum())
+
+    def test_profile_fastq_matches_reads(self):
+        for path in self.fastq_10xv2_paths:
+            reads = fastq.Fastq(path)[0:1000]
+            profile = profiling.profile_fastq(path, 1000)
+            self.assertEqual(len(reads), profile.n)
+            self.assertEqual(
+                np.bincount([len(read) for read in reads]).tolist(),
+                profile.lengths.tolist()
+            )
+            self.assertEqual(
+                np.bincount([
+                    len(read) - len(read.upper().rstrip('AN')) for read in reads
+                ]).tolist(), profile.poly_a.tolist()
+            )
+
+    def test_profile_fastq_long_read(self):
+        # A single long read does not pad all other reads to its length, which
+        # would take 2001 * 100000 bytes.
+        reads = ['A' * 100000] + ['ACGTT' * 10] * 2000
+        path = self.write_fastq(
+            os.path.join(self.directory, 'long.fastq'), reads
+        )
+        tracemalloc.start()
+        try:
+            profile = profiling.profile_fastq(path)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        self.assertLess(peak, 50 * 1024**2)
+        self.assertEqual(2001, profile.n)
+        self.assertEqual(2000, profile.lengths[50])
+        self.assertEqual(1, profile.poly_a[100000])
+        self.assertEqual(2001, profile.poly_t[0])
+        self.assertEqual(2000, profile.composition[3, 3])
+        self.assertEqual(1, profile.composition[99999, 0])
+
+    def test_profile_fastq_invalid(self):
+        path = os.path.join(self.directory, 'invalid.fastq')
+        with open(path, 'w') as f:
+            f.write('@read0\nACGT\n+\nIIII\nread1\nACGT\n+\nIIII\n')
+        with self.assertRaises(Exception):
+            profiling.profile_fastq(path)
+        with open(path, 'w') as f:
+            f.write('@read0\nACGT\n+\nIIII\n@read1\nACGT\n')
+        with self.assertRaises(Exception):
+            profiling.profile_fastq(path)
+
+    def test_write_report(self):
+        profiles = profiling.profile_fastqs(self.fastq_10xv2_paths, 2)
+        self.assertEqual(self.fastq_10xv2_paths, list(profiles.keys()))
+        path = profiling.write_report(
+            profiles, os.path.join(self.directory, 'report.json')
+        )
+        with open(path, 'r') as f:
+            report = json.load(f)
+        self.assertEqual(self.fastq_10xv2_paths, list(report.keys()))
+        for fastq_path, profile in profiles.items():
+            self.assertEqual(profile.n, report[fastq_path]['reads'])
+            self.assertEqual(
+                profile.composition[:, 0].tolist(),
+                report[fastq_path]['composition']['A']
+            )
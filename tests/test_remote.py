@@ -0,0 +1,229 @@
+import asyncio
+import os
+import shutil
+import tempfile
+import threading
+import time
+from unittest import mock, TestCase
+from urllib.request import urlopen
+
+import pysam
+
+import fqc.bam as bam
+import fqc.fqc as fqc
+import fqc.remote as remote
+from fqc.technologies import OrderedTechnology, TECHNOLOGIES_MAPPING
+from tests.mixins import TestMixin
+
+
+class LocalServer:
+    """Minimal asyncio HTTP server that serves files from a directory, with an
+    optional delay before each response.
+    """
+
+    def __init__(self, directory, delay=0):
+        self.directory = directory
+        self.delay = delay
+        self.active = 0
+        self.max_active = 0
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever)
+
+    async def handle(self, reader, writer):
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        try:
+            request = (await reader.readline()).decode().split()
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode().strip()
+                if not line:
+                    break
+                key, _, value = line.partition(':')
+                headers[key.lower()] = value.strip()
+            await asyncio.sleep(self.delay)
+
+            path = os.path.join(self.directory, request[1].lstrip('/'))
+            if request[1] == '/redirect.fastq.gz':
+                writer.write(
+                    b'HTTP/1.0 302 Found\r\nLocation: /10xv2_1.fastq.gz\r\n\r\n'
+                )
+            elif not os.path.exists(path):
+                writer.write(b'HTTP/1.0 404 Not Found\r\n\r\n')
+            else:
+                with open(path, 'rb') as f:
+                    data = f.read()
+                if 'range' in headers:
+                    stop = int(headers['range'].split('-')[1])
+                    data = data[:stop + 1]
+                writer.write(b'HTTP/1.0 200 OK\r\n\r\n' + data)
+            await writer.drain()
+        finally:
+            writer.close()
+            self.active -= 1
+
+    def __enter__(self):
+        self.server = self.loop.run_until_complete(
+            asyncio.start_server(self.handle, '127.0.0.1', 0)
+        )
+        self.port = self.server.sockets[0].getsockname()[1]
+        self.thread.start()
+        return self
+
+    async def shutdown(self):
+        self.server.close()
+        tasks = [
+            task for task in asyncio.all_tasks()
+            if task is not asyncio.current_task()
+        ]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def __exit__(self, *args):
+        asyncio.run_coroutine_threadsafe(self.shutdown(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    def url(self, name):
+        return f'http://127.0.0.1:{self.port}/{name}'
+
+
+class TestRemote(TestMixin, TestCase):
+
+    def test_is_remote(self):
+        self.assertTrue(remote.is_remote('http://localhost/a.fastq.gz'))
+        self.assertFalse(remote.is_remote(self.fastq_10xv2_paths[0]))
+
+    def test_fetch_heads_concurrent(self):
+        with LocalServer(self.fixtures_dir, delay=0.5) as server:
+            urls = [server.url('10xv2.bam')] * 4
+            start = time.time()
+            paths = remote.fetch_heads(urls, 4096)
+            elapsed = time.time() - start
+            max_active = server.max_active
+        for path in paths:
+            os.remove(path)
+        self.assertLess(elapsed, 1.5)
+        self.assertEqual(4, max_active)
+
+    def test_fetch_heads_bounded(self):
+        with LocalServer(self.fixtures_dir) as server:
+            paths = remote.fetch_heads([server.url('10xv2.bam')] * 6,
+                                       4096,
+                                       concurrency=2)
+            self.assertLessEqual(server.max_active, 2)
+        for path in paths:
+            os.remove(path)
+
+    def test_fetch_not_found(self):
+        with LocalServer(self.fixtures_dir) as server:
+            with self.assertRaises(Exception):
+                remote.fetch_heads([server.url('missing.bam')])
+
+    def test_fetch_timeout(self):
+        with LocalServer(self.fixtures_dir, delay=2) as server:
+            with self.assertRaises(Exception):
+                remote.fetch_heads([server.url('10xv2.bam')], timeout=0.2)
+
+    def test_fetch_heads(self):
+        with LocalServer(self.fixtures_dir) as server:
+            path = remote.fetch_heads([server.url('10xv2.bam')])[0]
+        try:
+            b = bam.BAM(self.bam_10xv2_path, head=path)
+            self.assertEqual(TECHNOLOGIES_MAPPING['10xv2'], b.technology)
+        finally:
+            os.remove(path)
+
+    def test_fetch_heads_truncated(self):
+        with LocalServer(self.fixtures_dir) as server:
+            path = remote.fetch_heads([server.url('10xv2.bam')], 4096)[0]
+        try:
+            # Only the first (header) block is complete.
+            self.assertEqual(2942 + 28, os.path.getsize(path))
+            with pysam.AlignmentFile(path, 'rb') as f:
+                self.assertIn('@HD', str(f.header))
+        finally:
+            os.remove(path)
+
+    def test_remote_files(self):
+        with LocalServer(self.fixtures_dir, delay=0.2) as server:
+            urls = [
+                server.url(os.path.basename(path))
+                for path in self.fastq_10xv2_paths
+            ]
+            with remote.RemoteFiles(urls) as files:
+                data = [f.read() for f in files]
+            self.assertEqual(2, server.max_active)
+        for path, d in zip(self.fastq_10xv2_paths, data):
+            with open(path, 'rb') as f:
+                self.assertEqual(f.read(), d)
+
+    def test_remote_files_urllib(self):
+        # Urls that are not http or https (i.e. ftp) are opened with urllib,
+        # concurrently.
+        def slow_urlopen(url, timeout=None):
+            time.sleep(0.5)
+            return urlopen(url, timeout=timeout)
+
+        urls = [f'file://{path}' for path in self.fastq_10xv2_paths]
+        with mock.patch('fqc.remote.urlopen', side_effect=slow_urlopen):
+            start = time.time()
+            with remote.RemoteFiles(urls) as files:
+                elapsed = time.time() - start
+                data = [f.read() for f in files]
+        self.assertLess(elapsed, 0.9)
+        for path, d in zip(self.fastq_10xv2_paths, data):
+            with open(path, 'rb') as f:
+                self.assertEqual(f.read(), d)
+
+    def test_remote_files_redirect(self):
+        with LocalServer(self.fixtures_dir) as server:
+            with remote.RemoteFiles([server.url('redirect.fastq.gz')]) as files:
+                data = files[0].read()
+        with open(self.fastq_10xv2_paths[0], 'rb') as f:
+            self.assertEqual(f.read(), data)
+
+    def test_remote_files_not_found(self):
+        with LocalServer(self.fixtures_dir) as server:
+            with self.assertRaises(Exception):
+                with remote.RemoteFiles([server.url('missing.fastq')]):
+                    pass
+
+    def test_remote_files_timeout(self):
+        with LocalServer(self.fixtures_dir, delay=2) as server:
+            with self.assertRaises(Exception):
+                with remote.RemoteFiles([server.url('10xv2_1.fastq.gz')],
+                                        timeout=0.2):
+                    pass
+
+    def test_fqc_bams_remote(self):
+        directory = tempfile.mkdtemp()
+        for name in ['a.bam', 'b.bam']:
+            shutil.copy(self.bam_10xv2_path, os.path.join(directory, name))
+        with LocalServer(directory) as server:
+            urls = [server.url('a.bam'), server.url('b.bam')]
+            with mock.patch('fqc.fqc.fetch_heads',
+                            side_effect=remote.fetch_heads) as fetch_heads:
+                technology = fqc.fqc_bams(urls + [self.bam_10xv2_path, urls[0]])
+        self.assertEqual(TECHNOLOGIES_MAPPING['10xv2'], technology)
+        # The heads of all remote BAMs are fetched at once, and only once.
+        fetch_heads.assert_called_once_with(urls)
+
+    def test_fqc_fastq_remote(self):
+        technologies = fqc.all_ordered_technologies([
+            TECHNOLOGIES_MAPPING['10xv2']
+        ], 2)
+        with LocalServer(self.fixtures_dir) as server:
+            urls = [
+                server.url(os.path.basename(path))
+                for path in self.fastq_10xv2_paths
+            ]
+            fastqs, result = fqc.fqc_fastq(
+                urls, 10, 100, technologies=technologies, batch_size=7
+            )
+        self.assertEqual(urls, fastqs)
+        self.assertEqual([
+            OrderedTechnology(TECHNOLOGIES_MAPPING['10xv2'], (0, 1))
+        ], result)
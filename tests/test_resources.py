@@ -0,0 +1,53 @@
+import gzip
+import os
+import tempfile
+from unittest import mock, TestCase
+
+import fqc.resources as resources
+from fqc.config import BATCH_SIZE, MAX_BUFFERED_BYTES
+from tests.mixins import TestMixin
+
+
+class TestResources(TestMixin, TestCase):
+
+    def test_whitelist_memory(self):
+        path = os.path.join(tempfile.mkdtemp(), 'whitelist.txt.gz')
+        with gzip.open(path, 'wt') as f:
+            f.write('ACGT\n' * 1000)
+        self.assertEqual(8000, resources.whitelist_memory(path))
+
+    def test_plan_resources_unlimited(self):
+        r = resources.plan_resources(threads=8, jobs=2)
+        self.assertEqual(2, r.processes)
+        self.assertEqual(4, r.threads)
+        self.assertEqual(BATCH_SIZE, r.batch_size)
+        self.assertEqual(MAX_BUFFERED_BYTES, r.max_buffered)
+        self.assertEqual('memory', r.whitelist_mode)
+
+    def test_plan_resources_large(self):
+        with mock.patch('fqc.resources.whitelist_paths', return_value=[]):
+            r = resources.plan_resources(threads=8, max_memory=64 << 30, jobs=4)
+        self.assertEqual(4, r.processes)
+        self.assertEqual(2, r.threads)
+        self.assertEqual(BATCH_SIZE, r.batch_size)
+        self.assertEqual(4, r.queue_depth)
+        self.assertEqual(MAX_BUFFERED_BYTES, r.max_buffered)
+        self.assertEqual('memory', r.whitelist_mode)
+
+    def test_plan_resources_degrades(self):
+        with mock.patch('fqc.resources.whitelist_paths',
+                        return_value=['whitelist']), \
+                mock.patch('fqc.resources.whitelist_memory',
+                           return_value=1 << 30), \
+                self.assertLogs('fqc.resources', level='WARNING') as logs:
+            r = resources.plan_resources(
+                threads=8, max_memory=(1 << 28) + (4 << 20), jobs=4
+            )
+        self.assertEqual(1, r.processes)
+        self.assertEqual(8, r.threads)
+        self.assertEqual('mmap', r.whitelist_mode)
+        self.assertEqual(1024, r.batch_size)
+        self.assertEqual(1, r.queue_depth)
+        self.assertEqual(3 << 19, r.max_buffered)
+        self.assertTrue(any('memory-mapped' in line for line in logs.output))
+        self.assertTrue(any('instead of 4' in line for line in logs.output))
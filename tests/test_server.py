@@ -0,0 +1,81 @@
+import os
+import socket
+import tempfile
+import threading
+import time
+from unittest import TestCase
+
+import fqc.client as client
+import fqc.server as server
+from tests.mixins import TestMixin
+
+
+class TestServer(TestMixin, TestCase):
+
+    def test_detect(self):
+        self.assertEqual([{
+            'technology': '10xv2',
+            'permutation': [1, 0]
+        }], server.detect(self.fastq_10xv2_paths[::-1], 0, 100))
+        self.assertEqual([{
+            'technology': '10xv2',
+            'permutation': [0, 1]
+        }], server.detect([self.bam_10xv2_path]))
+
+    def test_serve(self):
+        path = os.path.join(tempfile.mkdtemp(), 'fqc.sock')
+        thread = threading.Thread(target=server.serve, args=(path, 2))
+        thread.start()
+        try:
+            start = time.time()
+            while not client.is_running(path):
+                self.assertLess(time.time() - start, 60)
+                time.sleep(0.1)
+            self.assertEqual(0o600, os.stat(path).st_mode & 0o777)
+            with self.assertRaises(Exception):
+                server.serve(path)
+
+            # Concurrent requests.
+            results = [None] * 4
+
+            def detect(i):
+                results[i] = client.detect(
+                    self.fastq_10xv2_paths[::-1], 0, 100, path=path
+                )
+
+            threads = [
+                threading.Thread(target=detect, args=(i,)) for i in range(4)
+            ]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            self.assertEqual([[('10xv2', (1, 0))]] * 4, results)
+
+            self.assertEqual([('10xv2', (0, 1))],
+                             client.detect([self.bam_10xv2_path], path=path))
+            with self.assertRaises(Exception):
+                client.detect(['missing_1.fastq.gz'], path=path)
+            self.assertEqual(
+                'error',
+                client.request({'command': 'unknown'}, path)['status']
+            )
+        finally:
+            self.assertEqual(
+                'ok',
+                client.request({'command': 'shutdown'}, path)['status']
+            )
+            thread.join()
+        self.assertFalse(os.path.exists(path))
+        self.assertFalse(client.is_running(path))
+
+    def test_request_timeout(self):
+        # A server that never responds.
+        path = os.path.join(tempfile.mkdtemp(), 'fqc.sock')
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.bind(path)
+            sock.listen(1)
+            start = time.time()
+            with self.assertRaises(OSError):
+                client.detect(self.fastq_10xv2_paths, path=path, timeout=0.2)
+            self.assertLess(time.time() - start, 10)
@@ -0,0 +1,41 @@
+import os
+from unittest import TestCase
+
+import fqc.compression as compression
+import fqc.fqc as fqc
+import runs.sweep as sweep
+from fqc.plan import load_whitelist
+from fqc.remote import RemoteFiles
+from fqc.resources import whitelist_paths
+from tests.mixins import TestMixin
+from tests.test_remote import LocalServer
+
+
+class TestSweep(TestMixin, TestCase):
+
+    def test_evaluate_bytes(self):
+        # Like the sweep, load the whitelists before anything is counted.
+        for path in whitelist_paths():
+            load_whitelist(path)
+        run = ('local', self.fastq_10xv2_paths, '10xv2', (0, 1))
+        with LocalServer(self.fixtures_dir) as server:
+            urls = [
+                server.url(os.path.basename(path))
+                for path in self.fastq_10xv2_paths
+            ]
+            with sweep.counting():
+                results = [
+                    sweep.evaluate(run, 0, 100, None),
+                    sweep.evaluate(('remote',) + (urls,) + run[2:], 0, 100,
+                                   None),
+                ]
+        for result in results:
+            self.assertTrue(result['correct'])
+            self.assertGreater(result['bytes'], 0)
+            # Only part of the FASTQs is read.
+            self.assertLessEqual(
+                result['bytes'],
+                sum(os.path.getsize(path) for path in self.fastq_10xv2_paths)
+            )
+        self.assertIs(RemoteFiles, fqc.RemoteFiles)
+        self.assertNotIn('counted', compression.BACKENDS)
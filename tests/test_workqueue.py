@@ -0,0 +1,84 @@
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from unittest import TestCase
+
+import fqc.workqueue as workqueue
+from tests.mixins import TestMixin
+
+
+class TestWorkqueue(TestMixin, TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.manifest_path = os.path.join(self.directory, 'samples.tsv')
+        self.queue = os.path.join(self.directory, 'queue')
+        with open(self.manifest_path, 'w') as f:
+            f.write('# sample\tfiles\n')
+            f.write('\t'.join(['fastqs'] + self.fastq_10xv2_paths[::-1]) + '\n')
+            f.write(f'bam\t{self.bam_10xv2_path}\n')
+            f.write('missing\tmissing_1.fastq.gz\tmissing_2.fastq.gz\n')
+
+    def test_read_manifest(self):
+        samples = workqueue.read_manifest(self.manifest_path)
+        self.assertEqual(['fastqs', 'bam', 'missing'], list(samples.keys()))
+        self.assertEqual([self.bam_10xv2_path], samples['bam'])
+
+    def test_init_queue(self):
+        self.assertTrue(workqueue.init_queue(self.queue, self.manifest_path))
+        self.assertFalse(workqueue.init_queue(self.queue, self.manifest_path))
+        self.assertEqual(['000000.1', '000001.1', '000002.1'],
+                         sorted(os.listdir(os.path.join(self.queue, 'todo'))))
+
+        with open(self.manifest_path, 'a') as f:
+            f.write('other\tother.bam\n')
+        with self.assertRaises(Exception):
+            workqueue.init_queue(self.queue, self.manifest_path)
+
+    def test_workers(self):
+        workqueue.init_queue(self.queue, self.manifest_path)
+        with ProcessPoolExecutor(3) as executor:
+            futures = [
+                executor.submit(
+                    workqueue.work,
+                    self.queue,
+                    f'worker{i}',
+                    skip=0,
+                    n=100,
+                    poll_interval=0.1
+                ) for i in range(3)
+            ]
+            self.assertEqual(3, sum(future.result() for future in futures))
+
+        results = workqueue.merge(self.queue)
+        self.assertEqual(['fastqs', 'bam', 'missing'], list(results.keys()))
+        self.assertEqual(('ok', '10xv2', self.fastq_10xv2_paths),
+                         results['fastqs'])
+        self.assertEqual(('ok', '10xv2', [self.bam_10xv2_path]), results['bam'])
+        self.assertEqual('error', results['missing'][0])
+        self.assertEqual([], os.listdir(os.path.join(self.queue, 'leases')))
+
+    def test_stale_lease(self):
+        workqueue.init_queue(self.queue, self.manifest_path)
+        lease = workqueue.claim(self.queue, 'dead')
+        self.assertTrue(lease.endswith('000000.1.dead'))
+        # The worker that claimed the first sample never renews its lease.
+        os.utime(lease, (0, 0))
+
+        self.assertEqual(
+            3, workqueue.work(self.queue, 'worker', skip=0, n=100, timeout=60)
+        )
+        results = workqueue.merge(self.queue)
+        self.assertEqual('ok', results['fastqs'][0])
+
+    def test_stale_lease_max_attempts(self):
+        workqueue.init_queue(self.queue, self.manifest_path)
+        lease = workqueue.claim(self.queue, 'dead')
+        os.utime(lease, (0, 0))
+        self.assertEqual(1, workqueue.reclaim(self.queue, max_attempts=1))
+        self.assertEqual(['000000.1'],
+                         os.listdir(os.path.join(self.queue, 'failed')))
+
+        results = workqueue.merge(self.queue)
+        self.assertEqual(('failed', '', []), results['fastqs'])
+        self.assertEqual(('pending', '', []), results['bam'])
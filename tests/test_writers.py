@@ -0,0 +1,63 @@
+import gzip
+import hashlib
+import os
+import tempfile
+from unittest import TestCase
+
+import fqc.writers as writers
+
+
+class TestWriters(TestCase):
+
+    def test_handle_pool(self):
+        directory = tempfile.mkdtemp()
+        paths = [os.path.join(directory, f'{i}.txt') for i in range(3)]
+        pool = writers.HandlePool(max_open=2)
+        for path in paths + paths:
+            pool.get(path).write(b'A')
+            self.assertLessEqual(len(pool.handles), 2)
+        pool.close()
+        self.assertEqual(6, pool.n_opens)
+        for path in paths:
+            with open(path, 'rb') as f:
+                self.assertEqual(b'AA', f.read())
+
+    def test_handle_pool_truncates(self):
+        path = os.path.join(tempfile.mkdtemp(), 'test.txt')
+        with open(path, 'w') as f:
+            f.write('stale')
+        pool = writers.HandlePool(max_open=1)
+        pool.get(path).write(b'A')
+        pool.close()
+        with open(path, 'rb') as f:
+            self.assertEqual(b'A', f.read())
+
+    def test_gzip_split_writer(self):
+        directory = tempfile.mkdtemp()
+        paths = [os.path.join(directory, f'{i}.gz') for i in range(10)]
+        with writers.GzipSplitWriter(max_open=3, buffer_size=10,
+                                     max_buffered=50) as writer:
+            for i in range(100):
+                writer.write(paths[i % 10], f'{i}\n')
+                self.assertLess(writer.buffered, 50)
+        for i, path in enumerate(paths):
+            with gzip.open(path, 'rt') as f:
+                self.assertEqual([str(j) for j in range(i, 100, 10)],
+                                 f.read().split())
+
+    def test_checkpoint_truncate(self):
+        path = os.path.join(tempfile.mkdtemp(), 'a.txt.gz')
+        with writers.GzipSplitWriter() as writer:
+            writer.write(path, 'a\n')
+            sizes = writer.checkpoint()
+            writer.write(path, 'b\n')
+        self.assertLess(sizes[path], os.path.getsize(path))
+
+        with writers.GzipSplitWriter() as writer:
+            writer.truncate(sizes)
+            writer.write(path, 'c\n')
+        checksums = writer.checksums()
+        with gzip.open(path, 'rt') as f:
+            self.assertEqual('a\nc\n', f.read())
+        with open(path, 'rb') as f:
+            self.assertEqual(hashlib.md5(f.read()).hexdigest(), checksums[path])